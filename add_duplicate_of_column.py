@@ -0,0 +1,44 @@
+
+import psycopg2
+import os
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv(os.path.join(os.path.dirname(__file__), '.env'))
+
+DB_HOST = os.getenv('POSTGRES_HOST')
+DB_PORT = os.getenv('POSTGRES_PORT')
+DB_NAME = os.getenv('POSTGRES_DB')
+DB_USER = os.getenv('POSTGRES_USER')
+DB_PASSWORD = os.getenv('POSTGRES_PASSWORD')
+
+def add_duplicate_of_column():
+    conn = psycopg2.connect(
+        host=DB_HOST,
+        port=DB_PORT,
+        dbname=DB_NAME,
+        user=DB_USER,
+        password=DB_PASSWORD
+    )
+    cur = conn.cursor()
+    try:
+        cur.execute("""
+            ALTER TABLE fnol_work_items
+            ADD COLUMN IF NOT EXISTS duplicate_of_id INTEGER REFERENCES fnol_work_items(id) ON DELETE SET NULL;
+        """)
+        cur.execute("""
+            CREATE INDEX IF NOT EXISTS ix_fnol_work_items_duplicate_of_id
+            ON fnol_work_items (duplicate_of_id);
+        """)
+        conn.commit()
+        print("duplicate_of_id column added (if not already present).")
+        print("Run migrate.py to create the minhash_signatures and minhash_bands tables.")
+    except Exception as e:
+        print(f"Error: {e}")
+        conn.rollback()
+    finally:
+        cur.close()
+        conn.close()
+
+if __name__ == "__main__":
+    add_duplicate_of_column()
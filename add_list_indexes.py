@@ -0,0 +1,39 @@
+
+import psycopg2
+import os
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv(os.path.join(os.path.dirname(__file__), '.env'))
+
+DB_HOST = os.getenv('POSTGRES_HOST')
+DB_PORT = os.getenv('POSTGRES_PORT')
+DB_NAME = os.getenv('POSTGRES_DB')
+DB_USER = os.getenv('POSTGRES_USER')
+DB_PASSWORD = os.getenv('POSTGRES_PASSWORD')
+
+def add_list_indexes():
+    conn = psycopg2.connect(
+        host=DB_HOST,
+        port=DB_PORT,
+        dbname=DB_NAME,
+        user=DB_USER,
+        password=DB_PASSWORD
+    )
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction
+    conn.autocommit = True
+    cur = conn.cursor()
+    try:
+        cur.execute("""
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_fnol_work_items_created_at_id
+            ON fnol_work_items (created_at, id);
+        """)
+        print("ix_fnol_work_items_created_at_id index created (if not already present).")
+    except Exception as e:
+        print(f"Error: {e}")
+    finally:
+        cur.close()
+        conn.close()
+
+if __name__ == "__main__":
+    add_list_indexes()
@@ -0,0 +1,55 @@
+import psycopg2
+import os
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv(os.path.join(os.path.dirname(__file__), '.env'))
+
+DB_HOST = os.getenv('POSTGRES_HOST')
+DB_PORT = os.getenv('POSTGRES_PORT')
+DB_NAME = os.getenv('POSTGRES_DB')
+DB_USER = os.getenv('POSTGRES_USER')
+DB_PASSWORD = os.getenv('POSTGRES_PASSWORD')
+
+def add_message_id_unique_index():
+    conn = psycopg2.connect(
+        host=DB_HOST,
+        port=DB_PORT,
+        dbname=DB_NAME,
+        user=DB_USER,
+        password=DB_PASSWORD
+    )
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction
+    conn.autocommit = True
+    cur = conn.cursor()
+    try:
+        # Work items created twice for one email before the index existed
+        # would make it fail; they are listed so they can be merged by hand
+        cur.execute("""
+            SELECT message_id, array_agg(id ORDER BY id)
+            FROM fnol_work_items
+            WHERE message_id IS NOT NULL
+            GROUP BY message_id
+            HAVING count(*) > 1;
+        """)
+        duplicates = cur.fetchall()
+        if duplicates:
+            print(f"{len(duplicates)} message_ids have more than one work item; resolve these first:")
+            for message_id, ids in duplicates:
+                print(f"  {message_id}: workitem ids {ids}")
+            return
+        cur.execute("""
+            CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS uix_fnol_work_items_message_id
+            ON fnol_work_items (message_id) WHERE message_id IS NOT NULL;
+        """)
+        # The unique index serves the message_id lookups the plain one did
+        cur.execute("DROP INDEX CONCURRENTLY IF EXISTS ix_fnol_work_items_message_id;")
+        print("uix_fnol_work_items_message_id index created (if not already present).")
+    except Exception as e:
+        print(f"Error: {e}")
+    finally:
+        cur.close()
+        conn.close()
+
+if __name__ == "__main__":
+    add_message_id_unique_index()
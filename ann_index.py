@@ -0,0 +1,183 @@
+import os
+import sys
+import time
+import logging
+import argparse
+from dotenv import load_dotenv
+
+load_dotenv()
+
+log = logging.getLogger('fnol.retrieval')
+
+# Index used for corpus-wide document search: 'flat' (exact), 'ivfpq' or 'hnsw'
+RETRIEVAL_INDEX_TYPE = os.getenv('RETRIEVAL_INDEX_TYPE', 'flat')
+# IVF lists (0 = about 4 * sqrt(n)) and PQ sub-quantizers (0 = one per 8 dimensions)
+RETRIEVAL_IVF_NLIST = int(os.getenv('RETRIEVAL_IVF_NLIST', '0'))
+RETRIEVAL_PQ_M = int(os.getenv('RETRIEVAL_PQ_M', '0'))
+RETRIEVAL_HNSW_M = int(os.getenv('RETRIEVAL_HNSW_M', '32'))
+RETRIEVAL_HNSW_EF_CONSTRUCTION = int(os.getenv('RETRIEVAL_HNSW_EF_CONSTRUCTION', '200'))
+# Re-rank IVF-PQ candidates against the full vectors: restores most of the
+# recall lost to PQ compression, at the cost of keeping the vectors in the index
+RETRIEVAL_IVF_REFINE = os.getenv('RETRIEVAL_IVF_REFINE', 'true').lower() == 'true'
+# Search-time recall/latency knobs: IVF lists scanned, HNSW candidate list size,
+# and how many candidates per result the IVF-PQ refine step re-ranks
+RETRIEVAL_NPROBE = int(os.getenv('RETRIEVAL_NPROBE', '16'))
+RETRIEVAL_EF_SEARCH = int(os.getenv('RETRIEVAL_EF_SEARCH', '64'))
+RETRIEVAL_REFINE_K_FACTOR = float(os.getenv('RETRIEVAL_REFINE_K_FACTOR', '4'))
+
+INDEX_TYPES = ('flat', 'ivfpq', 'hnsw')
+PQ_NBITS = 8
+# Training points faiss wants per IVF centroid / PQ code; smaller corpora stay flat
+TRAINING_POINTS_PER_CENTROID = 39
+MIN_IVFPQ_VECTORS = TRAINING_POINTS_PER_CENTROID * 2 ** PQ_NBITS
+
+
+def ivf_nlist(n, nlist=RETRIEVAL_IVF_NLIST):
+    if nlist <= 0:
+        nlist = int(4 * n ** 0.5)
+    return max(1, min(nlist, n // TRAINING_POINTS_PER_CENTROID))
+
+
+def pq_m(dim, m=RETRIEVAL_PQ_M):
+    if m <= 0:
+        m = max(1, dim // 8)
+    while dim % m:
+        m -= 1
+    return m
+
+
+def create_index(dim, n, index_type=RETRIEVAL_INDEX_TYPE, nlist=RETRIEVAL_IVF_NLIST, m=RETRIEVAL_PQ_M,
+                 refine=RETRIEVAL_IVF_REFINE, hnsw_m=RETRIEVAL_HNSW_M, ef_construction=RETRIEVAL_HNSW_EF_CONSTRUCTION):
+    """
+    Returns an empty inner-product index of the given type for about n vectors
+    of dimension dim. IVF-PQ indexes still need train() before add().
+    """
+    import faiss
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Unknown index type '{index_type}', expected one of {', '.join(INDEX_TYPES)}")
+    if index_type == 'ivfpq' and n < MIN_IVFPQ_VECTORS:
+        log.warning("Only %d vectors, too few to train IVF-PQ; building a flat index", n, extra={'vectors': n})
+        index_type = 'flat'
+    if index_type == 'flat':
+        return faiss.IndexFlatIP(dim)
+    if index_type == 'hnsw':
+        index = faiss.IndexHNSWFlat(dim, hnsw_m, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = ef_construction
+        return index
+    description = f"IVF{ivf_nlist(n, nlist)},PQ{pq_m(dim, m)}x{PQ_NBITS}"
+    if refine:
+        description += ",RFlat"
+    return faiss.index_factory(dim, description, faiss.METRIC_INNER_PRODUCT)
+
+
+def training_size(index):
+    import faiss
+    try:
+        nlist = faiss.extract_index_ivf(index).nlist
+    except RuntimeError:
+        return 0
+    return max(nlist, 2 ** PQ_NBITS) * TRAINING_POINTS_PER_CENTROID * 2
+
+
+def set_search_params(index, nprobe=RETRIEVAL_NPROBE, ef_search=RETRIEVAL_EF_SEARCH,
+                      k_factor=RETRIEVAL_REFINE_K_FACTOR):
+    """Applies the nprobe (IVF), efSearch (HNSW) and k_factor (refine) settings to a loaded index."""
+    import faiss
+    # downcast_index returns a non-owning view; keep returning the caller's object
+    concrete = faiss.downcast_index(index)
+    if isinstance(concrete, faiss.IndexRefine):
+        concrete.k_factor = k_factor
+    try:
+        faiss.extract_index_ivf(index).nprobe = nprobe
+    except RuntimeError:
+        pass
+    hnsw = getattr(concrete, 'hnsw', None)
+    if hnsw is not None:
+        hnsw.efSearch = ef_search
+    return index
+
+
+def build_index(vectors, index_type=RETRIEVAL_INDEX_TYPE, **params):
+    """Builds, trains and fills an index from an (n, dim) float32 array of normalized vectors."""
+    import numpy as np
+    vectors = np.ascontiguousarray(vectors, dtype='float32')
+    index = create_index(vectors.shape[1], len(vectors), index_type, **params)
+    if not index.is_trained:
+        sample = vectors
+        if len(vectors) > training_size(index):
+            rng = np.random.default_rng(0)
+            sample = vectors[rng.choice(len(vectors), training_size(index), replace=False)]
+        index.train(sample)
+    index.add(vectors)
+    return set_search_params(index)
+
+
+def rebuild(index_path, index_type=RETRIEVAL_INDEX_TYPE):
+    """
+    Rebuilds the corpus-wide document index from every claim shard in the
+    vector store. Next to the index, <index_path>.ids.npy maps each vector to
+    its (workitem_id, chunk position) in the store, so chunk text is read from
+    the shards instead of a pickle. Both files are replaced atomically.
+    """
+    import faiss
+    import numpy as np
+    import vector_store
+    store = vector_store.get_store()
+    shards = []
+    dim = None
+    for workitem_id in store.workitem_ids():
+        vectors = store.vectors(workitem_id)
+        if not len(vectors):
+            continue
+        if dim is None:
+            dim = vectors.shape[1]
+        if vectors.shape[1] != dim:
+            log.warning("Skipping workitem_id=%s: embedding dimension %d != %d", workitem_id, vectors.shape[1], dim,
+                        extra={'workitem_id': workitem_id})
+            continue
+        shards.append((workitem_id, vectors))
+    total = sum(len(vectors) for _, vectors in shards)
+    if not total:
+        log.warning("No indexed claim chunks to build from")
+        return None
+
+    start = time.perf_counter()
+    index = create_index(dim, total, index_type)
+    if not index.is_trained:
+        # Train on an even sample across shards, without loading them all at once
+        fraction = min(1.0, training_size(index) / total)
+        rng = np.random.default_rng(0)
+        sample = np.concatenate([
+            vectors[rng.random(len(vectors)) < fraction] for _, vectors in shards
+        ])
+        index.train(np.ascontiguousarray(sample, dtype='float32'))
+    ids = np.empty((total, 2), dtype='int64')
+    position = 0
+    for workitem_id, vectors in shards:
+        index.add(np.ascontiguousarray(vectors, dtype='float32'))
+        ids[position:position + len(vectors), 0] = workitem_id
+        ids[position:position + len(vectors), 1] = np.arange(len(vectors))
+        position += len(vectors)
+
+    ids_tmp = f"{index_path}.ids.tmp.npy"
+    np.save(ids_tmp, ids)
+    os.replace(ids_tmp, f"{index_path}.ids.npy")
+    index_tmp = f"{index_path}.tmp"
+    faiss.write_index(index, index_tmp)
+    os.replace(index_tmp, index_path)
+    seconds = time.perf_counter() - start
+    log.info("Built %s over %d chunks from %d claims in %.1fs -> %s", type(faiss.downcast_index(index)).__name__,
+             total, len(shards), seconds, index_path, extra={'chunks': total, 'seconds': round(seconds, 3)})
+    return index
+
+
+if __name__ == "__main__":
+    import retrieval
+    import telemetry
+    telemetry.configure_logging()
+    parser = argparse.ArgumentParser(description="Train/rebuild the document index from the per-claim vector store.")
+    parser.add_argument('command', choices=['rebuild'])
+    parser.add_argument('--type', default=RETRIEVAL_INDEX_TYPE, choices=INDEX_TYPES)
+    parser.add_argument('--index-path', default=retrieval.RETRIEVAL_INDEX_PATH)
+    args = parser.parse_args()
+    sys.exit(0 if rebuild(args.index_path, args.type) is not None else 1)
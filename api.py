@@ -1,10 +1,14 @@
 
+import os
+import logging
+import datetime
 import models
 import schemas
 import database
-from fastapi import APIRouter, Depends, HTTPException, UploadFile, File
-from sqlalchemy import func, case
-from sqlalchemy.orm import Session
+import cache
+from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Form, Query, Request, Response
+from sqlalchemy import func, tuple_, or_, and_
+from sqlalchemy.orm import Session, selectinload, defer
 router = APIRouter()
 # Dependency
 def get_db():
@@ -15,240 +19,375 @@ def get_db():
         db.close()
 
 # --- Analytics Endpoints ---
+# Served from the rollup tables maintained by rollups.py, behind a short TTL cache
+analytics_cache = cache.TieredCache(
+    'analytics',
+    max_memory_bytes=1024 * 1024,
+    ttl_seconds=int(os.getenv('FNOL_ANALYTICS_CACHE_SECONDS', '30')),
+    backend='none'
+)
+
+
 @router.get("/analytics/claims-summary")
 def claims_summary(db: Session = Depends(get_db)):
+    cached = analytics_cache.get('claims-summary')
+    if cached is not None:
+        return cached
+    rollup = models.ClaimsDailyRollup
     # Claims by status
-    status_counts = db.query(models.FNOLWorkItem.status, func.count(models.FNOLWorkItem.id)).group_by(models.FNOLWorkItem.status).all()
+    status_counts = db.query(rollup.status, func.sum(rollup.count)).group_by(rollup.status).all()
     # Claims by type (from attachments' doc_type)
-    type_counts = db.query(models.Attachment.doc_type, func.count(models.Attachment.id)).group_by(models.Attachment.doc_type).all()
-    # Average processing time (from created_at to now or to closed/approved)
-    avg_processing_time = db.query(
-        func.avg(
-            case(
-                (
-                    models.FNOLWorkItem.status.in_(["approved", "closed", "completed"]),
-                    func.extract('epoch', func.now() - models.FNOLWorkItem.created_at)
-                ),
-                else_=func.extract('epoch', func.now() - models.FNOLWorkItem.created_at)
-            )
-        )
-    ).scalar()
-    return {
-        "claims_by_status": {status: count for status, count in status_counts},
-        "claims_by_type": {doc_type or "Unknown": count for doc_type, count in type_counts},
-        "average_processing_time_seconds": avg_processing_time or 0
+    type_counts = db.query(models.DocTypeRollup.doc_type, models.DocTypeRollup.count).all()
+    # Average processing time, from created_at to completed_at of approved/closed/completed claims
+    processing_count, processing_seconds = db.query(
+        func.sum(rollup.processing_count), func.sum(rollup.processing_seconds)
+    ).one()
+    summary = {
+        "claims_by_status": {status: int(count) for status, count in status_counts if count},
+        "claims_by_type": {doc_type or "Unknown": count for doc_type, count in type_counts if count},
+        "average_processing_time_seconds": processing_seconds / processing_count if processing_count else 0
     }
+    analytics_cache.set('claims-summary', summary)
+    return summary
 
 @router.get("/analytics/claims-trend")
 def claims_trend(db: Session = Depends(get_db), days: int = 30):
     # Claims per day for the last N days
-    from sqlalchemy import cast, Date
-    import datetime
-    cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=days)
-    trend = db.query(
-        cast(models.FNOLWorkItem.created_at, Date).label('date'),
-        func.count(models.FNOLWorkItem.id)
-    ).filter(models.FNOLWorkItem.created_at >= cutoff)
-    trend = trend.group_by('date').order_by('date').all()
-    return [{"date": str(date), "count": count} for date, count in trend]
+    cache_key = f'claims-trend:{days}'
+    cached = analytics_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    cutoff = (datetime.datetime.utcnow() - datetime.timedelta(days=days)).date()
+    rollup = models.ClaimsDailyRollup
+    trend = db.query(rollup.day, func.sum(rollup.count)).filter(rollup.day >= cutoff)
+    trend = trend.group_by(rollup.day).order_by(rollup.day).all()
+    result = [{"date": str(date), "count": int(count)} for date, count in trend if count]
+    analytics_cache.set(cache_key, result)
+    return result
 import azure_blob
+import export
+import intake
+import jobs
+import batch_ingest
 import llm_client
-from typing import List
+import doc_classifier
+import pipeline
+import retrieval
+import rollups
+import telemetry
+import io
+import json
+import base64
+import tempfile
 import mimetypes
-from azure_doc_intel import extract_text_from_bytes
-
-
-@router.post("/fnol/", response_model=schemas.FNOLWorkItem)
-def create_fnol(item: schemas.FNOLWorkItemCreate, db: Session = Depends(get_db)):
-    print(f"\n=== create_fnol called with message_id: {item.message_id} ===")
-    
-    # Deduplication: check for existing message_id if provided
-    if item.message_id:
-        existing_item = db.query(models.FNOLWorkItem).filter(models.FNOLWorkItem.message_id == item.message_id).first()
-        if existing_item:
-            print(f"Found existing item with id: {existing_item.id}, returning cached result")
-            all_attachments = db.query(models.Attachment).filter(models.Attachment.workitem_id == existing_item.id).all()
-            attachments_out = [
-                schemas.AttachmentOut(
-                    id=a.id,
-                    filename=a.filename,
-                    blob_url=a.blob_url,
-                    doc_type=a.doc_type
-                ) for a in all_attachments
-            ]
-            return schemas.FNOLWorkItem(
-                id=existing_item.id,
-                message_id=existing_item.message_id,
-                email_subject=existing_item.email_subject,
-                email_body=existing_item.email_body,
-                extracted_fields=existing_item.extracted_fields,
-                status=existing_item.status,
-                attachments=attachments_out
-            )
-    else:
-        print("WARNING: No message_id provided - deduplication will not work!")
-
-    # Step 1: Extract text from all attachments
-    import base64
-    extracted_texts = []
-    attachment_data = []
-    seen_filenames = set()
-    
-    if hasattr(item, 'attachments') and item.attachments:
-        for att in item.attachments:
-            filename = att.get('filename') or att.get('name')
-            content = att.get('contentBytes') or att.get('content')
-            
-            # Skip duplicate filenames in the input
-            if filename in seen_filenames:
-                print(f"Skipping duplicate attachment in input: {filename}")
-                continue
-            
-            print(f"Processing attachment: filename={filename}, content_present={bool(content)}")
-            if filename and content:
-                seen_filenames.add(filename)
-                file_bytes = base64.b64decode(content)
-                mime_type, _ = mimetypes.guess_type(filename)
-                extracted_text = None
-                print(f"Guessed MIME type for {filename}: {mime_type}")
-                if mime_type in ['image/png', 'image/jpeg', 'image/jpg', 'application/pdf']:
-                    print("entered into mime type processing")
-                    try:
-                        extracted_text = extract_text_from_bytes(file_bytes, mime_type)
-                    except Exception as e:
-                        print(f"Error extracting text from {filename}: {e}")
-                        extracted_text = None
-                
-                if extracted_text:
-                    extracted_texts.append(extracted_text)
-                
-                attachment_data.append({
-                    'filename': filename,
-                    'file_bytes': file_bytes,
-                    'mime_type': mime_type,
-                    'extracted_text': extracted_text
-                })
-    # print("attachment_data:", attachment_data)
-
-    # Step 2: Pass extracted text to LLM for field extraction
-    combined_attachment_text = '\n\n'.join(extracted_texts) if extracted_texts else ''
-    # print("Combined attachment text:", combined_attachment_text)
-    if item.extracted_fields is not None:
-        extracted_fields = item.extracted_fields
-    else:
-        extracted_fields = llm_client.extract_fields_from_email(
-            item.subject,
-            item.body,
-            combined_attachment_text
-        )
-    
-    # Step 3: Create FNOL work item
-    db_item = models.FNOLWorkItem(
-        message_id=item.message_id,
-        email_subject=item.subject,
-        email_body=item.body,
-        extracted_fields=extracted_fields,
-        tag=extracted_fields['claim_type']['category'] if 'claim_type' in extracted_fields else None
+from typing import List, Optional
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, StreamingResponse
+
+# 'sync' runs the pipeline inside POST /fnol/, 'async' queues it for the worker pool
+FNOL_INTAKE_MODE = os.getenv('FNOL_INTAKE_MODE', 'sync')
+
+log = logging.getLogger('fnol.api')
+
+
+def _workitem_status(db, db_item):
+    job = db.query(models.IntakeJob).filter(models.IntakeJob.workitem_id == db_item.id).order_by(models.IntakeJob.id.desc()).first()
+    if not job:
+        return schemas.FNOLJobStatus(workitem_id=db_item.id, status=db_item.status, created_at=db_item.created_at)
+    return schemas.FNOLJobStatus(
+        workitem_id=db_item.id,
+        status=db_item.status,
+        job_id=job.id,
+        job_status=job.status,
+        attempts=job.attempts,
+        error=job.last_error,
+        created_at=job.created_at,
+        started_at=job.started_at,
+        finished_at=job.finished_at
     )
-    db.add(db_item)
-    db.commit()
-    db.refresh(db_item)
 
-    # Step 4: Store attachments in DB
-    print(f"Storing {len(attachment_data)} attachments for workitem_id={db_item.id}")
-    attachments_added = 0
-    for att_data in attachment_data:
-        filename = att_data['filename']
-        print(f"Checking if attachment '{filename}' already exists for workitem {db_item.id}")
-        existing_attachment = db.query(models.Attachment).filter_by(workitem_id=db_item.id, filename=filename).first()
-        if existing_attachment:
-            print(f"Attachment '{filename}' already exists with id={existing_attachment.id}, skipping")
-            continue
-        
-        fname_lower = filename.lower()
-        text_for_detection = (att_data['extracted_text'] or '') + ' ' + fname_lower
-        from llm_client import guess_doc_type
+
+def _pending_response(db, db_item):
+    """202 with the status of a work item another delivery of the email has not finished."""
+    log.info("Existing item with id: %s is still %s", db_item.id, db_item.status,
+             extra={'workitem_id': db_item.id, 'status': db_item.status})
+    return JSONResponse(status_code=202, content=jsonable_encoder(_workitem_status(db, db_item)))
+
+
+def _existing_response(db, message_id):
+    """
+    Response for an email whose message_id already has a work item, or None
+    when that work item was released in the meantime (claim it again).
+    """
+    existing_item = db.query(models.FNOLWorkItem).filter(models.FNOLWorkItem.message_id == message_id).first()
+    if existing_item is None:
+        return None
+    if existing_item.status in rollups.TRANSIENT_STATUSES:
+        return _pending_response(db, existing_item)
+    log.info("Found existing item with id: %s, returning cached result", existing_item.id,
+             extra={'message_id': message_id, 'workitem_id': existing_item.id})
+    return pipeline.build_workitem_response(db, existing_item)
+
+
+@router.post("/fnol/", response_model=schemas.FNOLWorkItem, responses={202: {"model": schemas.FNOLJobStatus}})
+def create_fnol(item: schemas.FNOLWorkItemCreate, db: Session = Depends(get_db), mode: Optional[str] = None):
+    log.info("create_fnol called with message_id: %s", item.message_id,
+             extra={'message_id': item.message_id, 'attachments': len(item.attachments or [])})
+
+    # Deduplication happens when the work item is claimed (pipeline.claim_workitem, jobs.enqueue)
+    if not item.message_id:
+        log.warning("No message_id provided - deduplication will not work!")
+
+    try:
+        intake.check_base64_attachments(item.attachments)
+    except intake.AttachmentTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+
+    # Async intake: store the raw email, return 202 and let the worker pool run the pipeline
+    if (mode or FNOL_INTAKE_MODE) == 'async':
+        job = None
+        while job is None:
+            try:
+                job = jobs.enqueue(db, item)
+            except jobs.QueueFull:
+                raise HTTPException(status_code=503, detail="FNOL intake queue is full, retry later")
+            if job is None:
+                existing = _existing_response(db, item.message_id)
+                if existing is not None:
+                    return existing
+                # Released after a failed attempt: queue it again
+        status_out = schemas.FNOLJobStatus(
+            workitem_id=job.workitem_id,
+            status='queued',
+            job_id=job.id,
+            job_status=job.status,
+            attempts=job.attempts,
+            created_at=job.created_at
+        )
+        return JSONResponse(status_code=202, content=jsonable_encoder(status_out))
+
+    try:
+        return pipeline.process_fnol(db, item)
+    except pipeline.ClaimPending as e:
+        return _pending_response(db, e.workitem)
+
+
+@router.post("/fnol/batch")
+async def create_fnol_batch(request: Request):
+    """
+    Batch intake for backfills: the body is NDJSON, one POST /fnol/ body per
+    line. It is spooled first, then ingested by batch_ingest while the
+    response streams one NDJSON result per line and a final summary.
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=intake.FNOL_SPOOL_MEMORY_BYTES)
+    async for chunk in request.stream():
+        spool.write(chunk)
+    spool.seek(0)
+    # The body streams after this handler returns; keep its logs under the request's trace id
+    trace_id = telemetry.current_trace_id()
+
+    def results():
+        ingested = batch_ingest.ingest(io.TextIOWrapper(spool, encoding='utf-8'))
         try:
-            doc_type = guess_doc_type(text_for_detection)
-            print(f"LLM guessed document type for '{filename}': {doc_type}")
-        except Exception as e:
-            print(f"Guessing based on the keywords in the document '{filename}': {e}")
-            
-            if 'claim' in text_for_detection:
-                doc_type = 'Claim Form'
-            elif 'police' in text_for_detection:
-                doc_type = 'Police Report'
-            elif 'loss' in text_for_detection:
-                doc_type = 'Proof of Loss'
-            elif 'invoice' in text_for_detection:
-                doc_type = 'Invoice'
-            elif 'declaration' in text_for_detection:
-                doc_type = 'Declaration'
-            elif 'photo' in text_for_detection or 'image' in text_for_detection:
-                doc_type = 'Photo'
-            elif 'id' in text_for_detection or 'identity' in text_for_detection:
-                doc_type = 'ID Document'
-            else:
-                doc_type = 'Other Document'
-        
-        print(f"Uploading attachment '{filename}' to blob storage")
-        blob_url = azure_blob.upload_attachment(filename, att_data['file_bytes'])
-        print(f"Creating attachment record for '{filename}' with doc_type='{doc_type}'")
-        attachment = models.Attachment(
-            workitem_id=db_item.id,
-            filename=filename,
-            blob_url=blob_url,
-            doc_type=doc_type
+            while True:
+                # Each chunk may be produced on a different threadpool thread
+                with telemetry.trace(trace_id):
+                    result = next(ingested, None)
+                if result is None:
+                    break
+                yield json.dumps(result, default=str) + "\n"
+        finally:
+            # Releases the claims of windows not written if the client went away
+            ingested.close()
+            spool.close()
+
+    return StreamingResponse(results(), media_type="application/x-ndjson")
+
+
+def _parse_form_fields(extracted_fields):
+    if not extracted_fields:
+        return None
+    try:
+        parsed = json.loads(extracted_fields)
+    except ValueError:
+        parsed = None
+    if not isinstance(parsed, dict):
+        raise HTTPException(status_code=400, detail="extracted_fields must be a JSON object")
+    return parsed
+
+
+@router.post("/fnol/upload/", response_model=schemas.FNOLWorkItem, responses={202: {"model": schemas.FNOLJobStatus}})
+def create_fnol_multipart(
+    subject: str = Form(...),
+    body: str = Form(...),
+    message_id: Optional[str] = Form(None),
+    extracted_fields: Optional[str] = Form(None),
+    files: List[UploadFile] = File(default=[]),
+    db: Session = Depends(get_db)
+):
+    """
+    Multipart variant of POST /fnol/ for large emails: attachments arrive as
+    file parts instead of base64 JSON. The request size is capped by
+    intake.MultipartSizeLimit while the body streams in; each part is hashed
+    where the form parser spooled it and streamed from there into OCR and
+    blob upload. Runs the pipeline inline.
+    """
+    log.info("create_fnol_multipart called with message_id: %s", message_id,
+             extra={'message_id': message_id, 'attachments': len(files)})
+    if len(files) > intake.FNOL_MAX_ATTACHMENTS:
+        raise HTTPException(status_code=413, detail=f"At most {intake.FNOL_MAX_ATTACHMENTS} attachments are accepted")
+
+    if not message_id:
+        log.warning("No message_id provided - deduplication will not work!")
+
+    spooled = []
+    try:
+        for upload in files:
+            spooled.append(intake.SpooledAttachment.from_upload(upload))
+        item = schemas.FNOLWorkItemCreate(
+            message_id=message_id,
+            subject=subject,
+            body=body,
+            extracted_fields=_parse_form_fields(extracted_fields),
+            attachments=[{'filename': a.filename, 'source': a} for a in spooled]
         )
-        db.add(attachment)
-        attachments_added += 1
-        print(f"Added attachment '{filename}' to session (total added: {attachments_added})")
-    
-    print(f"Committing {attachments_added} attachments to database")
+        return pipeline.process_fnol(db, item)
+    except pipeline.ClaimPending as e:
+        return _pending_response(db, e.workitem)
+    except intake.AttachmentTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    finally:
+        for attachment in spooled:
+            attachment.close()
+
+
+@router.get("/fnol/{fnol_id}/status", response_model=schemas.FNOLJobStatus)
+def get_fnol_status(fnol_id: int, db: Session = Depends(get_db)):
+    db_item = db.query(models.FNOLWorkItem).filter(models.FNOLWorkItem.id == fnol_id).first()
+    if not db_item:
+        raise HTTPException(status_code=404, detail="FNOL work item not found")
+    return _workitem_status(db, db_item)
+
+def _encode_cursor(created_at, item_id):
+    # Work items without created_at (older rows) are keyed on id alone
+    created = created_at.isoformat() if created_at is not None else ''
+    return base64.urlsafe_b64encode(f"{created}|{item_id}".encode()).decode()
+
+
+def _decode_cursor(cursor):
     try:
-        db.commit()
-        print("Attachments committed successfully")
-    except Exception as e:
-        print(f"ERROR committing attachments: {e}")
-        db.rollback()
-        raise
-    
-    # Fetch all attachments for response
-    all_attachments = db.query(models.Attachment).filter(models.Attachment.workitem_id == db_item.id).all()
-    attachments_out = [
-        schemas.AttachmentOut(
-            id=a.id,
-            filename=a.filename,
-            blob_url=a.blob_url,
-            doc_type=a.doc_type
-        ) for a in all_attachments
-    ]
-    
-    return schemas.FNOLWorkItem(
-        id=db_item.id,
-        message_id=db_item.message_id,
-        email_subject=db_item.email_subject,
-        email_body=db_item.email_body,
-        extracted_fields=db_item.extracted_fields,
-        status=db_item.status,
-        attachments=attachments_out
-    )
+        created_at, item_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return (datetime.datetime.fromisoformat(created_at) if created_at else None), int(item_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
 
-@router.get("/fnol/", response_model=List[schemas.FNOLWorkItem])
-def list_fnols(db: Session = Depends(get_db)):
-    items = db.query(models.FNOLWorkItem).all()
+@router.get("/fnol/", response_model=List[schemas.FNOLWorkItemListEntry], response_model_exclude_unset=True)
+def list_fnols(
+    response: Response,
+    db: Session = Depends(get_db),
+    limit: int = Query(100, ge=1, le=500),
+    cursor: Optional[str] = None,
+    status: Optional[str] = None,
+    tag: Optional[str] = None,
+    created_from: Optional[datetime.datetime] = None,
+    created_to: Optional[datetime.datetime] = None,
+    include_content: bool = True
+):
+    """
+    Newest-first page of work items, keyset-paginated on (created_at, id);
+    older rows without created_at come first.
+    Pass the X-Next-Cursor response header back as `cursor` for the next page.
+    include_content=false leaves out email_body and extracted_fields. Work
+    items still 'queued' or 'processing' are listed only when asked for with
+    `status`.
+    """
+    query = db.query(models.FNOLWorkItem).options(selectinload(models.FNOLWorkItem.attachments))
+    if not include_content:
+        query = query.options(defer(models.FNOLWorkItem.email_body), defer(models.FNOLWorkItem.extracted_fields))
+    if status:
+        query = query.filter(models.FNOLWorkItem.status == status)
+    else:
+        query = query.filter(or_(models.FNOLWorkItem.status.is_(None),
+                                 models.FNOLWorkItem.status.notin_(rollups.TRANSIENT_STATUSES)))
+    if tag:
+        query = query.filter(models.FNOLWorkItem.tag == tag)
+    if created_from:
+        query = query.filter(models.FNOLWorkItem.created_at >= created_from)
+    if created_to:
+        query = query.filter(models.FNOLWorkItem.created_at < created_to)
+    if cursor:
+        cursor_created_at, cursor_id = _decode_cursor(cursor)
+        if cursor_created_at is None:
+            # Work items without created_at come first; the rest of them, then all dated ones
+            query = query.filter(or_(
+                and_(models.FNOLWorkItem.created_at.is_(None), models.FNOLWorkItem.id < cursor_id),
+                models.FNOLWorkItem.created_at.isnot(None)
+            ))
+        else:
+            query = query.filter(
+                tuple_(models.FNOLWorkItem.created_at, models.FNOLWorkItem.id) < tuple_(cursor_created_at, cursor_id)
+            )
+    order = (models.FNOLWorkItem.created_at.desc().nulls_first(), models.FNOLWorkItem.id.desc())
+    items = query.order_by(*order).limit(limit).all()
+
+    if len(items) == limit:
+        response.headers["X-Next-Cursor"] = _encode_cursor(items[-1].created_at, items[-1].id)
+
+    entries = []
     for item in items:
-        attachments = db.query(models.Attachment).filter(models.Attachment.workitem_id == item.id).all()
-        item.attachments = attachments
-    return items
+        content = {}
+        if include_content:
+            content = {"email_body": item.email_body, "extracted_fields": item.extracted_fields}
+        entries.append(schemas.FNOLWorkItemListEntry(
+            id=item.id,
+            message_id=item.message_id,
+            tag=item.tag,
+            email_subject=item.email_subject,
+            status=item.status,
+            created_at=item.created_at,
+            attachments=[schemas.AttachmentOut.model_validate(a) for a in item.attachments],
+            **content
+        ))
+    return entries
+
+@router.get("/fnol/export")
+def export_fnols(
+    format: str = Query("ndjson", pattern="^(ndjson|csv)$"),
+    since: Optional[datetime.datetime] = None,
+    after_id: Optional[int] = None,
+    status: Optional[str] = None,
+    flatten: bool = False,
+    include_body: bool = False
+):
+    """
+    Streams all work items (optionally only those created since `since` or
+    with id > after_id) as NDJSON or CSV, one row at a time. Work items still
+    'queued' or 'processing' are only included when asked for with `status`.
+    flatten=true spreads extracted_fields into dotted columns.
+    """
+    rows = export.iter_workitems(since=since, after_id=after_id, status=status, include_body=include_body)
+    if format == 'csv':
+        return StreamingResponse(
+            export.csv_lines(rows, flatten=flatten, include_body=include_body),
+            media_type="text/csv",
+            headers={"Content-Disposition": "attachment; filename=fnol_export.csv"}
+        )
+    return StreamingResponse(export.ndjson_lines(rows, flatten=flatten), media_type="application/x-ndjson")
+
 
 @router.post("/attachments/")
 def upload_attachments(workitem_id: int, file: UploadFile = File(...), db: Session = Depends(get_db)):
-    blob_url = azure_blob.upload_attachment(file.filename, file.file)
+    content_hash, size = azure_blob.content_digest(file.file)
+    mime_type = mimetypes.guess_type(file.filename)[0] or file.content_type
+    blob_url = azure_blob.upload_attachment(file.filename, file.file, mime_type=mime_type,
+                                            content_hash=content_hash, size=size)
     attachment = models.Attachment(
         workitem_id=workitem_id,
         filename=file.filename,
-        blob_url=blob_url
+        blob_url=blob_url,
+        mime_type=mime_type,
+        file_size=size
     )
     db.add(attachment)
     db.commit()
@@ -269,3 +408,71 @@ def update_fnol(fnol_id: int, item: schemas.FNOLWorkItemUpdate, db: Session = De
     db.commit()
     db.refresh(db_item)
     return db_item
+
+
+def _answer_question(question, workitem_id=None):
+    try:
+        results = retrieval.get_service().search(question.question, k=question.k, workitem_id=workitem_id)
+    except (retrieval.IndexNotFound, ImportError) as e:
+        raise HTTPException(status_code=503, detail=f"Document retrieval is unavailable: {e}")
+    chunks = [schemas.RetrievedChunk(score=score, text=text) for score, text in results]
+    if not chunks:
+        return schemas.DocumentAnswer(answer="No relevant information found in the document.")
+    context = "\n\n".join(chunk.text for chunk in chunks)
+    try:
+        answer = llm_client.answer_from_context(context, question.question)
+    except Exception as e:
+        raise HTTPException(status_code=502, detail=f"Answer generation failed: {e}")
+    return schemas.DocumentAnswer(answer=answer, chunks=chunks)
+
+
+# Ask a question about the indexed claim documents
+@router.post("/documents/ask", response_model=schemas.DocumentAnswer)
+def ask_documents(question: schemas.DocumentQuestion):
+    return _answer_question(question)
+
+
+# Ask a question about one claim's attachments (per-claim vector index)
+@router.post("/fnol/{fnol_id}/ask", response_model=schemas.DocumentAnswer)
+def ask_fnol_documents(fnol_id: int, question: schemas.DocumentQuestion, db: Session = Depends(get_db)):
+    if db.get(models.FNOLWorkItem, fnol_id) is None:
+        raise HTTPException(status_code=404, detail="FNOL work item not found")
+    pipeline.release_connection(db)
+    return _answer_question(question, workitem_id=fnol_id)
+
+
+@router.get("/metrics")
+def prometheus_metrics():
+    """Prometheus exposition: stage, request and attachment size histograms plus the /metrics/* counters."""
+    body, content_type = telemetry.render_metrics()
+    return Response(content=body, media_type=content_type)
+
+
+@router.get("/metrics/cache")
+def cache_metrics():
+    return cache.stats()
+
+
+@router.get("/metrics/db")
+def db_metrics():
+    return database.pool_stats()
+
+
+@router.get("/metrics/llm")
+def llm_metrics():
+    return llm_client.stats()
+
+
+@router.get("/metrics/blob")
+def blob_metrics():
+    return azure_blob.stats()
+
+
+@router.get("/metrics/classifier")
+def classifier_metrics():
+    return doc_classifier.stats()
+
+
+@router.get("/metrics/retrieval")
+def retrieval_metrics():
+    return retrieval.get_service().stats()
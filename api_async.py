@@ -0,0 +1,135 @@
+
+import logging
+import models
+import schemas
+import database
+import intake
+import jobs
+import pipeline
+import providers
+import rollups
+import api
+from typing import Optional
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from sqlalchemy import select
+from starlette.concurrency import run_in_threadpool
+
+# Async variants of the FNOL intake routes, mounted in place of the sync ones
+# when FNOL_API_MODE=async. Every downstream call (Postgres, Document
+# Intelligence, Blob Storage, Gemini) is awaited instead of blocking a thread.
+router = APIRouter()
+log = logging.getLogger('fnol.api')
+
+
+async def get_async_db():
+    async with database.get_async_sessionmaker()() as db:
+        yield db
+
+
+def _enqueue(item):
+    db = database.SessionLocal()
+    try:
+        job = jobs.enqueue(db, item)
+        if job is None:
+            return None
+        return schemas.FNOLJobStatus(
+            workitem_id=job.workitem_id,
+            status='queued',
+            job_id=job.id,
+            job_status=job.status,
+            attempts=job.attempts,
+            created_at=job.created_at
+        )
+    finally:
+        db.close()
+
+
+async def _workitem_status(db, db_item):
+    result = await db.execute(
+        select(models.IntakeJob).where(models.IntakeJob.workitem_id == db_item.id).order_by(models.IntakeJob.id.desc()).limit(1)
+    )
+    job = result.scalars().first()
+    if not job:
+        return schemas.FNOLJobStatus(workitem_id=db_item.id, status=db_item.status, created_at=db_item.created_at)
+    return schemas.FNOLJobStatus(
+        workitem_id=db_item.id,
+        status=db_item.status,
+        job_id=job.id,
+        job_status=job.status,
+        attempts=job.attempts,
+        error=job.last_error,
+        created_at=job.created_at,
+        started_at=job.started_at,
+        finished_at=job.finished_at
+    )
+
+
+async def _pending_response(db, db_item):
+    log.info("Existing item with id: %s is still %s", db_item.id, db_item.status,
+             extra={'workitem_id': db_item.id, 'status': db_item.status})
+    return JSONResponse(status_code=202, content=jsonable_encoder(await _workitem_status(db, db_item)))
+
+
+async def _existing_response(db, message_id):
+    """api._existing_response for an AsyncSession."""
+    result = await db.execute(
+        select(models.FNOLWorkItem).where(models.FNOLWorkItem.message_id == message_id).limit(1)
+        .execution_options(populate_existing=True)
+    )
+    existing_item = result.scalars().first()
+    if existing_item is None:
+        return None
+    if existing_item.status in rollups.TRANSIENT_STATUSES:
+        return await _pending_response(db, existing_item)
+    log.info("Found existing item with id: %s, returning cached result", existing_item.id,
+             extra={'message_id': message_id, 'workitem_id': existing_item.id})
+    return await pipeline.build_workitem_response_async(db, existing_item)
+
+
+@router.post("/fnol/", response_model=schemas.FNOLWorkItem, responses={202: {"model": schemas.FNOLJobStatus}})
+async def create_fnol(item: schemas.FNOLWorkItemCreate, db=Depends(get_async_db), mode: Optional[str] = None):
+    log.info("create_fnol (async) called with message_id: %s", item.message_id,
+             extra={'message_id': item.message_id, 'attachments': len(item.attachments or [])})
+
+    # Deduplication happens when the work item is claimed (pipeline.claim_workitem_async, jobs.enqueue)
+    if not item.message_id:
+        log.warning("No message_id provided - deduplication will not work!")
+
+    try:
+        intake.check_base64_attachments(item.attachments)
+    except intake.AttachmentTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+
+    if (mode or api.FNOL_INTAKE_MODE) == 'async':
+        status_out = None
+        while status_out is None:
+            try:
+                status_out = await run_in_threadpool(_enqueue, item)
+            except jobs.QueueFull:
+                raise HTTPException(status_code=503, detail="FNOL intake queue is full, retry later")
+            if status_out is None:
+                existing = await _existing_response(db, item.message_id)
+                if existing is not None:
+                    return existing
+                # Released after a failed attempt: queue it again
+        return JSONResponse(status_code=202, content=jsonable_encoder(status_out))
+
+    try:
+        return await pipeline.process_fnol_async(db, item)
+    except pipeline.ClaimPending as e:
+        return await _pending_response(db, e.workitem)
+
+
+@router.get("/fnol/{fnol_id}/status", response_model=schemas.FNOLJobStatus)
+async def get_fnol_status(fnol_id: int, db=Depends(get_async_db)):
+    db_item = await db.get(models.FNOLWorkItem, fnol_id)
+    if not db_item:
+        raise HTTPException(status_code=404, detail="FNOL work item not found")
+    return await _workitem_status(db, db_item)
+
+
+async def close_clients():
+    # Closes the async engine and the async blob, OCR and Gemini clients (the providers with a close hook)
+    await providers.close_all()
@@ -1,8 +1,29 @@
 
-from fastapi import FastAPI
+import os
+import time
+import logging
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
 import api
+import cache
+import intake
+import jobs
+import pipeline
+import providers
+import rollups
+import retrieval
+import telemetry
 
+# 'sync' serves every route from api.py; 'async' replaces the FNOL intake
+# routes with the fully async ones from api_async.py
+FNOL_API_MODE = os.getenv('FNOL_API_MODE', 'sync')
+# Load the embedding model and document index at startup instead of on the first question
+RETRIEVAL_PRELOAD = os.getenv('RETRIEVAL_PRELOAD', 'false').lower() == 'true'
+# Clients built at startup (in each worker, after any fork) instead of on the first request
+FNOL_WARM_UP = [name for name in os.getenv('FNOL_WARM_UP', 'postgres,blob,ocr,gemini').split(',') if name]
+
+telemetry.configure_logging()
+log = logging.getLogger('fnol.app')
 
 app = FastAPI()
 
@@ -14,9 +35,71 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# Caps multipart bodies before and while they are parsed
+app.add_middleware(intake.MultipartSizeLimit)
 
+if FNOL_API_MODE == 'async':
+    import api_async
+    overridden = {(route.path, method) for route in api_async.router.routes for method in route.methods}
+    api.router.routes = [
+        route for route in api.router.routes
+        if not any((route.path, method) in overridden for method in route.methods)
+    ]
+    app.include_router(api_async.router)
 app.include_router(api.router)
 
+
+@app.middleware("http")
+async def trace_requests(request: Request, call_next):
+    # One trace id per request (the caller's X-Request-ID when given), carried
+    # into the pipeline's stage threads and echoed on the response
+    trace_id = request.headers.get(telemetry.TRACE_HEADER) or telemetry.new_trace_id()
+    with telemetry.trace(trace_id):
+        start = time.perf_counter()
+        status = 500
+        try:
+            response = await call_next(request)
+            status = response.status_code
+        finally:
+            route = request.scope.get('route')
+            telemetry.observe_request(request.method, route.path if route else 'unmatched', status,
+                                      time.perf_counter() - start)
+    response.headers[telemetry.TRACE_HEADER] = trace_id
+    return response
+
+
+@app.on_event("startup")
+def start_intake_workers():
+    # Set FNOL_WORKER_CONCURRENCY=0 to run an API-only instance
+    if jobs.FNOL_WORKER_CONCURRENCY > 0:
+        jobs.start_workers()
+    rollups.start_refresh_thread()
+    if FNOL_WARM_UP:
+        names = list(FNOL_WARM_UP)
+        if FNOL_API_MODE == 'async':
+            # The async routes use their own engine and blob, OCR and Gemini clients
+            names += [f'{name}_async' for name in FNOL_WARM_UP]
+        log.info("Warmed up clients (seconds): %s", providers.warm_up(names))
+    if RETRIEVAL_PRELOAD:
+        try:
+            retrieval.get_service().warm_up()
+        except Exception as e:
+            log.warning("Document retrieval warm-up failed: %s", e, extra={'error': str(e)})
+
+
+@app.on_event("shutdown")
+async def stop_intake_workers():
+    jobs.stop_workers()
+    rollups.stop_refresh_thread()
+    rollups.stop_flush_thread()
+    cache.stop_purge_thread()
+    retrieval.close_service()
+    pipeline.shutdown_executors()
+    pipeline.stop_heartbeat_thread()
+    if FNOL_API_MODE == 'async':
+        await api_async.close_clients()
+
+
 @app.get("/")
 def root():
     return {"message": "FNOL Backend API"}
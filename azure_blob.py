@@ -1,16 +1,169 @@
 import os
-from azure.storage.blob import BlobServiceClient
+import hashlib
+import mimetypes
+import threading
 from dotenv import load_dotenv
 
+import providers
+
 load_dotenv()
 
 AZURE_STORAGE_CONNECTION_STRING = os.getenv('AZURE_STORAGE_CONNECTION_STRING')
 AZURE_STORAGE_CONTAINER = os.getenv('AZURE_STORAGE_CONTAINER')
+# Blobs are named by the SHA-256 of their content under this prefix, so two
+# claims' 'claim.pdf' never overwrite each other and identical files are stored once
+AZURE_BLOB_PREFIX = os.getenv('AZURE_BLOB_PREFIX', 'sha256')
+# Files above the single-put size go up as blocks of AZURE_BLOB_BLOCK_SIZE
+# bytes, AZURE_BLOB_MAX_CONCURRENCY at a time
+AZURE_BLOB_MAX_CONCURRENCY = int(os.getenv('AZURE_BLOB_MAX_CONCURRENCY', '4'))
+AZURE_BLOB_BLOCK_SIZE = int(os.getenv('AZURE_BLOB_BLOCK_SIZE', str(4 * 1024 * 1024)))
+AZURE_BLOB_SINGLE_PUT_SIZE = int(os.getenv('AZURE_BLOB_SINGLE_PUT_SIZE', str(8 * 1024 * 1024)))
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+_stats_lock = threading.Lock()
+_stats = {
+    'uploads': 0,
+    'uploaded_bytes': 0,
+    'deduplicated': 0,
+    'deduplicated_bytes': 0,
+}
+
+
+def _record(**deltas):
+    with _stats_lock:
+        for name, delta in deltas.items():
+            _stats[name] += delta
+
+
+def stats():
+    """Blobs uploaded and re-uploads skipped because the content was already stored."""
+    with _stats_lock:
+        return dict(_stats)
+
+
+def _settings():
+    if not AZURE_STORAGE_CONNECTION_STRING or not AZURE_STORAGE_CONTAINER:
+        raise RuntimeError("AZURE_STORAGE_CONNECTION_STRING and AZURE_STORAGE_CONTAINER must be set")
+    return AZURE_STORAGE_CONNECTION_STRING, AZURE_STORAGE_CONTAINER
+
+
+def _client_options():
+    return {'max_block_size': AZURE_BLOB_BLOCK_SIZE, 'max_single_put_size': AZURE_BLOB_SINGLE_PUT_SIZE}
+
+
+def _make_container_client():
+    # The SDK is imported here so importing this module stays cheap
+    from azure.storage.blob import BlobServiceClient
+    connection_string, container_name = _settings()
+    service_client = BlobServiceClient.from_connection_string(connection_string, **_client_options())
+    return service_client.get_container_client(container_name)
+
+
+container_provider = providers.ClientProvider('blob', _make_container_client)
+
+
+def get_container_client():
+    return container_provider.get()
+
+
+def content_digest(data):
+    """(hex SHA-256, size) of bytes or of a seekable binary stream, which is rewound afterwards."""
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        return hashlib.sha256(data).hexdigest(), len(data)
+    digest = hashlib.sha256()
+    size = 0
+    start = data.tell()
+    while True:
+        chunk = data.read(HASH_CHUNK_SIZE)
+        if not chunk:
+            break
+        digest.update(chunk)
+        size += len(chunk)
+    data.seek(start)
+    return digest.hexdigest(), size
+
+
+def blob_name(content_hash, file_name):
+    # Keep the extension so the blob's URL still says what kind of file it is
+    extension = os.path.splitext(file_name or '')[1].lower()
+    return f"{AZURE_BLOB_PREFIX}/{content_hash}{extension}"
+
+
+def content_hash_from_url(blob_url):
+    """The content hash in a blob URL built by blob_name, or None for other names."""
+    stem = os.path.splitext(blob_url.split('?', 1)[0].rsplit('/', 1)[-1])[0]
+    if len(stem) == 64 and all(c in '0123456789abcdef' for c in stem):
+        return stem
+    return None
+
+
+def _upload_options(file_name, mime_type, size):
+    from azure.storage.blob import ContentSettings
+    return {
+        'overwrite': False,
+        'length': size,
+        'max_concurrency': AZURE_BLOB_MAX_CONCURRENCY,
+        'content_settings': ContentSettings(content_type=mime_type or mimetypes.guess_type(file_name)[0]),
+    }
+
+
+def upload_attachment(file_name, data, mime_type=None, content_hash=None, size=None):
+    """
+    Stores an attachment (bytes or a binary stream) under its content hash
+    and returns the blob URL. Content that is already stored is not sent
+    again; two concurrent uploads of the same new content both succeed.
+    Pass content_hash (and size) when already known to skip hashing a stream.
+    """
+    from azure.core.exceptions import ResourceExistsError
+    if content_hash is None:
+        content_hash, size = content_digest(data)
+    elif size is None and isinstance(data, (bytes, bytearray, memoryview)):
+        size = len(data)
+    blob_client = get_container_client().get_blob_client(blob_name(content_hash, file_name))
+    if blob_client.exists():
+        _record(deduplicated=1, deduplicated_bytes=size or 0)
+        return blob_client.url
+    try:
+        blob_client.upload_blob(data, **_upload_options(file_name, mime_type, size))
+        _record(uploads=1, uploaded_bytes=size or 0)
+    except ResourceExistsError:
+        # Another request stored the same content in the meantime
+        _record(deduplicated=1, deduplicated_bytes=size or 0)
+    return blob_client.url
+
+
+def _make_async_container_client():
+    from azure.storage.blob.aio import BlobServiceClient as AsyncBlobServiceClient
+    connection_string, container_name = _settings()
+    async_service_client = AsyncBlobServiceClient.from_connection_string(connection_string, **_client_options())
+    return async_service_client.get_container_client(container_name)
+
+
+# Its connections belong to the event loop that opened them, so a forked
+# worker always builds its own
+async_container_provider = providers.ClientProvider('blob_async', _make_async_container_client,
+                                                    close=lambda client: client.close())
+
+
+def get_async_container_client():
+    return async_container_provider.get()
 
-blob_service_client = BlobServiceClient.from_connection_string(AZURE_STORAGE_CONNECTION_STRING)
-container_client = blob_service_client.get_container_client(AZURE_STORAGE_CONTAINER)
 
-def upload_attachment(file_name, data):
-    blob_client = container_client.get_blob_client(file_name)
-    blob_client.upload_blob(data, overwrite=True)
+async def upload_attachment_async(file_name, data, mime_type=None, content_hash=None, size=None):
+    """upload_attachment for bytes, on the async client."""
+    from azure.core.exceptions import ResourceExistsError
+    if content_hash is None:
+        content_hash, size = content_digest(data)
+    elif size is None:
+        size = len(data)
+    blob_client = get_async_container_client().get_blob_client(blob_name(content_hash, file_name))
+    if await blob_client.exists():
+        _record(deduplicated=1, deduplicated_bytes=size)
+        return blob_client.url
+    try:
+        await blob_client.upload_blob(data, **_upload_options(file_name, mime_type, size))
+        _record(uploads=1, uploaded_bytes=size)
+    except ResourceExistsError:
+        _record(deduplicated=1, deduplicated_bytes=size)
     return blob_client.url
@@ -1,26 +1,109 @@
 import os
-from azure.ai.documentintelligence import DocumentIntelligenceClient
-from azure.core.credentials import AzureKeyCredential
+import asyncio
+import hashlib
+import logging
 from dotenv import load_dotenv
 
+import cache
+import providers
+
 load_dotenv()
 
+log = logging.getLogger('fnol.ocr')
+
 endpoint = os.getenv('AZURE_DOC_INTELLIGENCE_ENDPOINT')
 key = os.getenv('AZURE_DOC_INTELLIGENCE_KEY')
+MODEL_ID = os.getenv('AZURE_DOC_INTELLIGENCE_MODEL', 'prebuilt-read')
+
+
+def _credentials():
+    if not endpoint or not key:
+        raise RuntimeError("AZURE_DOC_INTELLIGENCE_ENDPOINT and AZURE_DOC_INTELLIGENCE_KEY must be set")
+    from azure.core.credentials import AzureKeyCredential
+    return endpoint, AzureKeyCredential(key)
+
+
+def _make_client():
+    # The SDK is imported here so importing this module stays cheap
+    from azure.ai.documentintelligence import DocumentIntelligenceClient
+    return DocumentIntelligenceClient(*_credentials())
+
+
+client_provider = providers.ClientProvider('ocr', _make_client)
 
-client = DocumentIntelligenceClient(endpoint, AzureKeyCredential(key))
 
-def extract_text_from_bytes(file_bytes, mime_type):
+def get_client():
+    return client_provider.get()
+
+
+# OCR results keyed by SHA-256 of the file content + MIME type + model id, so a
+# document forwarded again in a later email skips Document Intelligence.
+ocr_cache = cache.TieredCache(
+    'ocr',
+    max_memory_bytes=int(os.getenv('OCR_CACHE_MEMORY_BYTES', str(64 * 1024 * 1024))),
+    ttl_seconds=int(os.getenv('OCR_CACHE_TTL_SECONDS', str(30 * 24 * 3600))),
+    max_persistent_entries=int(os.getenv('OCR_CACHE_MAX_ENTRIES', '200000')),
+)
+
+
+def ocr_cache_key(content_hash, mime_type, model_id=MODEL_ID):
+    return cache.hash_key(content_hash, mime_type or '', model_id)
+
+
+def extract_text_from_bytes(file_bytes, mime_type, content_hash=None):
+    """
+    OCRs a document given as bytes or a binary stream. Pass content_hash (hex
+    SHA-256 of the content) for streams; for bytes it is computed here.
+    """
+    cache_key = ocr_cache_key(content_hash or hashlib.sha256(file_bytes).hexdigest(), mime_type)
+    cached = ocr_cache.get(cache_key)
+    if cached is not None:
+        return cached
     try:
-        poller = client.begin_analyze_document(
-            model_id="prebuilt-read",
+        poller = get_client().begin_analyze_document(
+            model_id=MODEL_ID,
             body=file_bytes,
             content_type=mime_type
         )
         result = poller.result()
         # text = "\n".join([page.content for page in result.pages])
         # return text
+        if result.content is not None:
+            ocr_cache.set(cache_key, result.content)
+        return result.content
+    except Exception as e:
+        log.warning("Error extracting text: %s", e, extra={'mime_type': mime_type})
+        return None
+
+
+def _make_async_client():
+    from azure.ai.documentintelligence.aio import DocumentIntelligenceClient as AsyncDocumentIntelligenceClient
+    return AsyncDocumentIntelligenceClient(*_credentials())
+
+
+# Bound to the event loop that opened its connections; a forked worker builds its own
+async_client_provider = providers.ClientProvider('ocr_async', _make_async_client, close=lambda client: client.close())
+
+
+def get_async_client():
+    return async_client_provider.get()
+
+
+async def extract_text_from_bytes_async(file_bytes, mime_type, content_hash=None):
+    cache_key = ocr_cache_key(content_hash or hashlib.sha256(file_bytes).hexdigest(), mime_type)
+    cached = await asyncio.to_thread(ocr_cache.get, cache_key)
+    if cached is not None:
+        return cached
+    try:
+        poller = await get_async_client().begin_analyze_document(
+            model_id=MODEL_ID,
+            body=file_bytes,
+            content_type=mime_type
+        )
+        result = await poller.result()
+        if result.content is not None:
+            await asyncio.to_thread(ocr_cache.set, cache_key, result.content)
         return result.content
     except Exception as e:
-        print(f"Error extracting text: {str(e)}")
+        log.warning("Error extracting text: %s", e, extra={'mime_type': mime_type})
         return None
@@ -0,0 +1,359 @@
+import os
+import sys
+import json
+import time
+import argparse
+import logging
+from dotenv import load_dotenv
+from pydantic import ValidationError
+
+import models
+import schemas
+import intake
+import near_dup
+import pipeline
+import telemetry
+
+load_dotenv()
+
+log = logging.getLogger('fnol.batch')
+
+# Emails processed at once in a batch; OCR, LLM and upload calls are still
+# capped by the per-stage limits in pipeline.STAGE_CONCURRENCY
+FNOL_BATCH_CONCURRENCY = int(os.getenv('FNOL_BATCH_CONCURRENCY', '8'))
+# Emails per window: one message_id claim and one write transaction each
+FNOL_BATCH_SIZE = int(os.getenv('FNOL_BATCH_SIZE', '100'))
+
+
+def _parse_lines(lines):
+    """Yields (line_number, FNOLWorkItemCreate or error message) for the non-blank NDJSON lines."""
+    for line_number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            item = schemas.FNOLWorkItemCreate.model_validate_json(line)
+            intake.check_base64_attachments(item.attachments)
+        except ValidationError as e:
+            yield line_number, '; '.join(f"{'.'.join(map(str, error['loc'])) or 'line'}: {error['msg']}" for error in e.errors())
+            continue
+        except intake.AttachmentTooLarge as e:
+            yield line_number, str(e)
+            continue
+        yield line_number, item
+
+
+def _windows(entries, size):
+    window = []
+    for entry in entries:
+        window.append(entry)
+        if len(window) >= size:
+            yield window
+            window = []
+    if window:
+        yield window
+
+
+def _result(line_number, item, status, workitem_id=None, **extra):
+    result = {'line': line_number, 'message_id': getattr(item, 'message_id', None), 'status': status}
+    if workitem_id is not None:
+        result['workitem_id'] = workitem_id
+    result.update(extra)
+    return result
+
+
+def _run_stages(item):
+    start = time.perf_counter()
+    new_attachments, extracted_fields = pipeline.run_stages(item)
+    return new_attachments, extracted_fields, time.perf_counter() - start
+
+
+class _Window:
+    def __init__(self):
+        self.results = []  # finished without running the pipeline
+        # (line_number, item, sig, claimed workitem id or None, near-duplicate original id or None,
+        #  future of the pipeline run, or None for a duplicate linked without it)
+        self.pending = []
+
+
+class BatchIngest:
+    """
+    Ingests a stream of FNOL emails (NDJSON lines shaped like the POST /fnol/
+    body), e.g. a mailbox backfill. The stream is read in windows of
+    batch_size emails. Each window claims the work items of its emails'
+    message_ids with one INSERT ... ON CONFLICT (pipeline.claim_rows), so
+    emails already in the database (or being processed by another request)
+    are skipped. Its emails run through the pipeline stages `concurrency` at
+    a time, and its work items, attachments and signatures are written in
+    one transaction, or one savepoint per email if that fails. Claims of
+    emails that fail, or that are never written because iteration stopped
+    early, are released.
+    While a window is written, the next one is already running.
+
+    Iterating yields one result dict per line, then a summary.
+    """
+
+    def __init__(self, session_factory, concurrency=FNOL_BATCH_CONCURRENCY, batch_size=FNOL_BATCH_SIZE):
+        self.session_factory = session_factory
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.seen_message_ids = set()
+        self.counts = {}
+
+    def _count(self, result):
+        self.counts[result['status']] = self.counts.get(result['status'], 0) + 1
+        return result
+
+    def _existing_ids(self, db, message_ids):
+        if not message_ids:
+            return {}
+        rows = (
+            db.query(models.FNOLWorkItem.message_id, models.FNOLWorkItem.id)
+            .filter(models.FNOLWorkItem.message_id.in_(message_ids))
+            .all()
+        )
+        return dict(rows)
+
+    def _submit(self, executor, entries):
+        window = _Window()
+        items = []
+        for line_number, item in entries:
+            if isinstance(item, str):
+                window.results.append(_result(line_number, None, 'invalid', error=item))
+                continue
+            if item.message_id:
+                if item.message_id in self.seen_message_ids:
+                    window.results.append(_result(line_number, item, 'duplicate_in_batch'))
+                    continue
+                self.seen_message_ids.add(item.message_id)
+            else:
+                log.warning("No message_id on line %d - deduplication will not work!", line_number,
+                            extra={'line': line_number})
+            items.append((line_number, item))
+
+        db = self.session_factory()
+        try:
+            with_ids = [item for _, item in items if item.message_id]
+            claimed = pipeline.claim_rows(db, with_ids) if with_ids else {}
+            db.commit()
+            existing = self._existing_ids(db, [item.message_id for item in with_ids if item.message_id not in claimed])
+            released = []
+            for line_number, item in items:
+                if item.message_id in existing:
+                    window.results.append(_result(line_number, item, 'exists', existing[item.message_id]))
+                    continue
+                workitem_id = claimed.get(item.message_id)
+                attachment_hashes = near_dup.attachment_fingerprints(item)
+                sig = near_dup.item_signature(item, attachment_hashes)
+                match = pipeline._find_near_duplicate(db, sig)
+                original_id = match[0] if match is not None else None
+                if match is not None and pipeline._can_skip_pipeline(
+                        attachment_hashes, db.execute(pipeline._blob_urls_query(original_id)).scalars()):
+                    if near_dup.FNOL_NEAR_DUP_MODE == 'reuse':
+                        if workitem_id is not None:
+                            released.append(workitem_id)
+                        window.results.append(_result(line_number, item, 'exists', original_id))
+                    else:
+                        window.pending.append((line_number, item, sig, workitem_id, original_id, None))
+                else:
+                    window.pending.append((line_number, item, sig, workitem_id, original_id,
+                                           executor.submit(_run_stages, item)))
+            if released:
+                pipeline.release_claims(db, released)
+        finally:
+            db.close()
+        return window
+
+    def _release(self, workitem_ids):
+        if not workitem_ids:
+            return
+        db = self.session_factory()
+        try:
+            pipeline.release_claims(db, workitem_ids)
+        except Exception:
+            log.exception("Releasing claimed work items %s failed", workitem_ids, extra={'workitem_ids': workitem_ids})
+        finally:
+            db.close()
+
+    def _store(self, db, done):
+        """Adds the work items, attachments and signatures of finished entries to db; returns their ids."""
+        claimed_ids = [claimed_id for _, _, _, claimed_id, _, _ in done if claimed_id is not None]
+        ids = claimed_ids + [original_id for _, _, _, _, original_id, _ in done if original_id]
+        loaded = {db_item.id: db_item for db_item in
+                  db.query(models.FNOLWorkItem).filter(models.FNOLWorkItem.id.in_(ids))}
+        db_items = []
+        for line_number, item, sig, claimed_id, original_id, stages in done:
+            if stages is None:
+                db_items.append(pipeline._link_duplicate(item, loaded[original_id], loaded.get(claimed_id)))
+            else:
+                db_item = pipeline._fill_workitem(item, stages[1], loaded.get(claimed_id))
+                db_item.duplicate_of_id = original_id
+                db_items.append(db_item)
+        db.add_all(db_items)
+        db.flush()
+        # Read before the commit expires the instances
+        workitem_ids = [db_item.id for db_item in db_items]
+
+        values = []
+        signatures = []
+        for workitem_id, (line_number, item, sig, claimed_id, original_id, stages) in zip(workitem_ids, done):
+            if stages is not None:
+                values += pipeline._attachment_values(workitem_id, stages[0])
+            signatures += near_dup.signature_rows(workitem_id, sig)
+        pipeline.insert_attachments(db, values)
+        db.add_all(signatures)
+        db.flush()
+        return workitem_ids
+
+    def _write_rows(self, db, done, results, reported):
+        """
+        Stores the entries one savepoint each, after the window's transaction
+        failed, so one bad row only fails (and releases) itself. Adds the line
+        numbers of the rows it reported as failed to `reported`; their claims
+        are released once the commit succeeds. Returns the (workitem_id,
+        entry) pairs stored.
+        """
+        stored = []
+        failed_claims = []
+        for entry in done:
+            line_number, item, sig, claimed_id = entry[:4]
+            try:
+                with db.begin_nested():
+                    stored.append((self._store(db, [entry])[0], entry))
+            except Exception as e:
+                log.exception("Writing line %d failed", line_number,
+                              extra={'line': line_number, 'message_id': item.message_id})
+                results.append(_result(line_number, item, 'failed', error=str(e)))
+                reported.add(line_number)
+                if claimed_id is not None:
+                    failed_claims.append(claimed_id)
+        db.commit()
+        self._release(failed_claims)
+        return stored
+
+    def _write(self, window):
+        """Waits for a window's pipeline runs and stores them; returns the per-item results."""
+        results = list(window.results)
+        done = []
+        failed_claims = []
+        for line_number, item, sig, claimed_id, original_id, future in window.pending:
+            if future is None:
+                done.append((line_number, item, sig, claimed_id, original_id, None))
+                continue
+            try:
+                done.append((line_number, item, sig, claimed_id, original_id, future.result()))
+            except Exception as e:
+                log.error("Processing line %d failed: %s", line_number, e,
+                          extra={'line': line_number, 'message_id': item.message_id, 'error': str(e)})
+                results.append(_result(line_number, item, 'failed', error=str(e)))
+                if claimed_id is not None:
+                    failed_claims.append(claimed_id)
+        self._release(failed_claims)
+        if not done:
+            return sorted(results, key=lambda result: result['line'])
+
+        db = self.session_factory()
+        reported = set()
+        try:
+            try:
+                with telemetry.span('commit_batch', workitems=len(done)):
+                    stored = list(zip(self._store(db, done), done))
+                    db.commit()
+            except Exception as e:
+                db.rollback()
+                log.warning("Writing a batch of %d work items failed, writing them one by one: %s", len(done), e,
+                            extra={'workitems': len(done), 'error': str(e)})
+                stored = self._write_rows(db, done, results, reported)
+        except Exception as e:
+            db.rollback()
+            log.exception("Writing a batch of %d work items failed", len(done), extra={'workitems': len(done)})
+            results += [_result(line_number, item, 'failed', error=str(e))
+                        for line_number, item, *_ in done if line_number not in reported]
+            # _write_rows releases claims only after its commit, so none of these is released yet
+            self._release([claimed_id for _, _, _, claimed_id, _, _ in done if claimed_id is not None])
+            return sorted(results, key=lambda result: result['line'])
+        finally:
+            db.close()
+
+        for workitem_id, (line_number, item, sig, claimed_id, original_id, stages) in stored:
+            if stages is None:
+                results.append(_result(line_number, item, 'duplicate', workitem_id, duplicate_of_id=original_id))
+                continue
+            pipeline.index_attachment_text(workitem_id, stages[0])
+            extra = {'duplicate_of_id': original_id} if original_id is not None else {}
+            results.append(_result(line_number, item, 'created', workitem_id,
+                                   attachments=len(stages[0]), seconds=round(stages[2], 3), **extra))
+        return sorted(results, key=lambda result: result['line'])
+
+    def _abandon(self, window):
+        """Cancels a window that will not be written and releases its claims."""
+        for *_, future in window.pending:
+            if future is not None:
+                future.cancel()
+        self._release([entry[3] for entry in window.pending if entry[3] is not None])
+
+    def run(self, lines):
+        start = time.perf_counter()
+        # Windows claimed but not written yet; released if the caller stops
+        # iterating (e.g. the client of a streamed response disconnects)
+        unwritten = []
+        with telemetry.TracedThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='fnol-batch') as executor:
+            try:
+                for entries in _windows(_parse_lines(lines), self.batch_size):
+                    unwritten.append(self._submit(executor, entries))
+                    if len(unwritten) > 1:
+                        results = self._write(unwritten[0])
+                        unwritten.pop(0)
+                        for result in results:
+                            yield self._count(result)
+                if unwritten:
+                    results = self._write(unwritten[0])
+                    unwritten.pop(0)
+                    for result in results:
+                        yield self._count(result)
+            finally:
+                # Before the executor shuts down, so their queued runs are cancelled
+                for window in unwritten:
+                    self._abandon(window)
+        seconds = time.perf_counter() - start
+        total = sum(self.counts.values())
+        yield {
+            'summary': {
+                'lines': total,
+                **self.counts,
+                'seconds': round(seconds, 3),
+                'emails_per_second': round(total / seconds, 2) if seconds else None,
+            }
+        }
+
+
+def ingest(lines, session_factory=None, concurrency=FNOL_BATCH_CONCURRENCY, batch_size=FNOL_BATCH_SIZE):
+    """Result dicts for each NDJSON line of `lines`, then {'summary': ...}; see BatchIngest."""
+    if session_factory is None:
+        import database
+        session_factory = database.SessionLocal
+    return BatchIngest(session_factory, concurrency, batch_size).run(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ingest FNOL emails from an NDJSON file (or - for stdin).")
+    parser.add_argument('path')
+    parser.add_argument('--concurrency', type=int, default=FNOL_BATCH_CONCURRENCY)
+    parser.add_argument('--batch-size', type=int, default=FNOL_BATCH_SIZE)
+    parser.add_argument('--output', help="file for the NDJSON results (default: stdout, mixed with the pipeline log)")
+    args = parser.parse_args()
+    telemetry.configure_logging()
+
+    source = sys.stdin if args.path == '-' else open(args.path, encoding='utf-8')
+    output = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        for result in ingest(source, concurrency=args.concurrency, batch_size=args.batch_size):
+            output.write(json.dumps(result, default=str) + '\n')
+            output.flush()
+            if 'summary' in result:
+                print(f"Batch ingest finished: {result['summary']}")
+    finally:
+        if source is not sys.stdin:
+            source.close()
+        if output is not sys.stdout:
+            output.close()
+        pipeline.shutdown_executors()
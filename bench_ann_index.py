@@ -0,0 +1,89 @@
+"""
+Recall and query latency of the approximate document indexes (IVF-PQ, HNSW)
+against the exact flat baseline, on synthetic clustered embeddings (unit
+vectors around random topic centres, roughly how chunk embeddings of similar
+documents group together). Sweeps nprobe / efSearch.
+
+Usage: python bench_ann_index.py [--vectors N] [--dim D] [--queries Q] [--k K] [--types ivfpq,hnsw]
+"""
+import time
+import argparse
+import statistics
+
+import faiss
+import numpy as np
+
+import ann_index
+
+NPROBES = [1, 4, 16, 64]
+EF_SEARCHES = [16, 64, 256]
+
+
+def synthetic_embeddings(n, dim, clusters, rng):
+    centres = rng.standard_normal((clusters, dim)).astype('float32')
+    vectors = centres[rng.integers(0, clusters, n)] + 0.6 * rng.standard_normal((n, dim)).astype('float32')
+    faiss.normalize_L2(vectors)
+    return vectors
+
+
+def query_latencies(index, queries, k):
+    latencies = []
+    results = []
+    for query in queries:
+        start = time.perf_counter()
+        _, ids = index.search(query.reshape(1, -1), k)
+        latencies.append(time.perf_counter() - start)
+        results.append(ids[0])
+    latencies.sort()
+    return np.array(results), latencies
+
+
+def recall_at_k(results, truth, k):
+    return float(np.mean([len(set(found[:k]) & set(expected[:k])) / k for found, expected in zip(results, truth)]))
+
+
+def report(name, setting, results, latencies, truth, k):
+    p50 = statistics.median(latencies) * 1000
+    p99 = latencies[max(0, int(len(latencies) * 0.99) - 1)] * 1000
+    print(f"{name:6s} {setting:14s} recall@{k} {recall_at_k(results, truth, k):6.3f}   p50 {p50:7.3f} ms   p99 {p99:7.3f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--vectors', type=int, default=100000)
+    parser.add_argument('--dim', type=int, default=768)
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--clusters', type=int, default=200)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--types', default='ivfpq,hnsw')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(42)
+    vectors = synthetic_embeddings(args.vectors + args.queries, args.dim, args.clusters, rng)
+    corpus, queries = vectors[:args.vectors], vectors[args.vectors:]
+    print(f"{args.vectors} vectors x {args.dim} dims, {args.queries} queries")
+
+    start = time.perf_counter()
+    flat = ann_index.build_index(corpus, 'flat')
+    print(f"flat   built in {time.perf_counter() - start:.1f}s")
+    truth, latencies = query_latencies(flat, queries, args.k)
+    report('flat', 'exact', truth, latencies, truth, args.k)
+
+    for index_type, knob, values in (('ivfpq', 'nprobe', NPROBES), ('hnsw', 'efSearch', EF_SEARCHES)):
+        if index_type not in args.types.split(','):
+            continue
+        start = time.perf_counter()
+        index = ann_index.build_index(corpus, index_type)
+        print(f"{index_type:6s} built in {time.perf_counter() - start:.1f}s "
+              f"({type(faiss.downcast_index(index)).__name__})")
+        for value in values:
+            if knob == 'nprobe':
+                ann_index.set_search_params(index, nprobe=value)
+            else:
+                ann_index.set_search_params(index, ef_search=value)
+            results, latencies = query_latencies(index, queries, args.k)
+            report(index_type, f"{knob}={value}", results, latencies, truth, args.k)
+
+
+if __name__ == "__main__":
+    main()
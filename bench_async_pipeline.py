@@ -0,0 +1,115 @@
+"""
+Load test comparing the sync and async FNOL pipelines at increasing request
+concurrency, against stubbed OCR, Gemini and blob backends with fixed latency.
+The sync path runs on a thread pool the size of anyio's default limit (40),
+like sync FastAPI routes do; the async path runs every request on the loop.
+
+Usage: python bench_async_pipeline.py [latency_seconds] [attachments]
+"""
+import os
+import sys
+import time
+import base64
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+os.environ.setdefault('AZURE_STORAGE_CONNECTION_STRING', 'DefaultEndpointsProtocol=http;AccountName=devstoreaccount1;AccountKey=a2V5;BlobEndpoint=http://127.0.0.1:10000/devstoreaccount1;')
+os.environ.setdefault('AZURE_STORAGE_CONTAINER', 'fnol-attachments')
+os.environ.setdefault('AZURE_DOC_INTELLIGENCE_ENDPOINT', 'http://127.0.0.1:5000')
+os.environ.setdefault('AZURE_DOC_INTELLIGENCE_KEY', 'bench')
+os.environ.setdefault('FNOL_CACHE_BACKEND', 'none')
+
+import schemas
+import pipeline
+
+ANYIO_THREAD_LIMIT = 40
+CONCURRENCY_LEVELS = [10, 40, 100, 200]
+
+
+def install_stubs(latency):
+    fields = {'claim_type': {'category': 'Auto', 'sub_category': 'Collision'}}
+
+    def ocr(file_bytes, mime_type, content_hash=None):
+        time.sleep(latency)
+        return 'claim form'
+
+    async def ocr_async(file_bytes, mime_type, content_hash=None):
+        await asyncio.sleep(latency)
+        return 'claim form'
+
+    def extract(subject, body, attachment_text):
+        time.sleep(latency)
+        return fields
+
+    async def extract_async(subject, body, attachment_text):
+        await asyncio.sleep(latency)
+        return fields
+
+    def classify(texts):
+        time.sleep(latency)
+        return ['Claim Form'] * len(texts)
+
+    async def classify_async(texts):
+        await asyncio.sleep(latency)
+        return ['Claim Form'] * len(texts)
+
+    def upload(file_name, data, **options):
+        time.sleep(latency)
+        return f'http://127.0.0.1:10000/devstoreaccount1/fnol-attachments/{file_name}'
+
+    async def upload_async(file_name, data, **options):
+        await asyncio.sleep(latency)
+        return f'http://127.0.0.1:10000/devstoreaccount1/fnol-attachments/{file_name}'
+
+    pipeline.extract_text_from_bytes = ocr
+    pipeline.azure_doc_intel.extract_text_from_bytes_async = ocr_async
+    pipeline.llm_client.extract_fields_from_email = extract
+    pipeline.llm_client.extract_fields_from_email_async = extract_async
+    pipeline.llm_client.guess_doc_types = classify
+    pipeline.llm_client.guess_doc_types_async = classify_async
+    pipeline.azure_blob.upload_attachment = upload
+    pipeline.azure_blob.upload_attachment_async = upload_async
+
+
+def make_items(count, n_attachments):
+    content = base64.b64encode(b'%PDF-1.4 ' + b'x' * 1024).decode()
+    return [
+        schemas.FNOLWorkItemCreate(
+            message_id=f'bench-{i}',
+            subject='Claim',
+            body='Please find attached.',
+            attachments=[{'filename': f'doc{j}.pdf', 'contentBytes': content} for j in range(n_attachments)]
+        )
+        for i in range(count)
+    ]
+
+
+def run_sync(items):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=ANYIO_THREAD_LIMIT) as requests_pool:
+        list(requests_pool.map(pipeline.run_stages, items))
+    return time.perf_counter() - start
+
+
+async def run_async(items):
+    start = time.perf_counter()
+    await asyncio.gather(*(pipeline.run_stages_async(item) for item in items))
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    latency = float(sys.argv[1]) if len(sys.argv) > 1 else 0.1
+    n_attachments = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    # Lift the per-stage limits so the comparison measures the request path
+    for stage in pipeline.STAGE_CONCURRENCY:
+        pipeline.STAGE_CONCURRENCY[stage] = 1000
+    install_stubs(latency)
+
+    print(f"stage_latency={latency}s attachments_per_email={n_attachments}")
+    print(f"{'concurrency':>11} {'sync req/s':>11} {'async req/s':>12}")
+    for concurrency in CONCURRENCY_LEVELS:
+        items = make_items(concurrency, n_attachments)
+        sync_elapsed = run_sync(items)
+        items = make_items(concurrency, n_attachments)
+        async_elapsed = asyncio.run(run_async(items))
+        print(f"{concurrency:>11} {concurrency / sync_elapsed:>11.1f} {concurrency / async_elapsed:>12.1f}")
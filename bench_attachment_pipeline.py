@@ -0,0 +1,72 @@
+"""
+Benchmarks the per-attachment stages of the FNOL pipeline (OCR, batched
+doc-type classification, blob upload) against stubbed backends with fixed
+latency, comparing one-at-a-time processing with the parallel stage pools.
+
+Usage: python bench_attachment_pipeline.py [attachments] [latency_seconds]
+"""
+import os
+import sys
+import time
+import base64
+
+# The Azure clients are built at import time; point them at dummy endpoints.
+os.environ.setdefault('AZURE_STORAGE_CONNECTION_STRING', 'DefaultEndpointsProtocol=http;AccountName=devstoreaccount1;AccountKey=a2V5;BlobEndpoint=http://127.0.0.1:10000/devstoreaccount1;')
+os.environ.setdefault('AZURE_STORAGE_CONTAINER', 'fnol-attachments')
+os.environ.setdefault('AZURE_DOC_INTELLIGENCE_ENDPOINT', 'http://127.0.0.1:5000')
+os.environ.setdefault('AZURE_DOC_INTELLIGENCE_KEY', 'bench')
+
+import schemas
+import pipeline
+
+
+def install_stubs(latency):
+    def fake_ocr(file_bytes, mime_type, content_hash=None):
+        time.sleep(latency)
+        return f"claim form {len(file_bytes)} bytes"
+
+    def fake_guess_doc_types(texts):
+        time.sleep(latency)
+        return ['Claim Form'] * len(texts)
+
+    def fake_upload(file_name, data, **options):
+        time.sleep(latency)
+        return f"http://127.0.0.1:10000/devstoreaccount1/fnol-attachments/{file_name}"
+
+    pipeline.extract_text_from_bytes = fake_ocr
+    pipeline.llm_client.guess_doc_types = fake_guess_doc_types
+    pipeline.azure_blob.upload_attachment = fake_upload
+
+
+def make_item(n_attachments):
+    content = base64.b64encode(b'%PDF-1.4 ' + b'x' * 4096).decode()
+    return schemas.FNOLWorkItemCreate(
+        message_id='bench',
+        subject='Claim',
+        body='Please find attached.',
+        attachments=[{'filename': f'doc{i}.pdf', 'contentBytes': content} for i in range(n_attachments)]
+    )
+
+
+def run(item, concurrency):
+    pipeline.shutdown_executors()
+    for stage in pipeline.STAGE_CONCURRENCY:
+        pipeline.STAGE_CONCURRENCY[stage] = concurrency
+    start = time.perf_counter()
+    attachment_data = pipeline.extract_attachments(item)
+    pipeline.classify_and_upload(attachment_data)
+    elapsed = time.perf_counter() - start
+    assert [a['filename'] for a in attachment_data] == [a['filename'] for a in item.attachments]
+    return elapsed
+
+
+if __name__ == '__main__':
+    n_attachments = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.2
+    install_stubs(latency)
+    item = make_item(n_attachments)
+    sequential = run(item, 1)
+    parallel = run(item, n_attachments)
+    print(f"attachments={n_attachments} stage_latency={latency}s")
+    print(f"sequential: {sequential:.3f}s")
+    print(f"parallel:   {parallel:.3f}s ({sequential / parallel:.1f}x faster)")
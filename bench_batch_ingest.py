@@ -0,0 +1,107 @@
+"""
+Backfill throughput: replaying emails one POST /fnol/ at a time (a session,
+message_id lookup and pipeline run each, in sequence) against batch_ingest
+(set-based message_id dedupe, bounded parallelism across emails, one write
+transaction per window). OCR, Gemini and blob uploads are stubbed with fixed
+latency; work items go to a throwaway SQLite file (or the database given with
+--url). 10% of the replayed lines repeat an earlier message_id.
+
+Usage: python bench_batch_ingest.py [--emails N] [--latency S] [--concurrency C] [--url sqlite:///...]
+"""
+import os
+import json
+import time
+import base64
+import argparse
+import tempfile
+
+os.environ.setdefault('AZURE_STORAGE_CONNECTION_STRING', 'DefaultEndpointsProtocol=http;AccountName=devstoreaccount1;AccountKey=a2V5;BlobEndpoint=http://127.0.0.1:10000/devstoreaccount1;')
+os.environ.setdefault('AZURE_STORAGE_CONTAINER', 'fnol-attachments')
+os.environ.setdefault('AZURE_DOC_INTELLIGENCE_ENDPOINT', 'http://127.0.0.1:5000')
+os.environ.setdefault('AZURE_DOC_INTELLIGENCE_KEY', 'bench')
+os.environ.setdefault('FNOL_CACHE_BACKEND', 'none')
+
+from sqlalchemy import create_engine
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.orm import sessionmaker
+
+import models
+import schemas
+import database
+import pipeline
+import rollups
+import batch_ingest
+
+from bench_async_pipeline import install_stubs
+
+
+@compiles(JSONB, 'sqlite')
+def _jsonb_on_sqlite(type_, compiler, **kw):
+    return 'JSON'
+
+
+def make_lines(count, prefix):
+    content = base64.b64encode(b'%PDF-1.4 ' + b'x' * 1024).decode()
+    lines = []
+    for i in range(count):
+        # Every tenth line replays an earlier email
+        n = i - 5 if i % 10 == 9 else i
+        lines.append(json.dumps({
+            'message_id': f'{prefix}-{n}',
+            'subject': f'Claim {n}',
+            'body': f'Water damage in unit {n}: the pipe burst on floor {n % 7} and soaked the carpet and the drywall.',
+            'attachments': [{'filename': f'claim-{n}.pdf', 'contentBytes': content}],
+        }))
+    return lines
+
+
+def one_by_one(Session, lines):
+    for line in lines:
+        item = schemas.FNOLWorkItemCreate.model_validate_json(line)
+        db = Session()
+        try:
+            if db.query(models.FNOLWorkItem.id).filter(models.FNOLWorkItem.message_id == item.message_id).first():
+                continue
+            pipeline.process_fnol(db, item)
+        finally:
+            db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--emails', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--concurrency', type=int, default=batch_ingest.FNOL_BATCH_CONCURRENCY)
+    parser.add_argument('--batch-size', type=int, default=batch_ingest.FNOL_BATCH_SIZE)
+    parser.add_argument('--url')
+    args = parser.parse_args()
+
+    install_stubs(args.latency)
+    # Keep the comparison about intake, not near-duplicate linking of the generated emails
+    pipeline.near_dup.FNOL_NEAR_DUP_MODE = 'off'
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_engine(args.url or f"sqlite:///{os.path.join(directory, 'batch.db')}")
+        models.Base.metadata.create_all(engine)
+        # The rollup writer and claim heartbeat use database.SessionLocal
+        database.use_engine(engine)
+        Session = sessionmaker(bind=engine, autoflush=False)
+
+        start = time.perf_counter()
+        one_by_one(Session, make_lines(args.emails, 'single'))
+        single = time.perf_counter() - start
+        print(f"one by one: {args.emails} lines in {single:.1f}s ({args.emails / single:.1f} emails/s)")
+
+        summary = None
+        for result in batch_ingest.ingest(make_lines(args.emails, 'batch'), Session, args.concurrency, args.batch_size):
+            summary = result.get('summary', summary)
+        print(f"batch:      {summary['lines']} lines in {summary['seconds']:.1f}s "
+              f"({summary['emails_per_second']:.1f} emails/s, {summary.get('created', 0)} created, "
+              f"{summary.get('duplicate_in_batch', 0)} duplicates) - {single / summary['seconds']:.1f}x")
+        # Write the last rollup deltas while the database still exists
+        rollups.stop_flush_thread()
+    pipeline.shutdown_executors()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""
+Accuracy and latency of the local document type classifier against the LLM
+escalation it replaces. Trains doc_classifier on labelled samples (a
+JSON-lines export given with --data, or generated OCR-like documents for all
+eight labels), then reports for the keyword rules and the trained model:
+held-out accuracy, the share of attachments escalated to the LLM at the
+threshold, accuracy of the labels kept locally, and microseconds per document.
+
+Usage: python bench_doc_classifier.py [--data samples.jsonl] [--samples N] [--threshold 0.8]
+"""
+import random
+import argparse
+
+import doc_classifier
+
+FILLER = (
+    "the of and to in on for with at by from this that is was be as are insured vehicle property date "
+    "address phone email page name signature street city state zip total amount damage accident "
+    "reported contact number information please attached see below above regarding loss claim policy"
+).split()
+
+PHRASES = {
+    'Claim Form': ["claim form", "claim number", "policy number", "claimant name", "incident description",
+                   "policyholder information", "description of accident", "date of loss"],
+    'Police Report': ["police department", "reporting officer", "badge number", "case number",
+                      "incident report", "precinct", "report number", "officer narrative"],
+    'Proof of Loss': ["sworn statement in proof of loss", "actual cash value", "amount claimed",
+                      "statement of loss", "valuation of damaged property", "full cost of repair"],
+    'Invoice': ["invoice number", "bill to", "unit price", "qty", "subtotal", "amount due", "payment terms net"],
+    'Declaration': ["i hereby declare", "under penalty of perjury", "true and correct", "affirm",
+                    "declaration of", "sworn before me"],
+    'Photo': ["image", "photo taken", "camera model", "exif", "img", "photograph of"],
+    'ID Document': ["date of birth", "driver license", "license number", "passport", "nationality",
+                    "identification card", "expires"],
+    'Other Document': ["dear sir or madam", "thank you for your letter", "meeting notes", "newsletter",
+                       "terms and conditions", "regards"],
+}
+FILENAMES = {
+    'Claim Form': ['claim_form', 'fnol_form', 'acord'],
+    'Police Report': ['police_report', 'incident_report', 'pd_report'],
+    'Proof of Loss': ['proof_of_loss', 'pol_statement', 'sworn_statement'],
+    'Invoice': ['invoice', 'inv', 'repair_bill'],
+    'Declaration': ['declaration', 'affidavit', 'statement'],
+    'Photo': ['photo', 'img', 'damage'],
+    'ID Document': ['license', 'passport', 'id_scan'],
+    'Other Document': ['letter', 'notes', 'misc'],
+}
+
+
+def synthetic_samples(count, seed=0):
+    """OCR-like documents: label phrases in filler text, some phrases from other labels, mostly generic filenames."""
+    rng = random.Random(seed)
+    labels = list(PHRASES)
+    samples = []
+    for _ in range(count):
+        label = rng.choice(labels)
+        words = [rng.choice(FILLER) for _ in range(rng.randint(40, 400))]
+        for phrase in rng.sample(PHRASES[label], rng.randint(1, 3)):
+            words.insert(rng.randrange(len(words) + 1), phrase)
+        # Documents also mention other documents ("see attached police report")
+        for _ in range(rng.randint(0, 2)):
+            words.insert(rng.randrange(len(words) + 1), rng.choice(PHRASES[rng.choice(labels)]))
+        extension = 'jpg' if label == 'Photo' and rng.random() < 0.7 else 'pdf'
+        if rng.random() < 0.4:
+            filename = f"{rng.choice(FILENAMES[label])}_{rng.randint(1, 999)}.{extension}"
+        else:
+            filename = f"scan_{rng.randint(1, 99999)}.{extension}"
+        samples.append((' '.join(words), filename, label))
+    return samples
+
+
+def report(name, metrics):
+    confident = metrics['confident_accuracy']
+    print(f"{name:8} accuracy {metrics['accuracy']:.3f}  escalated {metrics['escalation_rate']:.1%}  "
+          f"kept-locally accuracy {confident if confident is None else f'{confident:.3f}'}  "
+          f"{metrics['microseconds_per_document']:.0f} us/doc")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data')
+    parser.add_argument('--samples', type=int, default=5000)
+    parser.add_argument('--threshold', type=float, default=doc_classifier.DOC_CLASSIFIER_THRESHOLD)
+    args = parser.parse_args()
+
+    samples = doc_classifier.read_jsonl(args.data) if args.data else synthetic_samples(args.samples)
+    rng = random.Random(1)
+    rng.shuffle(samples)
+    cut = int(len(samples) * 0.8)
+    train_samples, test_samples = samples[:cut], samples[cut:]
+    print(f"{len(train_samples)} training / {len(test_samples)} test samples, threshold {args.threshold}")
+
+    report('rules', doc_classifier.evaluate(doc_classifier.rules_classifier(), test_samples, args.threshold))
+    model, held_out = doc_classifier.train(train_samples)
+    print(f"trained on {len(train_samples)} samples: {len(model.vocabulary)} features, "
+          f"temperature {held_out['temperature']:.3f}")
+    report('trained', doc_classifier.evaluate(model, test_samples, args.threshold))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""
+Cost of the near-duplicate lookup done before OCR/LLM, as the number of stored
+signatures grows. Fills minhash_signatures / minhash_bands in a throwaway
+SQLite file (or the database given with --url) with random
+signatures, then times near_dup.find_duplicate for planted near-duplicates
+(5% of signature positions changed) and for unrelated emails.
+
+Usage: python bench_near_dup.py [--items N] [--queries Q] [--url sqlite:///...]
+"""
+import os
+import time
+import argparse
+import tempfile
+import statistics
+
+import numpy as np
+from sqlalchemy import create_engine, insert
+from sqlalchemy.orm import sessionmaker
+
+import models
+import near_dup
+
+INSERT_BATCH = 20000
+SAMPLE_BODY = (
+    "Hello, my car was hit in the parking lot of the grocery store on Main Street yesterday at 5pm. "
+    "The other driver left a note with their insurance details. Photos and the police report are attached. "
+) * 5
+
+
+def fill(engine, items, rng):
+    tables = [models.MinHashSignature.__table__, models.MinHashBand.__table__]
+    models.Base.metadata.create_all(engine, tables=tables)
+    signatures = {}
+    start = time.perf_counter()
+    with engine.begin() as conn:
+        for first in range(1, items + 1, INSERT_BATCH):
+            ids = range(first, min(first + INSERT_BATCH, items + 1))
+            batch = rng.integers(0, 2 ** 31 - 1, (len(ids), near_dup.NUM_PERMUTATIONS), dtype='uint32')
+            conn.execute(insert(models.MinHashSignature.__table__), [
+                {'workitem_id': workitem_id, 'signature': sig.tobytes()} for workitem_id, sig in zip(ids, batch)
+            ])
+            conn.execute(insert(models.MinHashBand.__table__), [
+                {'band_key': key, 'workitem_id': workitem_id}
+                for workitem_id, sig in zip(ids, batch) for key in set(near_dup.band_keys(sig))
+            ])
+            if first == 1:
+                signatures.update(zip(ids, batch[:1000]))
+    return signatures, time.perf_counter() - start
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[max(0, int(len(values) * fraction) - 1)]
+
+
+def time_lookups(Session, queries):
+    latencies = []
+    results = []
+    with Session() as db:
+        for sig in queries:
+            start = time.perf_counter()
+            results.append(near_dup.find_duplicate(db, sig))
+            latencies.append(time.perf_counter() - start)
+    return results, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--items', type=int, default=1000000)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--url')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(7)
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_engine(args.url or f"sqlite:///{os.path.join(directory, 'near_dup.db')}")
+        signatures, seconds = fill(engine, args.items, rng)
+        print(f"stored {args.items} signatures in {seconds:.1f}s ({args.items / seconds:.0f}/s)")
+        Session = sessionmaker(bind=engine)
+
+        start = time.perf_counter()
+        for _ in range(100):
+            near_dup.signature(near_dup.shingles('RE: Car accident', SAMPLE_BODY))
+        print(f"signature of a {len(SAMPLE_BODY)}-char email: {(time.perf_counter() - start) * 10:.2f} ms")
+
+        planted = []
+        for workitem_id in list(signatures)[:args.queries]:
+            sig = signatures[workitem_id].copy()
+            changed = rng.choice(len(sig), len(sig) // 20, replace=False)
+            sig[changed] = rng.integers(0, 2 ** 31 - 1, len(changed), dtype='uint32')
+            planted.append((workitem_id, sig))
+        results, latencies = time_lookups(Session, [sig for _, sig in planted])
+        found = sum(1 for (workitem_id, _), match in zip(planted, results) if match and match[0] == workitem_id)
+        print(f"near-duplicates: found {found}/{len(planted)}, "
+              f"p50 {statistics.median(latencies) * 1000:.2f} ms, p99 {percentile(latencies, 0.99) * 1000:.2f} ms")
+
+        unrelated = rng.integers(0, 2 ** 31 - 1, (args.queries, near_dup.NUM_PERMUTATIONS), dtype='uint32')
+        results, latencies = time_lookups(Session, list(unrelated))
+        false_matches = sum(1 for match in results if match)
+        print(f"unrelated:       matched {false_matches}/{len(unrelated)}, "
+              f"p50 {statistics.median(latencies) * 1000:.2f} ms, p99 {percentile(latencies, 0.99) * 1000:.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
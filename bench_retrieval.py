@@ -0,0 +1,126 @@
+"""
+Latency of document retrieval: the old per-query path in quey.py (read the
+index, unpickle the chunks, construct the SentenceTransformer on every call)
+against the long-lived RetrievalService, cold (first query) and warm, plus
+warm throughput at increasing concurrency to show query batching.
+
+Builds a throwaway index of synthetic chunks in a temp directory. Pass
+--stub-encoder to replace the SentenceTransformer with a random-projection
+encoder of fixed latency (no model download needed).
+
+Usage: python bench_retrieval.py [--chunks N] [--queries N] [--stub-encoder]
+"""
+import os
+import sys
+import time
+import types
+import pickle
+import argparse
+import tempfile
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+
+import faiss
+import numpy as np
+
+import retrieval
+
+CONCURRENCY_LEVELS = [1, 8, 32]
+STUB_LOAD_SECONDS = 2.0
+STUB_ENCODE_SECONDS = 0.02
+STUB_DIMENSION = 768
+
+
+class StubEncoder:
+    """Stands in for SentenceTransformer: slow to load, fixed cost per encode call."""
+
+    def __init__(self, model_name=None):
+        time.sleep(STUB_LOAD_SECONDS)
+
+    def encode(self, texts):
+        time.sleep(STUB_ENCODE_SECONDS)
+        rng = np.random.default_rng(abs(hash(tuple(texts))) % (2 ** 32))
+        return rng.standard_normal((len(texts), STUB_DIMENSION)).astype('float32')
+
+
+def build_index(directory, n_chunks, encoder):
+    """
+    Stores the chunks as one claim shard and builds the service's index from
+    it (ann_index.rebuild); chunks.pkl is only written for the old per-query path.
+    """
+    import ann_index
+    import vector_store
+    chunks = [f"Synthetic claim document chunk {i}: policy, loss and claimant details." for i in range(n_chunks)]
+    embeddings = np.ascontiguousarray(encoder.encode(chunks), dtype='float32')
+    faiss.normalize_L2(embeddings)
+    vector_store.use_store(vector_store.VectorStore(os.path.join(directory, 'vectors')))
+    vector_store.get_store().add(1, [('bench', chunk) for chunk in chunks], embeddings)
+    index_path = os.path.join(directory, 'faiss.index')
+    ann_index.rebuild(index_path, 'flat')
+    chunks_path = os.path.join(directory, 'chunks.pkl')
+    with open(chunks_path, 'wb') as f:
+        pickle.dump(chunks, f)
+    return index_path, chunks_path
+
+
+def per_query_reload(make_encoder, index_path, chunks_path, query):
+    """What quey.retrive_relavant_chunks used to do on every call."""
+    index = faiss.read_index(index_path)
+    chunks = pickle.load(open(chunks_path, 'rb'))
+    vectors = np.ascontiguousarray(make_encoder().encode([query]), dtype='float32')
+    faiss.normalize_L2(vectors)
+    index.search(vectors, 3)
+    return chunks
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--chunks', type=int, default=20000)
+    parser.add_argument('--queries', type=int, default=256)
+    parser.add_argument('--stub-encoder', action='store_true')
+    args = parser.parse_args()
+
+    if args.stub_encoder:
+        sys.modules['sentence_transformers'] = types.SimpleNamespace(SentenceTransformer=StubEncoder)
+    from sentence_transformers import SentenceTransformer
+
+    def make_encoder():
+        return SentenceTransformer(retrieval.RETRIEVAL_MODEL)
+
+    with tempfile.TemporaryDirectory() as directory:
+        print(f"Building index of {args.chunks} chunks...")
+        index_path, chunks_path = build_index(directory, args.chunks, make_encoder())
+        queries = [f"what is the claim number for loss {i}" for i in range(args.queries)]
+
+        reload_seconds = [timed(per_query_reload, make_encoder, index_path, chunks_path, q) for q in queries[:3]]
+        print(f"per-query reload:   {statistics.mean(reload_seconds) * 1000:9.1f} ms/query")
+
+        service = retrieval.RetrievalService(index_path=index_path)
+        cold = timed(service.search, queries[0])
+        print(f"service cold:       {cold * 1000:9.1f} ms (model + index load)")
+
+        warm = sorted(timed(service.search, q) for q in queries[:50])
+        print(f"service warm:       {statistics.median(warm) * 1000:9.1f} ms p50, "
+              f"{warm[int(len(warm) * 0.99) - 1] * 1000:.1f} ms p99")
+
+        for concurrency in CONCURRENCY_LEVELS:
+            before = service.stats()
+            with ThreadPoolExecutor(concurrency) as pool:
+                start = time.perf_counter()
+                list(pool.map(service.search, queries))
+                elapsed = time.perf_counter() - start
+            after = service.stats()
+            batches = after['batches'] - before['batches']
+            print(f"concurrency {concurrency:3d}:    {len(queries) / elapsed:9.1f} queries/s, "
+                  f"avg batch {len(queries) / batches:.1f}")
+        service.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,57 @@
+"""
+Cold import time of the API and of a maintenance script, each in fresh
+interpreters (median of --runs), plus whether they import with no Azure or
+Postgres settings at all. Nothing connects to a service: the settings point
+at unused local addresses.
+
+Usage: python bench_startup.py [--runs 7] [module ...]
+"""
+import os
+import sys
+import argparse
+import statistics
+import subprocess
+
+SETTINGS = {
+    'POSTGRES_USER': 'bench', 'POSTGRES_PASSWORD': 'bench', 'POSTGRES_HOST': '127.0.0.1',
+    'POSTGRES_PORT': '5432', 'POSTGRES_DB': 'fnol',
+    'AZURE_STORAGE_CONNECTION_STRING': 'DefaultEndpointsProtocol=http;AccountName=devstoreaccount1;AccountKey=a2V5;BlobEndpoint=http://127.0.0.1:10000/devstoreaccount1;',
+    'AZURE_STORAGE_CONTAINER': 'fnol-attachments',
+    'AZURE_DOC_INTELLIGENCE_ENDPOINT': 'http://127.0.0.1:1',
+    'AZURE_DOC_INTELLIGENCE_KEY': 'bench',
+}
+SNIPPET = "import time; start = time.perf_counter(); import {module}; print(time.perf_counter() - start)"
+
+
+def import_seconds(module, env):
+    result = subprocess.run([sys.executable, '-c', SNIPPET.format(module=module)], env=env,
+                            capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    if result.returncode != 0:
+        return None, result.stderr.strip().splitlines()[-1]
+    return float(result.stdout.strip().splitlines()[-1]), None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=7)
+    parser.add_argument('modules', nargs='*', default=['app', 'check_table_counts'])
+    args = parser.parse_args()
+
+    # Run from a scratch directory's point of view: no .env values leak in
+    base = {k: v for k, v in os.environ.items() if k not in SETTINGS}
+    base['PYTHONDONTWRITEBYTECODE'] = '1'
+    configured = {**base, **SETTINGS}
+    # Empty values keep load_dotenv from filling them in from .env
+    unconfigured = {**base, **{name: '' for name in SETTINGS}}
+
+    for module in args.modules:
+        import_seconds(module, configured)  # warm the OS file cache
+        times = [import_seconds(module, configured)[0] for _ in range(args.runs)]
+        times = [t for t in times if t is not None]
+        _, error = import_seconds(module, unconfigured)
+        print(f"{module:20} median import {statistics.median(times) * 1000:7.1f} ms  "
+              f"(min {min(times) * 1000:.1f}) | without settings: {'ok' if error is None else error}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,375 @@
+import os
+import json
+import asyncio
+import time
+import hashlib
+import logging
+import datetime
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Persistent tier shared by all caches: 'postgres' (cache_entries table),
+# 'disk' (JSON files under FNOL_CACHE_DIR) or 'none' (memory only).
+FNOL_CACHE_BACKEND = os.getenv('FNOL_CACHE_BACKEND', 'postgres')
+FNOL_CACHE_DIR = os.getenv('FNOL_CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache'))
+# Expired/oversized persistent entries of caches written to since the last
+# run are purged by a background thread every N seconds
+FNOL_CACHE_PURGE_SECONDS = float(os.getenv('FNOL_CACHE_PURGE_SECONDS', '300'))
+
+log = logging.getLogger('fnol.cache')
+
+_MISSING = object()
+_caches = {}
+
+_purge_stop = threading.Event()
+_purge_thread = None
+_purge_thread_lock = threading.Lock()
+_sessions = None
+
+
+def hash_key(*parts):
+    """SHA-256 over the given parts; bytes are hashed as-is, anything else as str."""
+    digest = hashlib.sha256()
+    for part in parts:
+        if not isinstance(part, (bytes, bytearray, memoryview)):
+            part = str(part).encode('utf-8')
+        digest.update(len(part).to_bytes(8, 'big'))
+        digest.update(part)
+    return digest.hexdigest()
+
+
+def _session():
+    """
+    This thread's cache session, reused across lookups. Each lookup ends its
+    transaction, so the pooled connection is only held for the statement.
+    """
+    global _sessions
+    if _sessions is None:
+        import database
+        from sqlalchemy.orm import scoped_session
+        _sessions = scoped_session(database.SessionLocal)
+    return _sessions()
+
+
+class PostgresTier:
+    def __init__(self, namespace, max_entries):
+        self.namespace = namespace
+        self.max_entries = max_entries
+
+    def get(self, key):
+        import models
+        from sqlalchemy import select
+        entries = models.CacheEntry
+        db = _session()
+        try:
+            value = db.execute(select(entries.value).where(
+                entries.namespace == self.namespace,
+                entries.key == key,
+                entries.expires_at > datetime.datetime.utcnow()
+            )).scalar()
+        finally:
+            db.rollback()
+        return json.loads(value) if value is not None else _MISSING
+
+    def set(self, key, value, ttl_seconds):
+        import models
+        import rollups
+        db = _session()
+        try:
+            now = datetime.datetime.utcnow()
+            values = {
+                'value': json.dumps(value),
+                'created_at': now,
+                'expires_at': now + datetime.timedelta(seconds=ttl_seconds),
+            }
+            stmt = rollups.dialect_insert(db.connection())(models.CacheEntry.__table__).values(
+                namespace=self.namespace, key=key, **values)
+            db.execute(stmt.on_conflict_do_update(index_elements=['namespace', 'key'], set_=values))
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+
+    def purge(self):
+        import database
+        import models
+        db = database.SessionLocal()
+        try:
+            entries = models.CacheEntry
+            db.query(entries).filter(
+                entries.namespace == self.namespace,
+                entries.expires_at <= datetime.datetime.utcnow()
+            ).delete(synchronize_session=False)
+            cutoff = db.query(entries.created_at).filter(entries.namespace == self.namespace) \
+                .order_by(entries.created_at.desc()).offset(self.max_entries).limit(1).scalar()
+            if cutoff is not None:
+                db.query(entries).filter(
+                    entries.namespace == self.namespace,
+                    entries.created_at <= cutoff
+                ).delete(synchronize_session=False)
+            db.commit()
+        finally:
+            db.close()
+
+
+class DiskTier:
+    def __init__(self, namespace, max_entries):
+        self.directory = os.path.join(FNOL_CACHE_DIR, namespace)
+        self.max_entries = max_entries
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.json')
+
+    def get(self, key):
+        try:
+            with open(self._path(key), 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return _MISSING
+        if entry['expires_at'] <= time.time():
+            return _MISSING
+        return entry['value']
+
+    def set(self, key, value, ttl_seconds):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'expires_at': time.time() + ttl_seconds, 'value': value}, f)
+        os.replace(tmp_path, path)
+
+    def purge(self):
+        files = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if name.endswith('.json'):
+                    path = os.path.join(root, name)
+                    try:
+                        files.append((os.path.getmtime(path), path))
+                    except OSError:
+                        pass
+        files.sort(reverse=True)
+        for i, (_, path) in enumerate(files):
+            if i >= self.max_entries or self.get(os.path.basename(path)[:-5]) is _MISSING:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+
+class TieredCache:
+    """
+    Two-tier cache: a size-bounded in-memory LRU in front of a persistent tier
+    shared across workers. Values must be JSON serializable. Persistent tier
+    errors are logged and treated as misses, so the cache never fails a request.
+    """
+
+    def __init__(self, name, max_memory_bytes, ttl_seconds, max_persistent_entries=100000, backend=None):
+        self.name = name
+        self.max_memory_bytes = max_memory_bytes
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()  # key -> (expires_at, size, value)
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        self._written = False  # since the last purge
+        self.counters = {'memory_hits': 0, 'persistent_hits': 0, 'misses': 0, 'evictions': 0, 'errors': 0}
+        backend = backend or FNOL_CACHE_BACKEND
+        if backend == 'postgres':
+            self.persistent = PostgresTier(name, max_persistent_entries)
+        elif backend == 'disk':
+            self.persistent = DiskTier(name, max_persistent_entries)
+        else:
+            self.persistent = None
+        _caches[name] = self
+
+    def _count(self, counter):
+        with self._lock:
+            self.counters[counter] += 1
+
+    def _remember(self, key, value, expires_at):
+        size = len(json.dumps(value))
+        if size > self.max_memory_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._memory_bytes -= old[1]
+            self._entries[key] = (expires_at, size, value)
+            self._memory_bytes += size
+            while self._memory_bytes > self.max_memory_bytes:
+                _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self._memory_bytes -= evicted_size
+                self.counters['evictions'] += 1
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > time.time():
+                    self._entries.move_to_end(key)
+                    self.counters['memory_hits'] += 1
+                    return entry[2]
+                self._entries.pop(key)
+                self._memory_bytes -= entry[1]
+        if self.persistent is not None:
+            try:
+                value = self.persistent.get(key)
+            except Exception as e:
+                log.warning("Cache '%s' persistent read failed: %s", self.name, e, extra={'cache': self.name})
+                self._count('errors')
+                value = _MISSING
+            if value is not _MISSING:
+                self._count('persistent_hits')
+                self._remember(key, value, time.time() + self.ttl_seconds)
+                return value
+        self._count('misses')
+        return default
+
+    def set(self, key, value):
+        self._remember(key, value, time.time() + self.ttl_seconds)
+        if self.persistent is None:
+            return
+        try:
+            self.persistent.set(key, value, self.ttl_seconds)
+        except Exception as e:
+            log.warning("Cache '%s' persistent write failed: %s", self.name, e, extra={'cache': self.name})
+            self._count('errors')
+            return
+        with self._lock:
+            self._written = True
+        start_purge_thread()
+
+    def purge(self):
+        """Purges the persistent tier if it was written to since the last purge."""
+        with self._lock:
+            written, self._written = self._written, False
+        if not written:
+            return
+        try:
+            self.persistent.purge()
+        except Exception as e:
+            log.warning("Cache '%s' purge failed: %s", self.name, e, extra={'cache': self.name})
+            self._count('errors')
+
+    def clear_memory(self):
+        with self._lock:
+            self._entries.clear()
+            self._memory_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self.counters)
+            entries = len(self._entries)
+            memory_bytes = self._memory_bytes
+        lookups = counters['memory_hits'] + counters['persistent_hits'] + counters['misses']
+        hits = counters['memory_hits'] + counters['persistent_hits']
+        return {
+            **counters,
+            'hit_rate': hits / lookups if lookups else 0.0,
+            'memory_entries': entries,
+            'memory_bytes': memory_bytes,
+        }
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key: the first caller runs the
+    function, later callers block on its result (or exception) instead of
+    issuing their own call.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.coalesced = 0
+
+    def do(self, key, fn):
+        """Returns (value, shared) where shared is True for coalesced callers."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = Future()
+                self._calls[key] = call
+            else:
+                self.coalesced += 1
+        if not leader:
+            return call.result(), True
+        try:
+            value = fn()
+            call.set_result(value)
+            return value, False
+        except BaseException as e:
+            call.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+
+class AsyncSingleFlight:
+    """
+    SingleFlight for coroutines running on one event loop. The call runs as
+    its own task that every caller awaits through a shield, so cancelling
+    one caller (the first one included) leaves it running for the others.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self.coalesced = 0
+
+    async def do(self, key, coro_fn):
+        """Returns (value, shared) where shared is True for coalesced callers."""
+        task = self._calls.get(key)
+        shared = task is not None
+        if shared:
+            self.coalesced += 1
+        else:
+            task = asyncio.ensure_future(coro_fn())
+            self._calls[key] = task
+            task.add_done_callback(lambda done: self._finished(key, done))
+        return await asyncio.shield(task), shared
+
+    def _finished(self, key, task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        if not task.cancelled():
+            # Mark the exception as retrieved when every caller was cancelled
+            task.exception()
+
+
+def _purge_loop():
+    while not _purge_stop.wait(FNOL_CACHE_PURGE_SECONDS):
+        for c in list(_caches.values()):
+            if c.persistent is not None:
+                c.purge()
+
+
+def start_purge_thread():
+    """Starts the background purge of the persistent tiers (once per process, on the first write)."""
+    global _purge_thread
+    if _purge_thread is not None and _purge_thread.is_alive():
+        return
+    with _purge_thread_lock:
+        # A forked child inherits the reference but not the thread
+        if _purge_thread is None or not _purge_thread.is_alive():
+            _purge_stop.clear()
+            _purge_thread = threading.Thread(target=_purge_loop, name="fnol-cache-purge", daemon=True)
+            _purge_thread.start()
+
+
+def stop_purge_thread():
+    global _purge_thread
+    _purge_stop.set()
+    if _purge_thread is not None:
+        _purge_thread.join(timeout=10)
+        _purge_thread = None
+
+
+def stats():
+    """Hit/miss statistics for every cache created in this process."""
+    return {name: c.stats() for name, c in _caches.items()}
@@ -1,8 +1,13 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
 import os
+import time
+import threading
 from dotenv import load_dotenv
 
+import providers
+
 load_dotenv()
 
 POSTGRES_USER = os.getenv('POSTGRES_USER')
@@ -13,5 +18,195 @@ POSTGRES_DB = os.getenv('POSTGRES_DB')
 
 DATABASE_URL = f"postgresql://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}:{POSTGRES_PORT}/{POSTGRES_DB}"
 
-engine = create_engine(DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# Connection pool, per engine (sync and async). Connections idle past
+# DB_POOL_RECYCLE seconds are replaced before Azure Postgres drops them, and
+# pre-ping replaces any that were dropped anyway.
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '10'))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', '10'))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '30'))
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', '1800'))
+DB_POOL_PRE_PING = os.getenv('DB_POOL_PRE_PING', 'true').lower() == 'true'
+
+_pool_stats = {}
+_pool_stats_lock = threading.Lock()
+
+
+def _record_pool(name, **deltas):
+    with _pool_stats_lock:
+        stats = _pool_stats.setdefault(name, {
+            'checkouts': 0, 'wait_seconds': 0.0, 'max_wait_seconds': 0.0, 'timeouts': 0, 'invalidated': 0,
+        })
+        for key, delta in deltas.items():
+            if key == 'max_wait_seconds':
+                stats[key] = max(stats[key], delta)
+            else:
+                stats[key] += delta
+
+
+class _TimedPoolMixin:
+    """Records how long checkouts wait for a free connection, and checkout timeouts."""
+
+    stats_name = 'sync'
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except Exception:
+            _record_pool(self.stats_name, timeouts=1, wait_seconds=time.perf_counter() - start)
+            raise
+        waited = time.perf_counter() - start
+        _record_pool(self.stats_name, checkouts=1, wait_seconds=waited, max_wait_seconds=waited)
+        return connection
+
+
+class TimedQueuePool(_TimedPoolMixin, QueuePool):
+    stats_name = 'sync'
+
+
+class TimedAsyncQueuePool(_TimedPoolMixin, AsyncAdaptedQueuePool):
+    stats_name = 'async'
+
+
+def pool_options(poolclass):
+    return {
+        'poolclass': poolclass,
+        'pool_size': DB_POOL_SIZE,
+        'max_overflow': DB_MAX_OVERFLOW,
+        'pool_timeout': DB_POOL_TIMEOUT,
+        'pool_recycle': DB_POOL_RECYCLE,
+        'pool_pre_ping': DB_POOL_PRE_PING,
+    }
+
+
+def _count_invalidations(engine, name):
+    @event.listens_for(engine.pool, 'invalidate')
+    def _invalidated(dbapi_connection, connection_record, exception):
+        _record_pool(name, invalidated=1)
+
+
+def _check_settings():
+    if not (POSTGRES_HOST and POSTGRES_PORT and POSTGRES_DB and POSTGRES_USER):
+        raise RuntimeError("POSTGRES_HOST, POSTGRES_PORT, POSTGRES_DB and POSTGRES_USER must be set")
+
+
+def _make_engine():
+    _check_settings()
+    engine = create_engine(DATABASE_URL, **pool_options(TimedQueuePool))
+    _count_invalidations(engine, 'sync')
+    return engine
+
+
+def _drop_inherited_connections(engine):
+    # A forked worker keeps the engine but must not touch the parent's sockets
+    engine.dispose(close=False)
+
+
+def _open_first_connection(engine):
+    engine.connect().close()
+
+
+# Built on first use: importing this module neither loads psycopg2 nor needs the settings
+engine_provider = providers.ClientProvider('postgres', _make_engine, on_fork=_drop_inherited_connections,
+                                           warm=_open_first_connection)
+
+
+def get_engine():
+    return engine_provider.get()
+
+
+class _LazySessionmaker(sessionmaker):
+    """A sessionmaker that binds itself to get_engine() when the first session is made."""
+
+    def __call__(self, **local_kw):
+        if self.kw.get('bind') is None:
+            self.configure(bind=get_engine())
+        return super().__call__(**local_kw)
+
+
+SessionLocal = _LazySessionmaker(autocommit=False, autoflush=False)
+
+
+def use_engine(engine):
+    """Points SessionLocal and database.engine at another engine, e.g. a benchmark's database."""
+    engine_provider.set(engine)
+    SessionLocal.configure(bind=engine)
+
+
+def __getattr__(name):
+    # `database.engine` / `from database import engine` still work, building it on first use
+    if name == 'engine':
+        return get_engine()
+    if name == 'async_engine':
+        return get_async_engine() if async_engine_provider.built else None
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+# Registers the session listeners that keep the analytics rollups up to date
+import rollups  # noqa: E402,F401
+# and the one that drops a deleted work item's vector index shard
+import vector_store  # noqa: E402,F401
+
+# Async engine for FNOL_API_MODE=async, built on first use so the sync
+# deployment does not need asyncpg installed.
+ASYNC_DATABASE_URL = f"postgresql+asyncpg://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}:{POSTGRES_PORT}/{POSTGRES_DB}"
+
+def _make_async_engine():
+    from sqlalchemy.ext.asyncio import create_async_engine
+    _check_settings()
+    engine = create_async_engine(ASYNC_DATABASE_URL, **pool_options(TimedAsyncQueuePool))
+    _count_invalidations(engine.sync_engine, 'async')
+    return engine
+
+
+# Its connections belong to the event loop that opened them, so a forked
+# worker builds its own; closed (disposed) with the other async clients
+async_engine_provider = providers.ClientProvider('postgres_async', _make_async_engine,
+                                                 close=lambda engine: engine.dispose())
+AsyncSessionLocal = None
+
+
+def get_async_engine():
+    return async_engine_provider.get()
+
+
+def get_async_sessionmaker():
+    global AsyncSessionLocal
+    engine = get_async_engine()
+    if AsyncSessionLocal is None or AsyncSessionLocal.kw.get('bind') is not engine:
+        from sqlalchemy.ext.asyncio import async_sessionmaker
+        AsyncSessionLocal = async_sessionmaker(bind=engine, autoflush=False, expire_on_commit=False)
+    return AsyncSessionLocal
+
+
+def use_async_engine(engine):
+    """use_engine for the async engine behind get_async_sessionmaker()."""
+    async_engine_provider.set(engine)
+    get_async_sessionmaker()
+
+
+def _pool_status(engine, name):
+    pool = engine.pool
+    with _pool_stats_lock:
+        stats = dict(_pool_stats.get(name, {}))
+    if not isinstance(pool, QueuePool):
+        stats['pool'] = type(pool).__name__
+        return stats
+    stats.update(
+        size=pool.size(),
+        checked_out=pool.checkedout(),
+        checked_in=pool.checkedin(),
+        overflow=max(0, pool.overflow()),
+        max_overflow=DB_MAX_OVERFLOW,
+    )
+    return stats
+
+
+def pool_stats():
+    """Connections checked out / idle / in overflow per engine, with checkout wait times and timeouts."""
+    stats = {}
+    if engine_provider.built:
+        stats['sync'] = _pool_status(get_engine(), 'sync')
+    if async_engine_provider.built:
+        stats['async'] = _pool_status(get_async_engine().sync_engine, 'async')
+    return stats
+
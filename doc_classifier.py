@@ -0,0 +1,396 @@
+import os
+import re
+import sys
+import json
+import math
+import logging
+import time
+import random
+import argparse
+import threading
+from collections import Counter
+from dotenv import load_dotenv
+
+from llm_client import DOC_TYPES
+
+load_dotenv()
+
+log = logging.getLogger('fnol.classifier')
+
+# Attachments are labelled by a local classifier first; only those it is less
+# than DOC_CLASSIFIER_THRESHOLD confident about go to the LLM. Modes: 'local'
+# (escalate below the threshold), 'local_only' (never call the LLM), 'llm'
+# (always call the LLM, the local label is used only if that fails)
+DOC_CLASSIFIER_MODE = os.getenv('DOC_CLASSIFIER_MODE', 'local')
+DOC_CLASSIFIER_THRESHOLD = float(os.getenv('DOC_CLASSIFIER_THRESHOLD', '0.8'))
+# Trained model written by `python doc_classifier.py train`; without one, the
+# built-in keyword rules below are used
+DOC_CLASSIFIER_PATH = os.getenv('DOC_CLASSIFIER_PATH', 'doc_classifier.json')
+# Document types show in the first page or so; the rest is not looked at
+DOC_CLASSIFIER_MAX_CHARS = int(os.getenv('DOC_CLASSIFIER_MAX_CHARS', '3000'))
+
+_WORD = re.compile(r'[a-z]{2,}')
+
+# Keyword weights per label (binary features; 'file:' ones match the filename).
+# Mirrors the classification rules given to the LLM in llm_client.
+RULES = {
+    'Claim Form': {
+        'claim': 1, 'claim form': 3, 'claim number': 2, 'policy number': 1.5, 'claimant': 1.5,
+        'policyholder': 1, 'date of': 0.5, 'incident description': 1.5, 'description of': 0.5,
+        'file:claim': 2,
+    },
+    'Police Report': {
+        'police': 2, 'officer': 1.5, 'badge': 2, 'case number': 1.5, 'report number': 1.5,
+        'incident report': 2, 'precinct': 2, 'department': 0.5, 'file:police': 2,
+    },
+    'Proof of Loss': {
+        'proof': 2, 'sworn': 1.5, 'sworn statement': 1, 'of loss': 1.5, 'loss': 0.5, 'valuation': 1,
+        'actual cash': 1.5, 'amount claimed': 1.5, 'file:proof': 2, 'file:pol': 2,
+    },
+    'Invoice': {
+        'invoice': 3, 'invoice number': 1, 'subtotal': 2, 'total': 0.5, 'amount due': 2, 'payment terms': 2,
+        'qty': 1.5, 'bill to': 1.5, 'unit price': 1.5, 'file:invoice': 2, 'file:inv': 1.5,
+    },
+    'Declaration': {
+        'declaration': 2, 'declare': 2, 'perjury': 2.5, 'under penalty': 2, 'affirm': 1.5, 'hereby': 1,
+        'file:declaration': 2,
+    },
+    'Photo': {
+        'photo': 2, 'photograph': 2, 'image': 1.5, 'exif': 2, 'file:jpg': 4, 'file:jpeg': 4, 'file:png': 4,
+        'file:heic': 4, 'file:img': 1.5, 'file:photo': 2,
+    },
+    'ID Document': {
+        'passport': 3, 'driver license': 2, 'drivers license': 2, 'license': 1.5, 'of birth': 2, 'dob': 2,
+        'identification': 1.5, 'id card': 2, 'nationality': 1.5, 'file:license': 2, 'file:passport': 2,
+    },
+    'Other Document': {},
+}
+# Prior score of 'Other Document', so text matching no rule is labelled Other
+# with low confidence (and escalated)
+RULES_OTHER_BIAS = 1.0
+
+_stats_lock = threading.Lock()
+_stats = {
+    'classified': 0,
+    'escalated': 0,
+    'seconds': 0.0,
+}
+
+
+def _record(**deltas):
+    with _stats_lock:
+        for name, delta in deltas.items():
+            _stats[name] += delta
+
+
+def stats():
+    """Attachments labelled locally, how many of them were escalated to the LLM, and the local time spent."""
+    with _stats_lock:
+        stats = dict(_stats)
+    stats['model'] = get_classifier().name
+    return stats
+
+
+def features(text, filename=None, max_chars=DOC_CLASSIFIER_MAX_CHARS):
+    """Word unigram and bigram counts of the start of the text, plus 'file:' tokens of the filename."""
+    words = _WORD.findall((text or '')[:max_chars].lower())
+    counts = Counter(words)
+    counts.update(f"{a} {b}" for a, b in zip(words, words[1:]))
+    if filename:
+        counts.update(f"file:{word}" for word in _WORD.findall(filename.lower()))
+    return counts
+
+
+def _softmax(scores):
+    top = max(scores)
+    exps = [math.exp(score - top) for score in scores]
+    total = sum(exps)
+    return [value / total for value in exps]
+
+
+class LinearClassifier:
+    """
+    A linear model over features(): scores are bias + feature values x weights,
+    turned into probabilities with a softmax at the given temperature. Feature
+    values are 1 for binary models (the keyword rules) and L2-normalized
+    log-count x idf otherwise (the trained naive Bayes model).
+    """
+
+    def __init__(self, labels, vocabulary, weights, bias, idf=None, temperature=1.0, binary=False, name='rules'):
+        import numpy as np
+        self.labels = list(labels)
+        self.vocabulary = {feature: i for i, feature in enumerate(vocabulary)}
+        self.weights = np.asarray(weights, dtype='float32').reshape(len(self.vocabulary), len(self.labels))
+        self.bias = np.asarray(bias, dtype='float64')
+        self.idf = np.asarray(idf, dtype='float32') if idf is not None else None
+        self.temperature = temperature
+        self.binary = binary
+        self.name = name
+
+    def _values(self, counts):
+        import numpy as np
+        pairs = [(self.vocabulary[feature], count) for feature, count in counts.items() if feature in self.vocabulary]
+        if not pairs:
+            return np.zeros(0, dtype='int64'), np.zeros(0, dtype='float32')
+        index = np.fromiter((i for i, _ in pairs), dtype='int64', count=len(pairs))
+        if self.binary:
+            return index, np.ones(len(pairs), dtype='float32')
+        values = np.log1p(np.fromiter((count for _, count in pairs), dtype='float32', count=len(pairs)))
+        values *= self.idf[index]
+        return index, values / np.linalg.norm(values)
+
+    def scores(self, text, filename=None):
+        index, values = self._values(features(text, filename))
+        return self.bias + values @ self.weights[index]
+
+    def predict(self, text, filename=None):
+        """Returns (label, confidence)."""
+        probabilities = _softmax(list(self.scores(text, filename) / self.temperature))
+        best = max(range(len(self.labels)), key=probabilities.__getitem__)
+        return self.labels[best], probabilities[best]
+
+    def to_dict(self):
+        vocabulary = sorted(self.vocabulary, key=self.vocabulary.get)
+        return {
+            'name': self.name,
+            'labels': self.labels,
+            'vocabulary': vocabulary,
+            'weights': [[round(float(w), 5) for w in row] for row in self.weights],
+            'bias': [round(float(b), 5) for b in self.bias],
+            'idf': [round(float(v), 5) for v in self.idf] if self.idf is not None else None,
+            'temperature': self.temperature,
+            'binary': self.binary,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['labels'], data['vocabulary'], data['weights'], data['bias'], data.get('idf'),
+                   data.get('temperature', 1.0), data.get('binary', False), data.get('name', 'trained'))
+
+
+def rules_classifier():
+    vocabulary = sorted({feature for keywords in RULES.values() for feature in keywords})
+    weights = [[RULES[label].get(feature, 0.0) for label in DOC_TYPES] for feature in vocabulary]
+    bias = [RULES_OTHER_BIAS if label == 'Other Document' else 0.0 for label in DOC_TYPES]
+    return LinearClassifier(DOC_TYPES, vocabulary, weights, bias, binary=True, name='rules')
+
+
+def _fit_naive_bayes(docs, labels, alpha, min_df, max_features):
+    import numpy as np
+    document_frequency = Counter()
+    for counts in docs:
+        document_frequency.update(counts.keys())
+    vocabulary = [feature for feature, df in document_frequency.most_common(max_features) if df >= min_df]
+    position = {feature: i for i, feature in enumerate(vocabulary)}
+    idf = np.log((1 + len(docs)) / (1 + np.array([document_frequency[f] for f in vocabulary], dtype='float64'))) + 1
+    label_index = {label: i for i, label in enumerate(DOC_TYPES)}
+
+    totals = np.zeros((len(DOC_TYPES), len(vocabulary)))
+    for counts, label in zip(docs, labels):
+        pairs = [(position[f], c) for f, c in counts.items() if f in position]
+        if not pairs:
+            continue
+        index = np.array([i for i, _ in pairs])
+        values = np.log1p(np.array([c for _, c in pairs], dtype='float64')) * idf[index]
+        totals[label_index[label], index] += values / np.linalg.norm(values)
+    theta = (totals + alpha) / (totals.sum(axis=1, keepdims=True) + alpha * len(vocabulary))
+    label_counts = Counter(labels)
+    prior = np.array([label_counts[label] + 1 for label in DOC_TYPES], dtype='float64')
+    return LinearClassifier(DOC_TYPES, vocabulary, np.log(theta).T, np.log(prior / prior.sum()), idf, name='trained')
+
+
+def _fit_temperature(model, samples):
+    """Temperature minimising the log loss on held-out samples, so confidences are calibrated."""
+    import numpy as np
+    label_index = {label: i for i, label in enumerate(model.labels)}
+    scores = np.array([model.scores(text, filename) for text, filename, _ in samples])
+    truth = np.array([label_index[label] for _, _, label in samples])
+    best = None
+    for temperature in np.logspace(-3, 1, 80):
+        scaled = scores / temperature
+        scaled -= scaled.max(axis=1, keepdims=True)
+        log_probabilities = scaled - np.log(np.exp(scaled).sum(axis=1, keepdims=True))
+        loss = -log_probabilities[np.arange(len(truth)), truth].mean()
+        if best is None or loss < best[0]:
+            best = (loss, float(temperature))
+    return best[1]
+
+
+def evaluate(model, samples, threshold=DOC_CLASSIFIER_THRESHOLD):
+    """Accuracy overall and on the samples the model is confident about, and the share it would escalate."""
+    correct = confident = confident_correct = 0
+    start = time.perf_counter()
+    for text, filename, label in samples:
+        predicted, confidence = model.predict(text, filename)
+        correct += predicted == label
+        if confidence >= threshold:
+            confident += 1
+            confident_correct += predicted == label
+    seconds = time.perf_counter() - start
+    return {
+        'samples': len(samples),
+        'accuracy': correct / len(samples) if samples else None,
+        'escalation_rate': 1 - confident / len(samples) if samples else None,
+        'confident_accuracy': confident_correct / confident if confident else None,
+        'microseconds_per_document': seconds / len(samples) * 1e6 if samples else None,
+    }
+
+
+def train(samples, holdout=0.2, alpha=0.1, min_df=2, max_features=50000, seed=0):
+    """
+    Trains a naive Bayes classifier on (text, filename, label) samples. The
+    temperature is fitted on a held-out split, which also gives the reported
+    metrics; the returned model is then refitted on all samples.
+    Returns (model, held-out metrics).
+    """
+    samples = [sample for sample in samples if sample[2] in DOC_TYPES]
+    rng = random.Random(seed)
+    shuffled = samples[:]
+    rng.shuffle(shuffled)
+    cut = int(len(shuffled) * (1 - holdout))
+    train_samples, test_samples = shuffled[:cut], shuffled[cut:]
+
+    def fit(subset):
+        docs = [features(text, filename) for text, filename, _ in subset]
+        return _fit_naive_bayes(docs, [label for _, _, label in subset], alpha, min_df, max_features)
+
+    model = fit(train_samples)
+    temperature = _fit_temperature(model, test_samples) if test_samples else 1.0
+    model.temperature = temperature
+    report = evaluate(model, test_samples)
+    report['temperature'] = temperature
+    model = fit(samples)
+    model.temperature = temperature
+    return model, report
+
+
+def save(model, path=DOC_CLASSIFIER_PATH):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(model.to_dict(), f)
+    os.replace(tmp_path, path)
+
+
+_model = None
+_model_mtime = None
+_model_lock = threading.Lock()
+
+
+def get_classifier():
+    """The trained model at DOC_CLASSIFIER_PATH (reloaded when the file changes), or the keyword rules."""
+    global _model, _model_mtime
+    try:
+        mtime = os.stat(DOC_CLASSIFIER_PATH).st_mtime
+    except OSError:
+        mtime = None
+    if _model is None or mtime != _model_mtime:
+        with _model_lock:
+            if _model is None or mtime != _model_mtime:
+                model = None
+                if mtime is not None:
+                    try:
+                        with open(DOC_CLASSIFIER_PATH) as f:
+                            model = LinearClassifier.from_dict(json.load(f))
+                        log.info("Loaded document classifier from %s", DOC_CLASSIFIER_PATH)
+                    except Exception as e:
+                        log.warning("Could not load %s, using keyword rules: %s", DOC_CLASSIFIER_PATH, e,
+                                    extra={'error': str(e)})
+                _model = model or rules_classifier()
+                _model_mtime = mtime
+    return _model
+
+
+def classify_attachments(texts, filenames):
+    """
+    Labels attachments locally. Returns (labels, positions to escalate to the
+    LLM) according to DOC_CLASSIFIER_MODE and DOC_CLASSIFIER_THRESHOLD.
+    """
+    model = get_classifier()
+    start = time.perf_counter()
+    predictions = [model.predict(text, filename) for text, filename in zip(texts, filenames)]
+    seconds = time.perf_counter() - start
+    labels = [label for label, _ in predictions]
+    if DOC_CLASSIFIER_MODE == 'llm':
+        uncertain = list(range(len(labels)))
+    elif DOC_CLASSIFIER_MODE == 'local_only':
+        uncertain = []
+    else:
+        uncertain = [i for i, (_, confidence) in enumerate(predictions) if confidence < DOC_CLASSIFIER_THRESHOLD]
+    for filename, (label, confidence) in zip(filenames, predictions):
+        log.debug("Local document type for '%s': %s (%.2f)", filename, label, confidence,
+                  extra={'attachment': filename, 'doc_type': label, 'confidence': round(confidence, 3)})
+    _record(classified=len(labels), escalated=len(uncertain), seconds=seconds)
+    return labels, uncertain
+
+
+def labelled_attachments(db):
+    """
+    (text, filename, doc_type) of stored attachments whose OCR text is in the
+    per-claim vector store (FNOL_VECTOR_INDEXING); others have no text to learn from.
+    """
+    import models
+    import vector_store
+    store = vector_store.get_store()
+    indexed = set(store.workitem_ids())
+    rows = (
+        db.query(models.Attachment.workitem_id, models.Attachment.filename, models.Attachment.doc_type)
+        .filter(models.Attachment.doc_type.in_(DOC_TYPES))
+        .order_by(models.Attachment.workitem_id)
+        .all()
+    )
+    samples = []
+    texts = {}
+    for workitem_id, filename, doc_type in rows:
+        if workitem_id not in indexed:
+            continue
+        if workitem_id not in texts:
+            texts = {workitem_id: store.source_texts(workitem_id)}
+        text = texts[workitem_id].get(filename)
+        if text:
+            samples.append((text, filename, doc_type))
+    log.info("%d of %d labelled attachments have indexed text", len(samples), len(rows),
+             extra={'samples': len(samples), 'attachments': len(rows)})
+    return samples
+
+
+def read_jsonl(path):
+    """Samples from a JSON-lines file of {"text": ..., "filename": ..., "doc_type": ...}."""
+    samples = []
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                entry = json.loads(line)
+                samples.append((entry.get('text') or '', entry.get('filename'), entry['doc_type']))
+    return samples
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train or evaluate the local document type classifier.")
+    parser.add_argument('command', choices=['train', 'evaluate'])
+    parser.add_argument('--from-jsonl', help="labelled samples instead of the attachments table")
+    parser.add_argument('--output', default=DOC_CLASSIFIER_PATH)
+    parser.add_argument('--min-samples', type=int, default=50)
+    args = parser.parse_args()
+    import telemetry
+    telemetry.configure_logging()
+
+    if args.from_jsonl:
+        samples = read_jsonl(args.from_jsonl)
+    else:
+        import database
+        db = database.SessionLocal()
+        try:
+            samples = labelled_attachments(db)
+        finally:
+            db.close()
+
+    if args.command == 'evaluate':
+        print(json.dumps(evaluate(get_classifier(), samples), indent=2))
+        sys.exit(0)
+    if len(samples) < args.min_samples:
+        print(f"Only {len(samples)} labelled samples, need at least {args.min_samples}; keeping the current model.")
+        sys.exit(1)
+    model, report = train(samples)
+    save(model, args.output)
+    print(f"Trained on {len(samples)} samples ({len(model.vocabulary)} features) -> {args.output}")
+    print(json.dumps(report, indent=2))
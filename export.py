@@ -0,0 +1,113 @@
+import io
+import csv
+import json
+import datetime
+from sqlalchemy import select, or_
+
+import models
+import schemas
+import database
+import rollups
+
+EXPORT_BATCH_SIZE = 1000
+
+BASE_COLUMNS = ['id', 'message_id', 'status', 'tag', 'created_at', 'email_subject']
+
+# Dotted paths of the FNOL field set (schemas.ExtractedFields), used as CSV
+# columns when extracted_fields is flattened. List values are written as JSON.
+EXTRACTED_FIELD_COLUMNS = schemas.ExtractedFields.field_paths()
+
+
+def flatten_fields(value, prefix=''):
+    """Flattens nested dicts into dotted keys; lists are kept as values."""
+    flat = {}
+    if isinstance(value, dict):
+        for key, inner in value.items():
+            flat.update(flatten_fields(inner, f"{prefix}{key}."))
+    elif prefix:
+        flat[prefix[:-1]] = value
+    return flat
+
+
+def iter_workitems(since=None, after_id=None, status=None, include_body=False, batch_size=EXPORT_BATCH_SIZE):
+    """
+    Streams work items in id order through a server-side cursor, so memory use
+    does not depend on table size. Opens its own session because the rows are
+    consumed while the response is being sent. Work items still 'queued' or
+    'processing' (claim placeholders without their fields yet) are left out
+    unless asked for with `status`.
+    """
+    table = models.FNOLWorkItem
+    columns = [getattr(table, name) for name in BASE_COLUMNS] + [table.extracted_fields]
+    if include_body:
+        columns.append(table.email_body)
+    query = select(*columns).order_by(table.id)
+    if since is not None:
+        query = query.where(table.created_at >= since)
+    if after_id is not None:
+        query = query.where(table.id > after_id)
+    if status:
+        query = query.where(table.status == status)
+    else:
+        query = query.where(or_(table.status.is_(None), table.status.notin_(rollups.TRANSIENT_STATUSES)))
+
+    db = database.SessionLocal()
+    try:
+        result = db.execute(query.execution_options(yield_per=batch_size))
+        for row in result:
+            yield row._asdict()
+    finally:
+        db.close()
+
+
+def _json_default(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    return str(value)
+
+
+def ndjson_lines(rows, flatten=False):
+    for row in rows:
+        if flatten:
+            row.update({
+                f"extracted_fields.{key}": value
+                for key, value in flatten_fields(row.pop('extracted_fields') or {}).items()
+            })
+        yield json.dumps(row, default=_json_default) + '\n'
+
+
+def csv_lines(rows, flatten=False, include_body=False):
+    columns = list(BASE_COLUMNS)
+    if include_body:
+        columns.append('email_body')
+    if flatten:
+        columns += [f"extracted_fields.{path}" for path in EXTRACTED_FIELD_COLUMNS]
+    else:
+        columns.append('extracted_fields')
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def line(values):
+        writer.writerow(values)
+        data = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate(0)
+        return data
+
+    yield line(columns)
+    for row in rows:
+        extracted = row.pop('extracted_fields') or {}
+        if flatten:
+            row.update({f"extracted_fields.{key}": value for key, value in flatten_fields(extracted).items()})
+        else:
+            row['extracted_fields'] = extracted
+        values = []
+        for column in columns:
+            value = row.get(column)
+            if isinstance(value, (dict, list)):
+                value = json.dumps(value, default=_json_default)
+            elif isinstance(value, datetime.datetime):
+                value = value.isoformat()
+            values.append('' if value is None else value)
+        yield line(values)
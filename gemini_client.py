@@ -0,0 +1,296 @@
+import os
+import json
+import asyncio
+import time
+import random
+import logging
+import threading
+import email.utils
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from dotenv import load_dotenv
+
+import providers
+
+load_dotenv()
+
+GEMINI_API_URL = os.getenv("GEMINI_API_URL")
+GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+
+GEMINI_POOL_SIZE = int(os.getenv("GEMINI_POOL_SIZE", "10"))
+GEMINI_CONNECT_TIMEOUT = float(os.getenv("GEMINI_CONNECT_TIMEOUT", "5"))
+GEMINI_READ_TIMEOUT = float(os.getenv("GEMINI_READ_TIMEOUT", "300"))
+GEMINI_MAX_RETRIES = int(os.getenv("GEMINI_MAX_RETRIES", "4"))
+GEMINI_BACKOFF_BASE = float(os.getenv("GEMINI_BACKOFF_BASE", "0.5"))
+GEMINI_BACKOFF_MAX = float(os.getenv("GEMINI_BACKOFF_MAX", "30"))
+# Client-side rate limit per model, in requests per second (0 disables it)
+GEMINI_RATE_LIMIT = float(os.getenv("GEMINI_RATE_LIMIT", "0"))
+GEMINI_RATE_BURST = int(os.getenv("GEMINI_RATE_BURST", "10"))
+GEMINI_BREAKER_THRESHOLD = int(os.getenv("GEMINI_BREAKER_THRESHOLD", "5"))
+GEMINI_BREAKER_COOLDOWN = float(os.getenv("GEMINI_BREAKER_COOLDOWN", "30"))
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+log = logging.getLogger('fnol.gemini')
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class TokenBucket:
+    """Blocking token bucket: `rate` tokens per second, up to `burst` stored."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """Takes a token, returning how long the caller must wait before using it."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait:
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        wait = self.reserve()
+        if wait:
+            await asyncio.sleep(wait)
+
+
+class CircuitBreaker:
+    """
+    Opens after `threshold` consecutive failed calls (a call counts once,
+    however often it was retried) and rejects calls for `cooldown` seconds,
+    then lets a single trial call through (half-open).
+    """
+
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+        self.lock = threading.Lock()
+
+    def before_call(self):
+        with self.lock:
+            if self.opened_at is None:
+                return
+            if time.monotonic() - self.opened_at < self.cooldown or self.trial_in_flight:
+                raise CircuitOpenError("Gemini circuit breaker is open")
+            self.trial_in_flight = True
+
+    def record(self, success):
+        """Records a call's outcome; None (e.g. the caller was cancelled) only frees the trial slot."""
+        with self.lock:
+            self.trial_in_flight = False
+            if success is None:
+                return
+            if success:
+                self.failures = 0
+                self.opened_at = None
+                return
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+
+    @property
+    def state(self):
+        with self.lock:
+            if self.opened_at is None:
+                return 'closed'
+            return 'half-open' if time.monotonic() - self.opened_at >= self.cooldown else 'open'
+
+
+def _retry_after_seconds(response):
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class GeminiClient:
+    """
+    Shared HTTP client for the Gemini generateContent API: a pooled keep-alive
+    session, a per-model token bucket, jittered exponential retries on
+    connection errors and 429/5xx (honouring Retry-After) and a circuit breaker.
+    """
+
+    def __init__(self, api_url=None, api_key=None, pool_size=GEMINI_POOL_SIZE,
+                 connect_timeout=GEMINI_CONNECT_TIMEOUT, read_timeout=GEMINI_READ_TIMEOUT,
+                 max_retries=GEMINI_MAX_RETRIES, backoff_base=GEMINI_BACKOFF_BASE,
+                 backoff_max=GEMINI_BACKOFF_MAX, rate_limit=GEMINI_RATE_LIMIT,
+                 rate_burst=GEMINI_RATE_BURST, breaker_threshold=GEMINI_BREAKER_THRESHOLD,
+                 breaker_cooldown=GEMINI_BREAKER_COOLDOWN):
+        self.api_url = api_url or GEMINI_API_URL
+        self.api_key = api_key or GEMINI_API_KEY
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.rate_limit = rate_limit
+        self.rate_burst = rate_burst
+        self.breaker = CircuitBreaker(breaker_threshold, breaker_cooldown)
+        self._buckets = {}
+        self._buckets_lock = threading.Lock()
+        self.session = self._make_session(pool_size)
+
+    def _make_session(self, pool_size):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def _bucket(self, model):
+        if self.rate_limit <= 0:
+            return None
+        with self._buckets_lock:
+            bucket = self._buckets.get(model)
+            if bucket is None:
+                bucket = TokenBucket(self.rate_limit, self.rate_burst)
+                self._buckets[model] = bucket
+            return bucket
+
+    def _backoff_delay(self, attempt, retry_after=None):
+        delay = min(self.backoff_max, self.backoff_base * (2 ** attempt))
+        delay = random.uniform(delay / 2, delay)
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.backoff_max))
+        return delay
+
+    def _request_parts(self, payload):
+        url = f"{self.api_url}:generateContent"
+        # Key goes in a header rather than the query string so it stays out of error messages
+        headers = {"Content-Type": "application/json", "x-goog-api-key": self.api_key}
+        return url, headers, json.dumps(payload), self._bucket(payload.get("model"))
+
+    def _send(self, url, headers, body, bucket):
+        """POSTs, retrying connection errors and 429/5xx; returns the last response."""
+        for attempt in range(self.max_retries + 1):
+            if bucket is not None:
+                bucket.acquire()
+            last_attempt = attempt == self.max_retries
+            try:
+                response = self.session.post(url, headers=headers, data=body, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if last_attempt:
+                    raise
+                log.warning("Gemini request failed (%s), retrying (attempt %s/%s)", e, attempt + 1, self.max_retries,
+                            extra={'attempt': attempt + 1})
+                time.sleep(self._backoff_delay(attempt))
+                continue
+            if response.status_code in RETRY_STATUS_CODES and not last_attempt:
+                log.warning("Gemini returned %s, retrying (attempt %s/%s)", response.status_code, attempt + 1,
+                            self.max_retries, extra={'status': response.status_code, 'attempt': attempt + 1})
+                time.sleep(self._backoff_delay(attempt, _retry_after_seconds(response)))
+                continue
+            return response
+
+    def generate_content(self, payload):
+        """POSTs a generateContent payload and returns the decoded JSON response."""
+        url, headers, body, bucket = self._request_parts(payload)
+        self.breaker.before_call()
+        success = None
+        try:
+            response = self._send(url, headers, body, bucket)
+            if response.status_code in RETRY_STATUS_CODES:
+                response.raise_for_status()
+            # Other 4xx are caller errors, not backend failures
+            success = True
+            response.raise_for_status()
+            return response.json()
+        except Exception:
+            if success is None:
+                success = False
+            raise
+        finally:
+            # Always recorded, so a half-open trial never stays in flight
+            self.breaker.record(success)
+
+
+class AsyncGeminiClient(GeminiClient):
+    """GeminiClient on top of a pooled httpx.AsyncClient, for the async API path."""
+
+    def _make_session(self, pool_size):
+        limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+        timeout = httpx.Timeout(self.timeout[1], connect=self.timeout[0])
+        return httpx.AsyncClient(limits=limits, timeout=timeout)
+
+    async def _send(self, url, headers, body, bucket):
+        for attempt in range(self.max_retries + 1):
+            if bucket is not None:
+                await bucket.acquire_async()
+            last_attempt = attempt == self.max_retries
+            try:
+                response = await self.session.post(url, headers=headers, content=body)
+            except (httpx.TransportError, httpx.TimeoutException) as e:
+                if last_attempt:
+                    raise
+                log.warning("Gemini request failed (%s), retrying (attempt %s/%s)", e, attempt + 1, self.max_retries,
+                            extra={'attempt': attempt + 1})
+                await asyncio.sleep(self._backoff_delay(attempt))
+                continue
+            if response.status_code in RETRY_STATUS_CODES and not last_attempt:
+                log.warning("Gemini returned %s, retrying (attempt %s/%s)", response.status_code, attempt + 1,
+                            self.max_retries, extra={'status': response.status_code, 'attempt': attempt + 1})
+                await asyncio.sleep(self._backoff_delay(attempt, _retry_after_seconds(response)))
+                continue
+            return response
+
+    async def generate_content(self, payload):
+        url, headers, body, bucket = self._request_parts(payload)
+        self.breaker.before_call()
+        success = None
+        try:
+            response = await self._send(url, headers, body, bucket)
+            if response.status_code in RETRY_STATUS_CODES:
+                response.raise_for_status()
+            success = True
+            response.raise_for_status()
+            return response.json()
+        except Exception:
+            if success is None:
+                success = False
+            raise
+        finally:
+            self.breaker.record(success)
+
+    async def aclose(self):
+        await self.session.aclose()
+
+
+# One pooled session per process; a forked worker opens its own
+client_provider = providers.ClientProvider('gemini', GeminiClient)
+# The httpx pool belongs to the parent's event loop, so a forked worker builds its own
+async_client_provider = providers.ClientProvider('gemini_async', AsyncGeminiClient,
+                                                 close=lambda client: client.aclose())
+
+
+def get_client():
+    """Returns the process-wide GeminiClient, creating it on first use."""
+    return client_provider.get()
+
+
+def get_async_client():
+    """Returns the process-wide AsyncGeminiClient, creating it on first use."""
+    return async_client_provider.get()
@@ -0,0 +1,175 @@
+import io
+import os
+import hashlib
+import mimetypes
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Per-request intake limits, applied to both the JSON and multipart intake
+FNOL_MAX_ATTACHMENT_BYTES = int(os.getenv('FNOL_MAX_ATTACHMENT_BYTES', str(25 * 1024 * 1024)))
+FNOL_MAX_REQUEST_BYTES = int(os.getenv('FNOL_MAX_REQUEST_BYTES', str(60 * 1024 * 1024)))
+FNOL_MAX_ATTACHMENTS = int(os.getenv('FNOL_MAX_ATTACHMENTS', '50'))
+# Attachments up to this size are held in memory, larger ones are read from their spool file
+FNOL_SPOOL_MEMORY_BYTES = int(os.getenv('FNOL_SPOOL_MEMORY_BYTES', str(1024 * 1024)))
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class AttachmentTooLarge(Exception):
+    pass
+
+
+class SpooledAttachment:
+    """
+    A multipart attachment, read where the form parser already spooled it
+    (memory, or a temp file past its limit) and hashed in one pass. Every
+    consumer (OCR, blob upload) gets its own handle via open(), so they can
+    stream it concurrently without loading it into memory or copying it.
+    """
+
+    def __init__(self, filename, mime_type=None):
+        self.filename = filename
+        # Same rule as the JSON intake: trust the extension, then the declared type
+        self.mime_type = mimetypes.guess_type(filename)[0] or mime_type
+        self.size = 0
+        self.sha256 = None
+        self._file = None
+        self._data = None
+
+    @classmethod
+    def from_upload(cls, upload, max_bytes=None):
+        """Wraps a starlette UploadFile. Raises AttachmentTooLarge."""
+        max_bytes = max_bytes or FNOL_MAX_ATTACHMENT_BYTES
+        spooled = cls(upload.filename, upload.content_type)
+        digest = hashlib.sha256()
+        stream = upload.file
+        stream.seek(0)
+        while True:
+            chunk = stream.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            spooled.size += len(chunk)
+            if spooled.size > max_bytes:
+                raise AttachmentTooLarge(f"Attachment '{upload.filename}' exceeds {max_bytes} bytes")
+            digest.update(chunk)
+        spooled.sha256 = digest.hexdigest()
+        if spooled.size <= FNOL_SPOOL_MEMORY_BYTES:
+            stream.seek(0)
+            spooled._data = stream.read()
+        else:
+            # fileno() moves a still in-memory spool to disk; positional reads
+            # then give each consumer its own offset into the one file
+            spooled._file = stream
+        return spooled
+
+    def open(self):
+        """Returns a new independent binary stream over the content."""
+        if self._file is not None:
+            return io.BufferedReader(_PositionalReader(self._file.fileno(), self.size), CHUNK_SIZE)
+        return io.BytesIO(self._data)
+
+    def close(self):
+        # The upload's own file is closed by the framework with the request
+        self._file = None
+        self._data = None
+
+
+class _PositionalReader(io.RawIOBase):
+    """Read-only view of a file descriptor with its own offset (os.pread)."""
+
+    def __init__(self, fd, size):
+        self._fd = fd
+        self._size = size
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        n = min(len(buffer), self._size - self._pos)
+        if n <= 0:
+            return 0
+        data = os.pread(self._fd, n, self._pos)
+        buffer[:len(data)] = data
+        self._pos += len(data)
+        return len(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self._size
+        self._pos = max(0, offset)
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+
+class MultipartSizeLimit:
+    """
+    ASGI middleware capping multipart request bodies at FNOL_MAX_REQUEST_BYTES.
+    An oversized Content-Length is answered with 413 before the form parser
+    reads anything; a chunked or understated body is cut off with 413 as soon
+    as the bytes received pass the limit, before it is all spooled.
+    """
+
+    def __init__(self, app, max_bytes=None):
+        self.app = app
+        self.max_bytes = max_bytes or FNOL_MAX_REQUEST_BYTES
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        headers = dict(scope['headers'])
+        if not headers.get(b'content-type', b'').startswith(b'multipart/'):
+            return await self.app(scope, receive, send)
+        from fastapi import HTTPException
+        from fastapi.responses import JSONResponse
+        detail = f"Request exceeds {self.max_bytes} bytes"
+        content_length = headers.get(b'content-length', b'')
+        if content_length.isdigit() and int(content_length) > self.max_bytes:
+            response = JSONResponse({'detail': detail}, status_code=413, headers={'Connection': 'close'})
+            return await response(scope, receive, send)
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message['type'] == 'http.request':
+                received += len(message.get('body', b''))
+                if received > self.max_bytes:
+                    # Re-raised by the route's body parsing and rendered as 413
+                    raise HTTPException(status_code=413, detail=detail)
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+
+def base64_decoded_size(content):
+    """Decoded size of a base64 string, without decoding it."""
+    return len(content) * 3 // 4 - content[-2:].count('=')
+
+
+def check_base64_attachments(attachments):
+    """
+    Enforces the intake limits on JSON (base64) attachments before decoding.
+    Raises AttachmentTooLarge.
+    """
+    attachments = attachments or []
+    if len(attachments) > FNOL_MAX_ATTACHMENTS:
+        raise AttachmentTooLarge(f"At most {FNOL_MAX_ATTACHMENTS} attachments are accepted")
+    total = 0
+    for att in attachments:
+        content = att.get('contentBytes') or att.get('content') or ''
+        size = base64_decoded_size(content)
+        if size > FNOL_MAX_ATTACHMENT_BYTES:
+            filename = att.get('filename') or att.get('name')
+            raise AttachmentTooLarge(f"Attachment '{filename}' exceeds {FNOL_MAX_ATTACHMENT_BYTES} bytes")
+        total += size
+    if total > FNOL_MAX_REQUEST_BYTES:
+        raise AttachmentTooLarge(f"Attachments exceed {FNOL_MAX_REQUEST_BYTES} bytes in total")
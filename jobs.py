@@ -0,0 +1,197 @@
+import os
+import queue
+import logging
+import threading
+import datetime
+from dotenv import load_dotenv
+
+import models
+import schemas
+import database
+import pipeline
+import telemetry
+
+load_dotenv()
+
+log = logging.getLogger('fnol.jobs')
+
+# 'postgres' claims jobs with SELECT ... FOR UPDATE SKIP LOCKED, so several app
+# instances can share the queue; 'memory' dispatches job ids through an
+# in-process queue (single instance / tests).
+FNOL_JOB_BACKEND = os.getenv('FNOL_JOB_BACKEND', 'postgres')
+FNOL_WORKER_CONCURRENCY = int(os.getenv('FNOL_WORKER_CONCURRENCY', '4'))
+FNOL_JOB_QUEUE_MAXSIZE = int(os.getenv('FNOL_JOB_QUEUE_MAXSIZE', '1000'))
+FNOL_JOB_MAX_ATTEMPTS = int(os.getenv('FNOL_JOB_MAX_ATTEMPTS', '3'))
+FNOL_JOB_POLL_INTERVAL = float(os.getenv('FNOL_JOB_POLL_INTERVAL', '1.0'))
+
+
+class QueueFull(Exception):
+    pass
+
+
+_memory_queue = queue.Queue(maxsize=FNOL_JOB_QUEUE_MAXSIZE)
+_stop_event = threading.Event()
+_workers = []
+
+
+def enqueue(db, item: schemas.FNOLWorkItemCreate):
+    """
+    Stores the raw email as a 'queued' work item plus an intake job and hands it
+    to the worker pool. Raises QueueFull when the queue is at capacity.
+    Returns None, queueing nothing, when the email's message_id already has a
+    work item.
+    """
+    if FNOL_JOB_BACKEND == 'memory':
+        if _memory_queue.full():
+            raise QueueFull()
+    else:
+        queued = db.query(models.IntakeJob).filter(models.IntakeJob.status == 'queued').count()
+        if queued >= FNOL_JOB_QUEUE_MAXSIZE:
+            raise QueueFull()
+
+    if item.message_id:
+        claimed = pipeline.claim_rows(db, [item], status='queued')
+        if not claimed:
+            db.rollback()
+            return None
+        db_item = db.get(models.FNOLWorkItem, claimed[item.message_id])
+    else:
+        db_item = models.FNOLWorkItem(
+            message_id=item.message_id,
+            email_subject=item.subject,
+            email_body=item.body,
+            status='queued'
+        )
+        db.add(db_item)
+    job = models.IntakeJob(workitem=db_item, payload=item.model_dump(), status='queued')
+    db.add(job)
+    db.commit()
+    db.refresh(job)
+
+    if FNOL_JOB_BACKEND == 'memory':
+        try:
+            _memory_queue.put_nowait(job.id)
+        except queue.Full:
+            # Lost the race for the last slot. Nothing would run the job until
+            # a restart, so it is dropped with its work item: the caller gets
+            # QueueFull and a redelivery of the email can claim it again.
+            db.delete(job)
+            db.delete(db_item)
+            db.commit()
+            raise QueueFull()
+    # Logged under the request's trace id; the worker then runs it as trace job-<id>
+    log.info("Queued intake job %s for workitem_id=%s", job.id, job.workitem_id,
+             extra={'job_id': job.id, 'workitem_id': job.workitem_id, 'job_trace_id': f"job-{job.id}"})
+    return job
+
+
+def _claim_next_job(db):
+    if FNOL_JOB_BACKEND == 'memory':
+        try:
+            job_id = _memory_queue.get(timeout=FNOL_JOB_POLL_INTERVAL)
+        except queue.Empty:
+            return None
+        job = db.query(models.IntakeJob).filter(
+            models.IntakeJob.id == job_id,
+            models.IntakeJob.status == 'queued'
+        ).first()
+    else:
+        job = (
+            db.query(models.IntakeJob)
+            .filter(models.IntakeJob.status == 'queued')
+            .order_by(models.IntakeJob.id)
+            .with_for_update(skip_locked=True)
+            .first()
+        )
+    if job is None:
+        db.rollback()
+        return None
+    job.status = 'processing'
+    job.attempts += 1
+    job.started_at = datetime.datetime.utcnow()
+    job.workitem.status = 'processing'
+    db.commit()
+    return job
+
+
+def run_job(db, job):
+    """Runs the FNOL pipeline for a claimed job and records the outcome."""
+    try:
+        item = schemas.FNOLWorkItemCreate(**job.payload)
+        pipeline.process_fnol(db, item, db_item=job.workitem, attempt=job.attempts)
+        job.status = 'done'
+        job.last_error = None
+        job.finished_at = datetime.datetime.utcnow()
+        db.commit()
+        log.info("Intake job %s done for workitem_id=%s", job.id, job.workitem_id,
+                 extra={'job_id': job.id, 'workitem_id': job.workitem_id, 'attempts': job.attempts})
+    except Exception as e:
+        log.exception("Intake job %s failed", job.id,
+                      extra={'job_id': job.id, 'workitem_id': job.workitem_id, 'attempts': job.attempts})
+        db.rollback()
+        job.last_error = str(e)
+        if job.attempts >= FNOL_JOB_MAX_ATTEMPTS:
+            job.status = 'failed'
+            job.finished_at = datetime.datetime.utcnow()
+            job.workitem.status = 'failed'
+        else:
+            job.status = 'queued'
+            job.workitem.status = 'queued'
+        db.commit()
+        if job.status == 'queued' and FNOL_JOB_BACKEND == 'memory':
+            _memory_queue.put(job.id)
+
+
+def _worker_loop():
+    while not _stop_event.is_set():
+        db = database.SessionLocal()
+        try:
+            job = _claim_next_job(db)
+            if job is None:
+                if FNOL_JOB_BACKEND != 'memory':
+                    _stop_event.wait(FNOL_JOB_POLL_INTERVAL)
+                continue
+            with telemetry.trace(f"job-{job.id}"):
+                run_job(db, job)
+        except Exception:
+            log.exception("Intake worker error")
+            db.rollback()
+            _stop_event.wait(FNOL_JOB_POLL_INTERVAL)
+        finally:
+            db.close()
+
+
+def requeue_pending():
+    """Puts jobs left 'queued' in the database back on the in-process queue."""
+    if FNOL_JOB_BACKEND != 'memory':
+        return
+    db = database.SessionLocal()
+    try:
+        for (job_id,) in db.query(models.IntakeJob.id).filter(models.IntakeJob.status == 'queued').order_by(models.IntakeJob.id):
+            try:
+                _memory_queue.put_nowait(job_id)
+            except queue.Full:
+                break
+    finally:
+        db.close()
+
+
+def start_workers(concurrency=None):
+    concurrency = concurrency or FNOL_WORKER_CONCURRENCY
+    if _workers:
+        return
+    _stop_event.clear()
+    requeue_pending()
+    for i in range(concurrency):
+        worker = threading.Thread(target=_worker_loop, name=f"fnol-intake-worker-{i}", daemon=True)
+        worker.start()
+        _workers.append(worker)
+    log.info("Started %d FNOL intake workers (backend=%s)", concurrency, FNOL_JOB_BACKEND,
+             extra={'workers': concurrency, 'backend': FNOL_JOB_BACKEND})
+
+
+def stop_workers(timeout=10):
+    _stop_event.set()
+    for worker in _workers:
+        worker.join(timeout=timeout)
+    _workers.clear()
@@ -1,36 +1,202 @@
 
 import os
-import requests
+import copy
+import logging
+import asyncio
+import time
+import threading
 import json
+import re
 from dotenv import load_dotenv
+from pydantic import ValidationError
+
+import cache
+import gemini_client
+import prompt_budget
+import schemas
+import telemetry
 
 
 load_dotenv()
 
-GEMINI_API_URL = os.getenv("GEMINI_API_URL")
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+log = logging.getLogger('fnol.llm')
+
 GEMINI_MODEL = os.getenv("GEMINI_MODEL")
+# 'json_schema' has Gemini answer field extraction prompts in JSON matching
+# schemas.ExtractedFields (responseSchema); 'text' leaves the format to the prompt.
+# Either way the answer is validated against the schema.
+LLM_RESPONSE_FORMAT = os.getenv("LLM_RESPONSE_FORMAT", "json_schema")
+# Re-ask once for just the fields that failed validation
+LLM_FIELD_RETRY = os.getenv("LLM_FIELD_RETRY", "true").lower() == "true"
 
+# Responses keyed by SHA-256 of model + prompt. Only responses that parsed
+# successfully are cached, so a malformed answer is retried next time.
+llm_cache = cache.TieredCache(
+    'llm',
+    max_memory_bytes=int(os.getenv('LLM_CACHE_MEMORY_BYTES', str(32 * 1024 * 1024))),
+    ttl_seconds=int(os.getenv('LLM_CACHE_TTL_SECONDS', str(7 * 24 * 3600))),
+    max_persistent_entries=int(os.getenv('LLM_CACHE_MAX_ENTRIES', '200000')),
+)
+_inflight = cache.SingleFlight()
+_inflight_async = cache.AsyncSingleFlight()
+_stats_lock = threading.Lock()
+_stats = {
+    'calls': 0,
+    'cache_hits': 0,
+    'coalesced': 0,
+    'tokens_used': 0,
+    'tokens_saved': 0,
+    'seconds_spent': 0.0,
+    'seconds_saved': 0.0,
+    'prompt_tokens_saved': 0,
+    'map_reduce_extractions': 0,
+    'invalid_fields': 0,
+    'field_retries': 0,
+}
 
-def extract_fields_from_email(email_subject, email_body, attachment_text=None):
+
+def _record(**deltas):
+    with _stats_lock:
+        for name, delta in deltas.items():
+            _stats[name] += delta
+
+
+def stats():
+    """Gemini call counts plus the tokens and latency saved by cache hits, coalescing and prompt budgeting."""
+    with _stats_lock:
+        return dict(_stats)
+
+
+def _payload(prompt, response_schema=None):
+    payload = {
+        "model": GEMINI_MODEL,
+        "contents": [{"role": "user", "parts": [{"text": prompt}]}]
+    }
+    if response_schema is not None:
+        payload["generationConfig"] = {"responseMimeType": "application/json", "responseSchema": response_schema}
+    return payload
+
+
+def _call_gemini(prompt, response_schema=None):
+    return gemini_client.get_client().generate_content(_payload(prompt, response_schema))
+
+
+def _cache_key(prompt, response_schema=None):
+    if response_schema is None:
+        return cache.hash_key(GEMINI_MODEL, prompt)
+    return cache.hash_key(GEMINI_MODEL, prompt, json.dumps(response_schema, sort_keys=True))
+
+
+def _from_cache(cached, parse):
+    _record(cache_hits=1, tokens_saved=cached['tokens'], seconds_saved=cached['seconds'])
+    return parse(cached['text'])
+
+
+def _parse_result(result, elapsed, parse):
+    """Parses a raw Gemini response; returns (parsed, cache_value)."""
+    tokens = result.get("usageMetadata", {}).get("totalTokenCount", 0)
+    _record(calls=1, tokens_used=tokens, seconds_spent=elapsed)
+    try:
+        text = result["candidates"][0]["content"]["parts"][0]["text"]
+        parsed = parse(text)
+    except Exception as e:
+        e.llm_response = result
+        raise
+    return parsed, {"text": text, "tokens": tokens, "seconds": elapsed}
+
+
+def _from_shared_call(parsed, cache_value):
+    _record(coalesced=1, tokens_saved=cache_value['tokens'], seconds_saved=cache_value['seconds'])
+    return copy.deepcopy(parsed)
+
+
+def _generate(prompt, parse, response_schema=None):
     """
-    Calls the LLM to extract all required FNOL fields from the provided email subject, body, and attachment text.
-    Returns a nested dict matching the required schema.
+    Sends the prompt to Gemini and returns parse(response_text), asking for
+    JSON matching response_schema when one is given.
+    Identical prompts are answered from llm_cache, and concurrent identical
+    prompts share a single in-flight request. Errors raised by the call or by
+    parse carry the raw response as `llm_response` when there is one.
     """
-    # Combine all text sources for extraction
-    combined_text = email_subject + "\n" + email_body
-    if attachment_text:
-        if isinstance(attachment_text, list):
-            combined_text += "\n" + "\n".join(attachment_text)
-        else:
-            combined_text += "\n" + str(attachment_text)
+    key = _cache_key(prompt, response_schema)
+    cached = llm_cache.get(key)
+    if cached is not None:
+        return _from_cache(cached, parse)
 
-    # --- LLM PROMPT TEMPLATE ---
-    prompt = f'''
-You are an expert insurance claims assistant. Extract the following fields and subfields from the provided email subject, body, and attachment text. Return the result as a JSON object matching this structure:
+    def call():
+        start = time.perf_counter()
+        with telemetry.span('gemini'):
+            result = _call_gemini(prompt, response_schema)
+        parsed, cache_value = _parse_result(result, time.perf_counter() - start, parse)
+        llm_cache.set(key, cache_value)
+        return parsed, cache_value
 
-<FIELDS>
-summary: str
+    (parsed, cache_value), shared = _inflight.do(key, call)
+    return _from_shared_call(parsed, cache_value) if shared else parsed
+
+
+async def _generate_async(prompt, parse, response_schema=None):
+    """Async variant of _generate, using the async Gemini client."""
+    key = _cache_key(prompt, response_schema)
+    cached = await asyncio.to_thread(llm_cache.get, key)
+    if cached is not None:
+        return _from_cache(cached, parse)
+
+    async def call():
+        start = time.perf_counter()
+        with telemetry.span('gemini'):
+            result = await gemini_client.get_async_client().generate_content(_payload(prompt, response_schema))
+        parsed, cache_value = _parse_result(result, time.perf_counter() - start, parse)
+        await asyncio.to_thread(llm_cache.set, key, cache_value)
+        return parsed, cache_value
+
+    (parsed, cache_value), shared = await _inflight_async.do(key, call)
+    return _from_shared_call(parsed, cache_value) if shared else parsed
+
+
+def _parse_json_response(text):
+    # Remove Markdown code block if present
+    if text.strip().startswith('```'):
+        text = text.strip()
+        # Remove the first line (```json or ```) and the last line (```)
+        lines = text.splitlines()
+        if lines[0].startswith('```'):
+            lines = lines[1:]
+        if lines and lines[-1].startswith('```'):
+            lines = lines[:-1]
+        text = '\n'.join(lines)
+    # Try to parse the JSON object from the LLM response
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        repaired = _repair_json(text)
+        if repaired is None:
+            raise
+        return repaired
+
+
+_TRAILING_COMMA = re.compile(r',\s*([}\]])')
+
+
+def _repair_json(text):
+    """
+    Retries a malformed answer with the prose around the outermost JSON value
+    cut off and trailing commas removed; None if that does not parse either.
+    """
+    starts = [i for i in (text.find('{'), text.find('[')) if i >= 0]
+    if not starts:
+        return None
+    start = min(starts)
+    end = text.rfind('}' if text[start] == '{' else ']')
+    if end < start:
+        return None
+    try:
+        return json.loads(_TRAILING_COMMA.sub(r'\1', text[start:end + 1]))
+    except json.JSONDecodeError:
+        return None
+
+
+_FIELD_LINES = """summary: str
 intent: dict (with keys: intent_type: str, confidence_score: float)
 reported_by_and_main_contact_are_same: bool
 claim_type: dict (category: str, sub_category: str)
@@ -47,7 +213,16 @@ loss: dict (loss_date: str, loss_time: str, loss_type: str, cause_of_loss: str,
 matter: str
 acknowledgment: dict (recipient_name: str, recipient_role: str, delivery_method: str, acknowledgment_sent: bool)
 lawsuit_or_complaint_received: bool
-</FIELDS>
+"""
+
+
+def _extract_fields_prompt(email_subject, email_body, attachment_text=None):
+    # --- LLM PROMPT TEMPLATE ---
+    prompt = f'''
+You are an expert insurance claims assistant. Extract the following fields and subfields from the provided email subject, body, and attachment text. Return the result as a JSON object matching this structure:
+
+<FIELDS>
+{_FIELD_LINES}</FIELDS>
 
 If a field is not present, use null or an empty string/list as appropriate. Only use the information in the provided text.
 
@@ -56,44 +231,265 @@ Email Body: {email_body}
 Attachment Text: {attachment_text if attachment_text else ''}
 Return only the JSON object.
 '''
+    return prompt
 
-    # Call Gemini LLM API
-    headers = {
-        "Content-Type": "application/json",
-    }
-    url = f"{GEMINI_API_URL}:generateContent?key={GEMINI_API_KEY}"
-    payload = {
-        "model": GEMINI_MODEL,
-        "contents": [
-            {"role": "user", "parts": [{"text": prompt}]}
-        ]
+
+def _extraction_plan(email_subject, email_body, attachment_text):
+    plan = prompt_budget.plan(email_subject, email_body, attachment_text)
+    if plan.strategy != 'full':
+        log.info("Attachment text for extraction: ~%d tokens -> ~%d in %d prompt(s) (%s)",
+                 plan.original_tokens, plan.kept_tokens, len(plan.parts), plan.strategy,
+                 extra={'original_tokens': plan.original_tokens, 'kept_tokens': plan.kept_tokens,
+                        'prompts': len(plan.parts), 'strategy': plan.strategy})
+    _record(prompt_tokens_saved=plan.tokens_saved, map_reduce_extractions=int(plan.strategy == 'map_reduce'))
+    return plan
+
+
+def _gemini_schema(schema, defs):
+    """Converts a Pydantic JSON schema into the OpenAPI subset Gemini's responseSchema accepts."""
+    if '$ref' in schema:
+        return _gemini_schema(defs[schema['$ref'].rsplit('/', 1)[-1]], defs)
+    if 'anyOf' in schema:
+        options = [option for option in schema['anyOf'] if option.get('type') != 'null']
+        converted = _gemini_schema(options[0], defs)
+        converted['nullable'] = True
+        return converted
+    converted = {'type': schema['type'].upper()}
+    if schema['type'] == 'object':
+        converted['properties'] = {name: _gemini_schema(value, defs) for name, value in schema['properties'].items()}
+        # Gemini orders keys alphabetically unless told otherwise
+        converted['propertyOrdering'] = list(schema['properties'])
+    elif schema['type'] == 'array':
+        converted['items'] = _gemini_schema(schema['items'], defs)
+    return converted
+
+
+_fields_schema = None
+
+
+def _response_schema(sections=None):
+    """responseSchema for the FNOL field set, or for some of its top-level fields; None in 'text' mode."""
+    global _fields_schema
+    if LLM_RESPONSE_FORMAT != 'json_schema':
+        return None
+    if _fields_schema is None:
+        schema = schemas.ExtractedFields.model_json_schema()
+        _fields_schema = _gemini_schema(schema, schema.get('$defs', {}))
+    if sections is None:
+        return _fields_schema
+    return {
+        'type': 'OBJECT',
+        'properties': {name: _fields_schema['properties'][name] for name in sections},
+        'propertyOrdering': list(sections),
     }
+
+
+_INVALID = object()
+
+
+def _drop_invalid(data, loc):
+    parent = data
+    for key in loc[:-1]:
+        try:
+            parent = parent[key]
+        except (KeyError, IndexError, TypeError):
+            parent = None
+            break
+    last = loc[-1]
+    if isinstance(parent, dict) and last in parent:
+        del parent[last]
+    elif isinstance(parent, list) and isinstance(last, int) and last < len(parent):
+        parent[last] = _INVALID
+    else:
+        data.pop(loc[0], None)
+
+
+def _without_invalid(value):
+    if isinstance(value, dict):
+        return {key: _without_invalid(inner) for key, inner in value.items()}
+    if isinstance(value, list):
+        return [_without_invalid(inner) for inner in value if inner is not _INVALID]
+    return value
+
+
+def validate_fields(data):
+    """
+    Validates an extraction answer against schemas.ExtractedFields. Values
+    that do not fit (after Pydantic's coercions) are dropped and left empty,
+    so the rest of the answer is kept. Returns (fields, {dotted path: error}).
+    """
+    if not isinstance(data, dict):
+        raise ValueError(f"Expected a JSON object of fields, got {type(data).__name__}")
+    invalid = {}
+    for _ in range(len(schemas.ExtractedFields.field_paths())):
+        try:
+            return schemas.ExtractedFields.model_validate(data).model_dump(), invalid
+        except ValidationError as e:
+            data = copy.deepcopy(data)
+            for error in e.errors():
+                invalid['.'.join(str(part) for part in error['loc'])] = error['msg']
+                _drop_invalid(data, error['loc'])
+            data = _without_invalid(data)
+    return schemas.ExtractedFields().model_dump(), invalid
+
+
+def _parse_fields(text):
+    return validate_fields(_parse_json_response(text))
+
+
+def _field_retry_prompt(email_subject, email_body, attachment_text, invalid):
+    sections = _invalid_sections(invalid)
+    problems = "\n".join(f"- {path}: {message}" for path, message in invalid.items())
+    field_lines = "".join(line + "\n" for line in _FIELD_LINES.splitlines() if line.split(":")[0] in sections)
+    return f'''
+You are an expert insurance claims assistant. An earlier extraction from the email below returned values that did not match the expected types:
+{problems}
+
+Extract only the following fields again from the provided email subject, body, and attachment text. Return the result as a JSON object with only these keys, matching this structure:
+
+<FIELDS>
+{field_lines}</FIELDS>
+
+If a field is not present, use null or an empty string/list as appropriate. Only use the information in the provided text.
+
+Email Subject: {email_subject}
+Email Body: {email_body}
+Attachment Text: {attachment_text if attachment_text else ''}
+Return only the JSON object.
+'''
+
+
+def _invalid_sections(invalid):
+    return list(dict.fromkeys(path.split('.')[0] for path in invalid))
+
+
+def _merge_retried(fields, invalid, retried):
+    """Takes the retried values of the invalid fields' sections, keeping the first answer where the retry has none."""
+    retried, still_invalid = validate_fields(retried)
+    merged = dict(fields)
+    for section in _invalid_sections(invalid):
+        value = retried[section]
+        if isinstance(value, dict):
+            merged[section] = {key: fields[section].get(key) if inner is None else inner for key, inner in value.items()}
+        elif value is not None and value != []:
+            merged[section] = value
+    if still_invalid:
+        log.warning("Fields still invalid after retry, left empty: %s", ', '.join(still_invalid),
+                    extra={'invalid_fields': sorted(still_invalid)})
+    return merged
+
+
+def _extract_part(email_subject, email_body, attachment_text):
+    prompt = _extract_fields_prompt(email_subject, email_body, attachment_text)
     try:
-        response = requests.post(url, headers=headers, data=json.dumps(payload), timeout=300)
-        response.raise_for_status()
-        result = response.json()
-        # Gemini returns the text in a nested structure; extract JSON from the response
-        text = result["candidates"][0]["content"]["parts"][0]["text"]
-        # Remove Markdown code block if present
-        if text.strip().startswith('```'):
-            text = text.strip()
-            # Remove the first line (```json or ```) and the last line (```)
-            lines = text.splitlines()
-            if lines[0].startswith('```'):
-                lines = lines[1:]
-            if lines and lines[-1].startswith('```'):
-                lines = lines[:-1]
-            text = '\n'.join(lines)
-        # Try to parse the JSON object from the LLM response
-        extracted = json.loads(text)
-        return extracted
+        fields, invalid = _generate(prompt, _parse_fields, _response_schema())
     except Exception as e:
         # Fallback: return error info for debugging
-        return {"error": str(e), "llm_response": result if 'result' in locals() else None}
+        return {"error": str(e), "llm_response": getattr(e, 'llm_response', None)}
+    if not invalid:
+        return fields
+    log.warning("Invalid extracted fields: %s", invalid, extra={'invalid_fields': invalid})
+    _record(invalid_fields=len(invalid))
+    if not LLM_FIELD_RETRY:
+        return fields
+    _record(field_retries=1)
+    try:
+        retried = _generate(_field_retry_prompt(email_subject, email_body, attachment_text, invalid),
+                            _parse_json_response, _response_schema(_invalid_sections(invalid)))
+        return _merge_retried(fields, invalid, retried)
+    except Exception as e:
+        log.warning("Retrying the invalid fields failed, leaving them empty: %s", e, extra={'error': str(e)})
+        return fields
 
 
-def guess_doc_type(data: str):
-    prompt = f"""
+async def _extract_part_async(email_subject, email_body, attachment_text):
+    prompt = _extract_fields_prompt(email_subject, email_body, attachment_text)
+    try:
+        fields, invalid = await _generate_async(prompt, _parse_fields, _response_schema())
+    except Exception as e:
+        return {"error": str(e), "llm_response": getattr(e, 'llm_response', None)}
+    if not invalid:
+        return fields
+    log.warning("Invalid extracted fields: %s", invalid, extra={'invalid_fields': invalid})
+    _record(invalid_fields=len(invalid))
+    if not LLM_FIELD_RETRY:
+        return fields
+    _record(field_retries=1)
+    try:
+        retried = await _generate_async(_field_retry_prompt(email_subject, email_body, attachment_text, invalid),
+                                        _parse_json_response, _response_schema(_invalid_sections(invalid)))
+        return _merge_retried(fields, invalid, retried)
+    except Exception as e:
+        log.warning("Retrying the invalid fields failed, leaving them empty: %s", e, extra={'error': str(e)})
+        return fields
+
+
+def extract_fields_from_email(email_subject, email_body, attachment_text=None):
+    """
+    Calls the LLM to extract all required FNOL fields from the provided email subject, body, and attachment text.
+    Returns a nested dict with the shape of schemas.ExtractedFields; fields
+    whose values do not validate are asked for again once, on their own.
+    Attachment text over the prompt budget is deduplicated and trimmed to its
+    most relevant chunks, or, when far over, extracted in parts and merged.
+    """
+    plan = _extraction_plan(email_subject, email_body, attachment_text)
+    if len(plan.parts) <= 1:
+        return _extract_part(email_subject, email_body, plan.parts[0] if plan.parts else None)
+    return prompt_budget.merge_fields(_extract_parts(email_subject, email_body, plan.parts))
+
+
+def _extract_parts(email_subject, email_body, parts):
+    """
+    Extracts the parts of a map-reduce plan on the shared 'llm' stage pool.
+    The caller is usually one of that pool's threads itself, so it works
+    through the parts no other thread has started instead of blocking on
+    them, and a full pool cannot deadlock.
+    """
+    import pipeline
+    executor = pipeline.stage_executor('llm')
+    futures = [executor.submit(_extract_part, email_subject, email_body, part) for part in parts[1:]]
+    results = [_extract_part(email_subject, email_body, parts[0])]
+    for future, part in zip(futures, parts[1:]):
+        if future.cancel():
+            results.append(_extract_part(email_subject, email_body, part))
+        else:
+            results.append(future.result())
+    return results
+
+
+async def extract_fields_from_email_async(email_subject, email_body, attachment_text=None):
+    plan = _extraction_plan(email_subject, email_body, attachment_text)
+    if len(plan.parts) <= 1:
+        return await _extract_part_async(email_subject, email_body, plan.parts[0] if plan.parts else None)
+    results = await asyncio.gather(*(_extract_part_async(email_subject, email_body, part) for part in plan.parts))
+    return prompt_budget.merge_fields(list(results))
+
+
+DOC_TYPES = [
+    'Claim Form',
+    'Police Report',
+    'Proof of Loss',
+    'Invoice',
+    'Declaration',
+    'Photo',
+    'ID Document',
+    'Other Document',
+]
+
+_DOC_TYPE_RULES = """
+    Classification Rules:
+    - Claim Form → Contains insurance claim details, claim number, policy number, claimant information, incident description.
+    - Police Report → Contains police department references, officer names, badge numbers, case/report numbers, incident reports.
+    - Proof of Loss → Contains statements of loss, damage valuation, sworn loss statements, insurance loss summaries.
+    - Invoice → Contains billing details, invoice number, line items, totals, payment terms.
+    - Declaration → Contains formal statements affirming truth, signatures under penalty, sworn declarations.
+    - Photo → Mentions image/photo metadata or indicates the content is a photograph.
+    - ID Document → Contains identity details such as name, date of birth, ID number, license/passport details.
+"""
+
+
+def _doc_type_prompt(data: str):
+    return f"""
     You are a document classification assistant.
 
     Your task is to determine the document type based only on the provided text content.
@@ -108,16 +504,7 @@ def guess_doc_type(data: str):
     - Photo
     - ID Document
     - Other Document
-
-    Classification Rules:
-    - Claim Form → Contains insurance claim details, claim number, policy number, claimant information, incident description.
-    - Police Report → Contains police department references, officer names, badge numbers, case/report numbers, incident reports.
-    - Proof of Loss → Contains statements of loss, damage valuation, sworn loss statements, insurance loss summaries.
-    - Invoice → Contains billing details, invoice number, line items, totals, payment terms.
-    - Declaration → Contains formal statements affirming truth, signatures under penalty, sworn declarations.
-    - Photo → Mentions image/photo metadata or indicates the content is a photograph.
-    - ID Document → Contains identity details such as name, date of birth, ID number, license/passport details.
-
+    {_DOC_TYPE_RULES}
     If none clearly apply, return: Other Document.
 
     Instructions:
@@ -134,17 +521,127 @@ def guess_doc_type(data: str):
     Output:
     """
 
-    headers = {"Content-Type": "application/json"}
-    url = f"{GEMINI_API_URL}:generateContent?key={GEMINI_API_KEY}"
-    payload = {
-        "model": GEMINI_MODEL,
-        "contents": [{"role": "user", "parts": [{"text": prompt}]}]
-    }
+
+_DOC_TYPES_BY_NAME = {label.lower(): label for label in DOC_TYPES}
+
+
+def _parse_doc_type(text):
+    """The DOC_TYPES label the model answered with; anything else is 'Other Document'."""
+    return _DOC_TYPES_BY_NAME.get(text.strip().strip('"\'.*`').strip().lower(), 'Other Document')
+
+
+def guess_doc_type(data: str):
+    try:
+        return _generate(_doc_type_prompt(data), _parse_doc_type)
+    except Exception as e:
+        return "Other Document"
+
+
+async def guess_doc_type_async(data: str):
     try:
-        response = requests.post(url, headers=headers, data=json.dumps(payload), timeout=300)
-        response.raise_for_status()
-        result = response.json()
-        doc_type = result["candidates"][0]["content"]["parts"][0]["text"].strip()
-        return doc_type
+        return await _generate_async(_doc_type_prompt(data), _parse_doc_type)
     except Exception as e:
-        return "Other Document"
\ No newline at end of file
+        return "Other Document"
+
+
+
+def _doc_types_prompt(texts):
+    documents = "\n".join(
+        f'    Document {i}:\n    """\n    {text}\n    """\n' for i, text in enumerate(texts)
+    )
+    labels_list = "\n".join(f"    - {label}" for label in DOC_TYPES)
+    return f"""
+    You are a document classification assistant.
+
+    Your task is to determine the document type of each of the {len(texts)} documents below, based only on its text content.
+
+    Classify each document into one of the following categories only:
+
+{labels_list}
+    {_DOC_TYPE_RULES}
+    If none clearly apply, use: Other Document.
+
+    Instructions:
+    - Base each answer strictly on that document's text content.
+    - Do not guess beyond the provided text.
+    - Return only a JSON array with one object per document: [{{"index": 0, "doc_type": "<label>"}}, ...]
+    - Do not provide explanations.
+
+{documents}
+    Output:
+    """
+
+
+def _doc_types_parser(count):
+    def parse(text):
+        labels = [None] * count
+        for entry in _parse_json_response(text):
+            index = entry.get("index")
+            doc_type = entry.get("doc_type")
+            if isinstance(index, int) and 0 <= index < count and doc_type in DOC_TYPES:
+                labels[index] = doc_type
+        return labels
+    return parse
+
+
+def guess_doc_types(texts):
+    """
+    Classifies several documents with a single Gemini call that returns one
+    label per document as JSON. Labels missing from the answer or outside
+    DOC_TYPES are re-classified one by one with guess_doc_type.
+    Returns the labels in input order.
+    """
+    if not texts:
+        return []
+    if len(texts) == 1:
+        return [guess_doc_type(texts[0])]
+
+    try:
+        labels = _generate(_doc_types_prompt(texts), _doc_types_parser(len(texts)))
+    except Exception as e:
+        log.warning("Batch document classification failed, classifying one by one: %s", e,
+                    extra={'error': str(e), 'attachments': len(texts)})
+        labels = [None] * len(texts)
+
+    for i, label in enumerate(labels):
+        if label is None:
+            labels[i] = guess_doc_type(texts[i])
+    return labels
+
+
+async def guess_doc_types_async(texts):
+    if not texts:
+        return []
+    if len(texts) == 1:
+        return [await guess_doc_type_async(texts[0])]
+
+    try:
+        labels = await _generate_async(_doc_types_prompt(texts), _doc_types_parser(len(texts)))
+    except Exception as e:
+        log.warning("Batch document classification failed, classifying one by one: %s", e,
+                    extra={'error': str(e), 'attachments': len(texts)})
+        labels = [None] * len(texts)
+
+    missing = [i for i, label in enumerate(labels) if label is None]
+    fallbacks = await asyncio.gather(*(guess_doc_type_async(texts[i]) for i in missing))
+    for i, label in zip(missing, fallbacks):
+        labels[i] = label
+    return labels
+
+
+def _answer_prompt(context, question):
+    return f"""
+Answer the question using only the context below.
+If the answer is not in the context, say "Not found in document."
+
+Context:
+{context}
+
+Question:
+{question}
+"""
+
+
+def answer_from_context(context, question):
+    """Answers a question about retrieved document chunks; returns the answer text."""
+    return _generate(_answer_prompt(context, question), str.strip)
@@ -1,6 +1,6 @@
-from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey
-from sqlalchemy.orm import relationship
-from sqlalchemy import UniqueConstraint, BigInteger
+from sqlalchemy import Column, Integer, String, Text, DateTime, Date, Float, ForeignKey, LargeBinary
+from sqlalchemy.orm import relationship, column_property
+from sqlalchemy import UniqueConstraint, BigInteger, Index, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import relationship
@@ -11,14 +11,29 @@ Base = declarative_base()
 class FNOLWorkItem(Base):
     __tablename__ = 'fnol_work_items'
     id = Column(Integer, primary_key=True, index=True)
-    message_id = Column(String, nullable=True, index=True, unique=False)  # Set unique=True if always available
+    # Unique where set (uix_fnol_work_items_message_id): intake claims the row before any OCR/LLM work
+    message_id = Column(String, nullable=True)
     email_subject = Column(String, nullable=False)
     email_body = Column(Text, nullable=False)
     extracted_fields = Column(JSONB)
-    status = Column(String, default='pending')
+    # active_history keeps the previous value around for the rollup listeners in rollups.py
+    status = column_property(Column(String, default='pending'), active_history=True)
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    completed_at = column_property(Column(DateTime, nullable=True), active_history=True)  # set when status moves to approved/closed/completed
     attachments = relationship('Attachment', back_populates='workitem', cascade='all, delete-orphan')
-    tag = Column(Text)
+    tag = column_property(Column(Text), active_history=True)
+    # Earlier work item this email was found to be a near-duplicate of (near_dup.py)
+    duplicate_of_id = Column(Integer, ForeignKey('fnol_work_items.id', ondelete='SET NULL'), nullable=True, index=True)
+    # Why LLM field extraction failed (extracted_fields is then stored empty); NULL when it did not
+    extraction_error = Column(Text, nullable=True)
+    # Refreshed while a request holds the 'processing' claim (pipeline.beat_claims)
+    claim_heartbeat_at = Column(DateTime, nullable=True)
+    __table_args__ = (
+        # Keyset pagination order for GET /fnol/
+        Index('ix_fnol_work_items_created_at_id', 'created_at', 'id'),
+        Index('uix_fnol_work_items_message_id', 'message_id', unique=True,
+              postgresql_where=text('message_id IS NOT NULL'), sqlite_where=text('message_id IS NOT NULL')),
+    )
 
 class Attachment(Base):
     __tablename__ = 'attachments'
@@ -26,10 +41,59 @@ class Attachment(Base):
     workitem_id = Column(Integer, ForeignKey('fnol_work_items.id', ondelete='CASCADE'), nullable=False, index=True)
     filename = Column(String)
     blob_url = Column(String)
-    doc_type = Column(String)
+    doc_type = column_property(Column(String), active_history=True)
     uploaded_at = Column(DateTime, default=datetime.datetime.utcnow)
     uploader = Column(String, nullable=True)
     file_size = Column(BigInteger, nullable=True)
     mime_type = Column(String, nullable=True)
     workitem = relationship('FNOLWorkItem', back_populates='attachments')
     __table_args__ = (UniqueConstraint('workitem_id', 'filename', name='uix_workitem_filename'),)
+
+class IntakeJob(Base):
+    __tablename__ = 'intake_jobs'
+    id = Column(Integer, primary_key=True, index=True)
+    workitem_id = Column(Integer, ForeignKey('fnol_work_items.id', ondelete='CASCADE'), nullable=False, index=True)
+    payload = Column(JSONB, nullable=False)  # raw FNOLWorkItemCreate body, attachments included
+    status = Column(String, default='queued', nullable=False, index=True)  # queued, processing, done, failed
+    attempts = Column(Integer, default=0, nullable=False)
+    last_error = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+    workitem = relationship('FNOLWorkItem')
+
+class CacheEntry(Base):
+    __tablename__ = 'cache_entries'
+    namespace = Column(String, primary_key=True)  # e.g. 'ocr'
+    key = Column(String, primary_key=True)  # SHA-256 hex digest
+    value = Column(Text, nullable=False)  # JSON encoded
+    created_at = Column(DateTime, default=datetime.datetime.utcnow, index=True)
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+class ClaimsDailyRollup(Base):
+    """Work item counts per created day x status x tag, maintained by rollups.py."""
+    __tablename__ = 'claims_daily_rollup'
+    day = Column(Date, primary_key=True)
+    status = Column(String, primary_key=True)
+    tag = Column(String, primary_key=True)  # '' when the work item has no tag
+    count = Column(Integer, nullable=False, default=0)
+    processing_count = Column(Integer, nullable=False, default=0)
+    processing_seconds = Column(Float, nullable=False, default=0)
+
+class DocTypeRollup(Base):
+    """Attachment counts per doc_type, maintained by rollups.py."""
+    __tablename__ = 'doc_type_rollup'
+    doc_type = Column(String, primary_key=True)  # '' when the attachment has no doc_type
+    count = Column(Integer, nullable=False, default=0)
+
+class MinHashSignature(Base):
+    """MinHash signature of a work item's email, used for near-duplicate detection."""
+    __tablename__ = 'minhash_signatures'
+    workitem_id = Column(Integer, ForeignKey('fnol_work_items.id', ondelete='CASCADE'), primary_key=True)
+    signature = Column(LargeBinary, nullable=False)  # near_dup.NUM_PERMUTATIONS x uint32
+
+class MinHashBand(Base):
+    """LSH band keys of the signatures; work items sharing a key are near-duplicate candidates."""
+    __tablename__ = 'minhash_bands'
+    band_key = Column(BigInteger, primary_key=True)
+    workitem_id = Column(Integer, ForeignKey('fnol_work_items.id', ondelete='CASCADE'), primary_key=True, index=True)
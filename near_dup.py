@@ -0,0 +1,177 @@
+import os
+import re
+import base64
+import hashlib
+from dotenv import load_dotenv
+from sqlalchemy import select, func
+
+import models
+
+load_dotenv()
+
+# What to do with an email whose MinHash similarity to an earlier work item is
+# at least FNOL_NEAR_DUP_THRESHOLD: 'flag' processes it as usual and sets its
+# duplicate_of_id; 'link' stores it as a duplicate of the earlier one (fields
+# copied, OCR/LLM/upload skipped) and 'reuse' returns the earlier work item as
+# is (a queued email's work item is dropped and its intake job moved to the
+# earlier one), both only when it carries exactly the earlier one's
+# attachments (it is flagged otherwise); 'off' disables the lookup. Signatures are recorded in
+# every mode.
+FNOL_NEAR_DUP_MODE = os.getenv('FNOL_NEAR_DUP_MODE', 'flag')
+FNOL_NEAR_DUP_THRESHOLD = float(os.getenv('FNOL_NEAR_DUP_THRESHOLD', '0.9'))
+# 128 permutations in 16 bands of 8 rows: emails with Jaccard similarity
+# >= 0.9 share a band (and become candidates) with probability > 0.99
+NUM_PERMUTATIONS = int(os.getenv('FNOL_MINHASH_PERMUTATIONS', '128'))
+LSH_BANDS = int(os.getenv('FNOL_LSH_BANDS', '16'))
+SHINGLE_WORDS = 3
+# Emails with fewer shingles than this carry too little text to compare
+MIN_SHINGLES = 5
+MAX_CANDIDATES = 20
+
+_PRIME = (1 << 31) - 1
+_SUBJECT_PREFIX = re.compile(r'^\s*((re|fw|fwd|aw|wg)\s*:\s*)+', re.IGNORECASE)
+_QUOTE_MARKERS = re.compile(r'^[>\s]+', re.MULTILINE)
+_WORD = re.compile(r'\w+')
+
+
+def _permutations():
+    import numpy as np
+    rng = np.random.default_rng(0x5EED)
+    a = rng.integers(1, _PRIME, NUM_PERMUTATIONS, dtype='uint64')
+    b = rng.integers(0, _PRIME, NUM_PERMUTATIONS, dtype='uint64')
+    return a[:, None], b[:, None]
+
+
+_perm_a = _perm_b = None
+
+
+def _token_hash(token):
+    return int.from_bytes(hashlib.blake2b(token.encode('utf-8'), digest_size=8).digest(), 'little') % _PRIME
+
+
+def attachment_fingerprints(item):
+    """
+    SHA-256 of each attachment's content (decoded for base64 attachments), the
+    hash the blob names use, so both intakes fingerprint a file the same way.
+    Attachments that are not valid base64 are left out, as the pipeline does.
+    """
+    fingerprints = []
+    for att in item.attachments or []:
+        source = att.get('source')
+        if source is not None:
+            fingerprints.append(source.sha256)
+            continue
+        content = att.get('contentBytes') or att.get('content')
+        if content:
+            try:
+                fingerprints.append(hashlib.sha256(base64.b64decode(content)).hexdigest())
+            except (ValueError, TypeError):
+                continue
+    return fingerprints
+
+
+def shingles(subject, body, attachment_hashes=()):
+    """
+    Word 3-shingles of the subject (without Re:/Fw: prefixes) and the body
+    (quoted '>' markers dropped, so a reply carries the original text), plus
+    one token per attachment hash.
+    """
+    subject = _SUBJECT_PREFIX.sub('', subject or '')
+    body = _QUOTE_MARKERS.sub('', body or '')
+    words = _WORD.findall(f"{subject}\n{body}".lower())
+    tokens = {' '.join(words[i:i + SHINGLE_WORDS]) for i in range(max(0, len(words) - SHINGLE_WORDS + 1))}
+    tokens.update(f"attachment:{digest}" for digest in attachment_hashes)
+    return tokens
+
+
+def signature(tokens):
+    """MinHash signature (uint32 array of NUM_PERMUTATIONS), or None if there is too little text."""
+    global _perm_a, _perm_b
+    import numpy as np
+    if len(tokens) < MIN_SHINGLES:
+        return None
+    if _perm_a is None:
+        _perm_a, _perm_b = _permutations()
+    hashes = np.fromiter((_token_hash(token) for token in tokens), dtype='uint64', count=len(tokens))
+    return ((_perm_a * hashes[None, :] + _perm_b) % _PRIME).min(axis=1).astype('uint32')
+
+
+def item_signature(item, attachment_hashes=None):
+    if attachment_hashes is None:
+        attachment_hashes = attachment_fingerprints(item)
+    return signature(shingles(item.subject, item.body, attachment_hashes))
+
+
+def band_keys(sig):
+    """One signed 64-bit key per LSH band (band number included, so bands never collide)."""
+    rows = len(sig) // LSH_BANDS
+    return [
+        int.from_bytes(
+            hashlib.blake2b(bytes([band]) + sig[band * rows:(band + 1) * rows].tobytes(), digest_size=8).digest(),
+            'little', signed=True
+        )
+        for band in range(LSH_BANDS)
+    ]
+
+
+def similarity(sig_a, sig_b):
+    """Estimated Jaccard similarity of two signatures."""
+    import numpy as np
+    return float(np.mean(sig_a == sig_b))
+
+
+def _candidates_query(keys):
+    bands = models.MinHashBand
+    return (
+        select(bands.workitem_id)
+        .where(bands.band_key.in_(keys))
+        .group_by(bands.workitem_id)
+        .order_by(func.count().desc())
+        .limit(MAX_CANDIDATES)
+    )
+
+
+def _signatures_query(workitem_ids):
+    signatures = models.MinHashSignature
+    return select(signatures.workitem_id, signatures.signature).where(signatures.workitem_id.in_(workitem_ids))
+
+
+def _best_match(sig, rows, threshold):
+    import numpy as np
+    best = None
+    for workitem_id, stored in rows:
+        score = similarity(sig, np.frombuffer(stored, dtype='uint32'))
+        if score >= threshold and (best is None or score > best[1]):
+            best = (workitem_id, score)
+    return best
+
+
+def find_duplicate(db, sig, threshold=FNOL_NEAR_DUP_THRESHOLD, exclude_id=None):
+    """Returns (workitem_id, similarity) of the most similar earlier work item at or above threshold, or None."""
+    if sig is None:
+        return None
+    candidates = [workitem_id for workitem_id in db.execute(_candidates_query(band_keys(sig))).scalars()
+                  if workitem_id != exclude_id]
+    if not candidates:
+        return None
+    return _best_match(sig, db.execute(_signatures_query(candidates)).all(), threshold)
+
+
+async def find_duplicate_async(db, sig, threshold=FNOL_NEAR_DUP_THRESHOLD, exclude_id=None):
+    if sig is None:
+        return None
+    result = await db.execute(_candidates_query(band_keys(sig)))
+    candidates = [workitem_id for workitem_id in result.scalars() if workitem_id != exclude_id]
+    if not candidates:
+        return None
+    result = await db.execute(_signatures_query(candidates))
+    return _best_match(sig, result.all(), threshold)
+
+
+def signature_rows(workitem_id, sig):
+    """ORM rows recording a work item's signature and LSH bands, to add in the work item's transaction."""
+    if sig is None:
+        return []
+    rows = [models.MinHashSignature(workitem_id=workitem_id, signature=sig.tobytes())]
+    rows += [models.MinHashBand(band_key=key, workitem_id=workitem_id) for key in set(band_keys(sig))]
+    return rows
@@ -0,0 +1,929 @@
+import os
+import time
+import logging
+import base64
+import asyncio
+import datetime
+import mimetypes
+import threading
+from dotenv import load_dotenv
+from sqlalchemy import select
+from sqlalchemy.orm.exc import StaleDataError
+
+import models
+import rollups
+import schemas
+import azure_blob
+import llm_client
+import azure_doc_intel
+import vector_store
+import near_dup
+import doc_classifier
+import telemetry
+from azure_doc_intel import extract_text_from_bytes
+
+load_dotenv()
+
+log = logging.getLogger('fnol.pipeline')
+
+OCR_MIME_TYPES = ['image/png', 'image/jpeg', 'image/jpg', 'application/pdf']
+
+# Per-stage concurrency limits. Each stage has its own pool (or semaphore on
+# the async path) shared by all requests in the process, so the limits also
+# cap load on each backend.
+STAGE_CONCURRENCY = {
+    'ocr': int(os.getenv('FNOL_OCR_CONCURRENCY', '4')),
+    'llm': int(os.getenv('FNOL_LLM_CONCURRENCY', '4')),
+    'classify': int(os.getenv('FNOL_CLASSIFY_CONCURRENCY', '4')),
+    'upload': int(os.getenv('FNOL_UPLOAD_CONCURRENCY', '4')),
+    'embed': int(os.getenv('FNOL_EMBED_CONCURRENCY', '1')),
+}
+
+# A delivery of an email whose work item another request is still processing
+# (or the worker pool has queued) waits up to FNOL_CLAIM_WAIT_SECONDS for that
+# result, then gets ClaimPending. The process holding a claim refreshes its
+# claim_heartbeat_at every FNOL_CLAIM_HEARTBEAT_SECONDS; a claim still
+# 'processing' without an intake job and without a heartbeat for
+# FNOL_CLAIM_STALE_SECONDS (its process died) is released and claimed again.
+FNOL_CLAIM_WAIT_SECONDS = float(os.getenv('FNOL_CLAIM_WAIT_SECONDS', '60'))
+FNOL_CLAIM_POLL_INTERVAL = float(os.getenv('FNOL_CLAIM_POLL_INTERVAL', '0.5'))
+FNOL_CLAIM_STALE_SECONDS = float(os.getenv('FNOL_CLAIM_STALE_SECONDS', '900'))
+FNOL_CLAIM_HEARTBEAT_SECONDS = float(os.getenv('FNOL_CLAIM_HEARTBEAT_SECONDS', '60'))
+
+
+class ClaimPending(Exception):
+    """The email's work item (.workitem) was still unfinished after FNOL_CLAIM_WAIT_SECONDS."""
+
+    def __init__(self, workitem):
+        super().__init__(f"workitem_id={workitem.id} is still {workitem.status}")
+        self.workitem = workitem
+
+
+_executors = {}
+_executors_lock = threading.Lock()
+
+
+def stage_executor(stage):
+    with _executors_lock:
+        executor = _executors.get(stage)
+        if executor is None:
+            executor = telemetry.TracedThreadPoolExecutor(max_workers=STAGE_CONCURRENCY[stage], thread_name_prefix=f"fnol-{stage}")
+            _executors[stage] = executor
+        return executor
+
+
+def shutdown_executors():
+    with _executors_lock:
+        for executor in _executors.values():
+            executor.shutdown(wait=False)
+        _executors.clear()
+
+
+def build_workitem_response(db, db_item):
+    """Builds the API response for a work item together with its attachments."""
+    all_attachments = db.query(models.Attachment).filter(models.Attachment.workitem_id == db_item.id).all()
+    attachments_out = [
+        schemas.AttachmentOut(
+            id=a.id,
+            filename=a.filename,
+            blob_url=a.blob_url,
+            doc_type=a.doc_type
+        ) for a in all_attachments
+    ]
+    return schemas.FNOLWorkItem(
+        id=db_item.id,
+        message_id=db_item.message_id,
+        email_subject=db_item.email_subject,
+        email_body=db_item.email_body,
+        extracted_fields=db_item.extracted_fields,
+        status=db_item.status,
+        duplicate_of_id=db_item.duplicate_of_id,
+        extraction_error=db_item.extraction_error,
+        attachments=attachments_out
+    )
+
+
+def _attachment_inputs(item):
+    """
+    The attachments of an item as {'filename', 'content'} dicts (base64) or,
+    from the multipart intake, {'filename', 'source'} dicts holding an
+    intake.SpooledAttachment. Repeated filenames keep the first occurrence.
+    """
+    attachment_data = []
+    seen_filenames = set()
+    for att in getattr(item, 'attachments', None) or []:
+        filename = att.get('filename') or att.get('name')
+        content = att.get('contentBytes') or att.get('content')
+
+        # Skip duplicate filenames in the input
+        if filename in seen_filenames:
+            log.info("Skipping duplicate attachment in input: %s", filename, extra={'attachment': filename})
+            continue
+
+        log.debug("Processing attachment: %s", filename, extra={'attachment': filename, 'content_present': bool(content)})
+        if filename and att.get('source') is not None:
+            seen_filenames.add(filename)
+            attachment_data.append({'filename': filename, 'source': att['source']})
+        elif filename and content:
+            seen_filenames.add(filename)
+            attachment_data.append({'filename': filename, 'content': content})
+    return attachment_data
+
+
+def _decode_attachment(att_data):
+    """
+    Decodes a base64 attachment (a spooled one is read from its own handle
+    later) and records its hash, size and guessed MIME type. Returns False,
+    leaving the attachment out of the email, when the payload is not valid
+    base64.
+    """
+    filename = att_data['filename']
+    source = att_data.get('source')
+    if source is not None:
+        att_data.update(sha256=source.sha256, file_size=source.size, mime_type=source.mime_type)
+    else:
+        try:
+            with telemetry.span('decode', attachment=filename):
+                att_data['file_bytes'] = base64.b64decode(att_data.pop('content'))
+        except (ValueError, TypeError) as e:
+            log.warning("Skipping attachment %s, its content is not valid base64: %s", filename, e,
+                        extra={'attachment': filename, 'error': str(e)})
+            return False
+        # One hash per attachment, shared by the OCR cache key and the blob name
+        sha256, file_size = azure_blob.content_digest(att_data['file_bytes'])
+        mime_type, _ = mimetypes.guess_type(filename)
+        att_data.update(sha256=sha256, file_size=file_size, mime_type=mime_type)
+    telemetry.attachment_bytes.observe(att_data['file_size'])
+    att_data['extracted_text'] = None
+    log.debug("Guessed MIME type for %s: %s", filename, att_data['mime_type'],
+              extra={'attachment': filename, 'mime_type': att_data['mime_type']})
+    return True
+
+
+def _ocr_attachment(att_data):
+    if not _decode_attachment(att_data):
+        return None
+    filename, mime_type, source = att_data['filename'], att_data['mime_type'], att_data.get('source')
+    if mime_type in OCR_MIME_TYPES:
+        try:
+            with telemetry.span('ocr', attachment=filename, mime_type=mime_type):
+                if source is not None:
+                    with source.open() as stream:
+                        att_data['extracted_text'] = extract_text_from_bytes(stream, mime_type,
+                                                                             content_hash=source.sha256)
+                else:
+                    att_data['extracted_text'] = extract_text_from_bytes(att_data['file_bytes'], mime_type,
+                                                                         content_hash=att_data['sha256'])
+        except Exception as e:
+            log.warning("Extracting text from %s failed: %s", filename, e, extra={'attachment': filename, 'error': str(e)})
+    return att_data
+
+
+def extract_attachments(item: schemas.FNOLWorkItemCreate):
+    """
+    Decodes and OCRs the email attachments in parallel (bounded by the 'ocr'
+    stage limit). Returns one dict per attachment, in input order; an
+    attachment that cannot be decoded is left out, and one that cannot be
+    OCR'd keeps extracted_text None.
+    """
+    attachment_data = _attachment_inputs(item)
+    return [a for a in stage_executor('ocr').map(_ocr_attachment, attachment_data) if a is not None]
+
+
+def _classification_texts(attachment_data):
+    return [(a['extracted_text'] or '') + ' ' + a['filename'].lower() for a in attachment_data]
+
+
+def _apply_llm_labels(attachment_data, doc_types, uncertain, llm_types):
+    for i, doc_type in zip(uncertain, llm_types):
+        log.info("LLM guessed document type for '%s': %s", attachment_data[i]['filename'], doc_type,
+                 extra={'attachment': attachment_data[i]['filename'], 'doc_type': doc_type})
+        doc_types[i] = doc_type
+    return doc_types
+
+
+def _classify_attachments(attachment_data):
+    """
+    Labels the attachments with the local classifier and sends only those it
+    is unsure about to the LLM, in one batched call. If that call fails the
+    local labels stand.
+    """
+    with telemetry.span('classify', attachments=len(attachment_data)):
+        doc_types, uncertain = doc_classifier.classify_attachments(
+            [a['extracted_text'] for a in attachment_data], [a['filename'] for a in attachment_data]
+        )
+        if not uncertain:
+            return doc_types
+        texts = _classification_texts(attachment_data)
+        try:
+            llm_types = llm_client.guess_doc_types([texts[i] for i in uncertain])
+        except Exception as e:
+            log.warning("LLM classification failed, keeping the local document types: %s", e, extra={'error': str(e)})
+            return doc_types
+        return _apply_llm_labels(attachment_data, doc_types, uncertain, llm_types)
+
+
+def _upload_attachment(att_data):
+    log.debug("Uploading attachment '%s' to blob storage", att_data['filename'], extra={'attachment': att_data['filename']})
+    source = att_data.get('source')
+    options = {'mime_type': att_data['mime_type'], 'content_hash': att_data['sha256'], 'size': att_data['file_size']}
+    with telemetry.span('upload', attachment=att_data['filename']):
+        if source is not None:
+            with source.open() as stream:
+                return azure_blob.upload_attachment(att_data['filename'], stream, **options)
+        return azure_blob.upload_attachment(att_data['filename'], att_data['file_bytes'], **options)
+
+
+def _extract_fields(subject, body, combined_attachment_text):
+    with telemetry.span('extract_fields'):
+        return llm_client.extract_fields_from_email(subject, body, combined_attachment_text)
+
+
+def classify_and_upload(attachment_data):
+    """
+    Classifies the attachments (locally, escalating uncertain ones to one
+    batched LLM call) while the uploads fan out in parallel. Sets 'doc_type'
+    and 'blob_url' on each dict; upload errors propagate.
+    """
+    doc_types_future = stage_executor('classify').submit(_classify_attachments, attachment_data)
+    blob_urls = list(stage_executor('upload').map(_upload_attachment, attachment_data))
+    doc_types = doc_types_future.result()
+    for att_data, doc_type, blob_url in zip(attachment_data, doc_types, blob_urls):
+        att_data['doc_type'] = doc_type
+        att_data['blob_url'] = blob_url
+    return attachment_data
+
+
+def _skip_existing(attachment_data, existing_filenames):
+    new_attachments = []
+    for att_data in attachment_data:
+        if att_data['filename'] in existing_filenames:
+            log.info("Attachment '%s' already exists for this workitem, skipping", att_data['filename'],
+                     extra={'attachment': att_data['filename']})
+            continue
+        new_attachments.append(att_data)
+    return new_attachments
+
+
+def run_stages(item: schemas.FNOLWorkItemCreate, existing_filenames=()):
+    """
+    Runs the external-service stages for an email without touching the
+    database. Returns (new_attachments, extracted_fields).
+    """
+    # Step 1: Extract text from all attachments
+    attachment_data = extract_attachments(item)
+    extracted_texts = [a['extracted_text'] for a in attachment_data if a['extracted_text']]
+
+    # Step 2: Pass extracted text to LLM for field extraction, while the
+    # attachments are classified and uploaded
+    combined_attachment_text = '\n\n'.join(extracted_texts) if extracted_texts else ''
+    extraction_future = None
+    if item.extracted_fields is None:
+        extraction_future = stage_executor('llm').submit(
+            _extract_fields,
+            item.subject,
+            item.body,
+            combined_attachment_text
+        )
+
+    new_attachments = _skip_existing(attachment_data, existing_filenames)
+    classify_and_upload(new_attachments)
+
+    if extraction_future is not None:
+        extracted_fields = extraction_future.result()
+    else:
+        extracted_fields = item.extracted_fields
+    return new_attachments, extracted_fields
+
+
+def _fill_workitem(item, extracted_fields, db_item=None):
+    extraction_error = None
+    if isinstance(extracted_fields, dict) and 'error' in extracted_fields:
+        # llm_client's error result: keep the field shape, flag the work item
+        extraction_error = str(extracted_fields['error'])
+        log.warning("Field extraction failed, storing empty fields: %s", extraction_error,
+                    extra={'message_id': item.message_id, 'error': extraction_error,
+                           'llm_response': extracted_fields.get('llm_response')})
+        extracted_fields = schemas.ExtractedFields().model_dump()
+    # Fields sent by the caller may lack claim_type or give it as a string
+    claim_type = (extracted_fields or {}).get('claim_type')
+    tag = claim_type.get('category') if isinstance(claim_type, dict) else None
+    if db_item is None:
+        return models.FNOLWorkItem(
+            message_id=item.message_id,
+            email_subject=item.subject,
+            email_body=item.body,
+            extracted_fields=extracted_fields,
+            tag=tag,
+            extraction_error=extraction_error
+        )
+    db_item.extracted_fields = extracted_fields
+    db_item.tag = tag
+    db_item.extraction_error = extraction_error
+    db_item.status = 'pending'
+    return db_item
+
+
+def _link_duplicate(item, original, db_item=None):
+    """
+    Fills a work item for an email that repeats an earlier one, attachments
+    included ('link' mode): it points to the original and takes over its
+    fields, without OCR, LLM calls or uploads.
+    """
+    if db_item is None:
+        db_item = models.FNOLWorkItem(message_id=item.message_id, email_subject=item.subject, email_body=item.body)
+    if item.extracted_fields is not None:
+        db_item.extracted_fields = item.extracted_fields
+    else:
+        db_item.extracted_fields = original.extracted_fields
+        db_item.extraction_error = original.extraction_error
+    db_item.tag = original.tag
+    db_item.status = 'duplicate'
+    db_item.duplicate_of_id = original.id
+    return db_item
+
+
+def _blob_urls_query(workitem_id):
+    return select(models.Attachment.blob_url).where(models.Attachment.workitem_id == workitem_id)
+
+
+def _can_skip_pipeline(attachment_hashes, original_blob_urls):
+    """
+    Whether a near-duplicate may skip the pipeline ('link' and 'reuse' modes):
+    only if it carries exactly the attachments stored for the original, so no
+    new file goes unstored.
+    """
+    if near_dup.FNOL_NEAR_DUP_MODE not in ('link', 'reuse'):
+        return False
+    return set(attachment_hashes) == {azure_blob.content_hash_from_url(url or '') for url in original_blob_urls}
+
+
+def _find_near_duplicate(db, sig, db_item=None):
+    if near_dup.FNOL_NEAR_DUP_MODE == 'off':
+        return None
+    match = near_dup.find_duplicate(db, sig, exclude_id=db_item.id if db_item is not None else None)
+    if match is not None:
+        log.info("Email is a near-duplicate of workitem_id=%s (similarity %.2f)", match[0], match[1],
+                 extra={'duplicate_of_id': match[0], 'similarity': round(match[1], 3)})
+    return match
+
+
+def _signature_rows(db, workitem_id, sig, retried):
+    # A retried job may already have recorded the signature
+    if retried and db.get(models.MinHashSignature, workitem_id) is not None:
+        return []
+    return near_dup.signature_rows(workitem_id, sig)
+
+
+def _attachment_values(workitem_id, new_attachments):
+    log.info("Storing %d attachments for workitem_id=%s", len(new_attachments), workitem_id,
+             extra={'workitem_id': workitem_id, 'attachments': len(new_attachments)})
+    uploaded_at = datetime.datetime.utcnow()
+    values = []
+    for att_data in new_attachments:
+        log.debug("Creating attachment record for '%s' with doc_type='%s'", att_data['filename'], att_data['doc_type'],
+                  extra={'workitem_id': workitem_id, 'attachment': att_data['filename'], 'doc_type': att_data['doc_type']})
+        values.append({
+            'workitem_id': workitem_id,
+            'filename': att_data['filename'],
+            'blob_url': att_data['blob_url'],
+            'doc_type': att_data['doc_type'],
+            'mime_type': att_data['mime_type'],
+            'file_size': att_data['file_size'],
+            'uploaded_at': uploaded_at,
+        })
+    return values
+
+
+def insert_attachments(db, values):
+    """
+    Stores attachment rows (_attachment_values) in one INSERT ... ON CONFLICT
+    DO NOTHING on uix_workitem_filename, so a file an earlier run already
+    stored for the work item is kept as it is. Returns the number inserted.
+    """
+    if not values:
+        return 0
+    table = models.Attachment.__table__
+    stmt = rollups.dialect_insert(db.connection())(table).values(values)
+    stmt = stmt.on_conflict_do_nothing(index_elements=['workitem_id', 'filename'])
+    doc_types = list(db.execute(stmt.returning(table.c.doc_type)).scalars())
+    rollups.count_inserted(db, doc_types=doc_types)
+    return len(doc_types)
+
+
+def _index_texts(workitem_id, texts):
+    try:
+        added = vector_store.index_texts(workitem_id, texts)
+        log.info("Indexed %d new chunks for workitem_id=%s", added, workitem_id,
+                 extra={'workitem_id': workitem_id, 'chunks': added})
+    except Exception:
+        log.exception("Indexing attachment text failed for workitem_id=%s", workitem_id,
+                      extra={'workitem_id': workitem_id})
+
+
+def index_attachment_text(workitem_id, new_attachments):
+    """
+    Queues the OCR text of the stored attachments for the per-claim vector
+    index (FNOL_VECTOR_INDEXING), on the 'embed' stage pool so the response
+    does not wait for the embedding. Returns the future, or None.
+    """
+    if not vector_store.FNOL_VECTOR_INDEXING:
+        return None
+    texts = [(a['filename'], a['extracted_text']) for a in new_attachments if a.get('extracted_text')]
+    if not texts:
+        return None
+    return stage_executor('embed').submit(_index_texts, workitem_id, texts)
+
+
+# Claims this process is still working on: workitem id -> time.monotonic() of the claim
+_live_claims = {}
+_live_claims_lock = threading.Lock()
+_heartbeat_thread = None
+_heartbeat_stop = threading.Event()
+
+
+def _hold_claims(workitem_ids):
+    now = time.monotonic()
+    with _live_claims_lock:
+        _live_claims.update((workitem_id, now) for workitem_id in workitem_ids)
+    start_heartbeat_thread()
+
+
+def _drop_claims(workitem_ids):
+    with _live_claims_lock:
+        for workitem_id in workitem_ids:
+            _live_claims.pop(workitem_id, None)
+
+
+def beat_claims(db):
+    """
+    Refreshes claim_heartbeat_at of this process's claims that are still
+    'processing', and forgets the others (filled in, released or rolled back).
+    """
+    with _live_claims_lock:
+        held = dict(_live_claims)
+    if not held:
+        return
+    table = models.FNOLWorkItem.__table__
+    stmt = table.update().where(table.c.id.in_(list(held)), table.c.status == 'processing')
+    stmt = stmt.values(claim_heartbeat_at=datetime.datetime.utcnow()).returning(table.c.id)
+    alive = set(db.execute(stmt).scalars())
+    db.commit()
+    # A claim younger than one beat may not have been committed yet
+    settled = time.monotonic() - FNOL_CLAIM_HEARTBEAT_SECONDS
+    _drop_claims([workitem_id for workitem_id, claimed_at in held.items()
+                  if workitem_id not in alive and claimed_at < settled])
+
+
+def _heartbeat_loop():
+    import database
+    while not _heartbeat_stop.wait(FNOL_CLAIM_HEARTBEAT_SECONDS):
+        db = database.SessionLocal()
+        try:
+            beat_claims(db)
+        except Exception:
+            log.exception("Refreshing claim heartbeats failed")
+        finally:
+            db.close()
+
+
+def start_heartbeat_thread():
+    """Starts the claim heartbeat in this process (again after a fork); a no-op when running."""
+    global _heartbeat_thread
+    with _live_claims_lock:
+        if _heartbeat_thread is not None and _heartbeat_thread.is_alive():
+            return
+        _heartbeat_stop.clear()
+        _heartbeat_thread = threading.Thread(target=_heartbeat_loop, name="fnol-claim-heartbeat", daemon=True)
+        _heartbeat_thread.start()
+
+
+def stop_heartbeat_thread():
+    global _heartbeat_thread
+    _heartbeat_stop.set()
+    if _heartbeat_thread is not None:
+        _heartbeat_thread.join(timeout=10)
+        _heartbeat_thread = None
+
+
+def _forget_claims_in_child():
+    # The parent keeps beating its own claims
+    global _live_claims_lock, _heartbeat_thread
+    _live_claims_lock = threading.Lock()
+    _live_claims.clear()
+    _heartbeat_thread = None
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_forget_claims_in_child)
+
+
+def claim_rows(db, items, status='processing'):
+    """
+    Inserts the work items of emails that have a message_id in one INSERT ...
+    ON CONFLICT DO NOTHING on uix_fnol_work_items_message_id, as placeholders in
+    `status`, and returns {message_id: workitem_id} of those inserted. Emails
+    that already have a work item are left out. Not committed.
+    """
+    created_at = datetime.datetime.utcnow()
+    table = models.FNOLWorkItem.__table__
+    stmt = rollups.dialect_insert(db.connection())(table).values([
+        {'message_id': item.message_id, 'email_subject': item.subject, 'email_body': item.body,
+         'status': status, 'created_at': created_at}
+        for item in items
+    ])
+    stmt = stmt.on_conflict_do_nothing(index_elements=['message_id'], index_where=table.c.message_id.isnot(None))
+    claimed = {message_id: workitem_id for workitem_id, message_id in
+               db.execute(stmt.returning(table.c.id, table.c.message_id))}
+    rollups.count_inserted(db, workitems=[(created_at, status, None)] * len(claimed))
+    if status == 'processing':
+        _hold_claims(claimed.values())
+    return claimed
+
+
+def release_claims(db, workitem_ids):
+    """
+    Deletes claimed work items whose processing failed, so a redelivery of
+    their emails can claim them again.
+    """
+    db.rollback()
+    _drop_claims(workitem_ids)
+    for db_item in db.query(models.FNOLWorkItem).filter(models.FNOLWorkItem.id.in_(workitem_ids)):
+        db.delete(db_item)
+    try:
+        db.commit()
+    except StaleDataError:
+        # Released by another request in the meantime
+        db.rollback()
+
+
+def _poll_claim(db, message_id):
+    """
+    One look at the work item another delivery of the email claimed:
+    (work item, finished). (None, True) when the claim was released.
+    """
+    db_item = db.execute(
+        select(models.FNOLWorkItem).where(models.FNOLWorkItem.message_id == message_id)
+        .execution_options(populate_existing=True)
+    ).scalars().first()
+    if db_item is None:
+        return None, True
+    if db_item.status not in rollups.TRANSIENT_STATUSES:
+        return db_item, True
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=FNOL_CLAIM_STALE_SECONDS)
+    last_seen = db_item.claim_heartbeat_at or db_item.created_at
+    if db_item.status == 'processing' and last_seen < cutoff and db.execute(
+            select(models.IntakeJob.id).where(models.IntakeJob.workitem_id == db_item.id).limit(1)).first() is None:
+        log.warning("Releasing stale claim on workitem_id=%s for message_id: %s", db_item.id, message_id,
+                    extra={'workitem_id': db_item.id, 'message_id': message_id})
+        release_claims(db, [db_item.id])
+        return None, True
+    return db_item, False
+
+
+def claim_workitem(db, item):
+    """
+    Claims the work item of an email with a message_id before any OCR or LLM
+    call. Returns (work item, True) when this request inserted it, as
+    'processing', or (work item, False) once another delivery of the email
+    that did has finished it. Raises ClaimPending when that work item is
+    still 'processing' (or 'queued') after FNOL_CLAIM_WAIT_SECONDS.
+    """
+    while True:
+        claimed = claim_rows(db, [item])
+        db.commit()
+        if claimed:
+            return db.get(models.FNOLWorkItem, claimed[item.message_id]), True
+        deadline = time.monotonic() + FNOL_CLAIM_WAIT_SECONDS
+        db_item, finished = _poll_claim(db, item.message_id)
+        while not finished and time.monotonic() < deadline:
+            release_connection(db)
+            time.sleep(FNOL_CLAIM_POLL_INTERVAL)
+            db_item, finished = _poll_claim(db, item.message_id)
+        if not finished:
+            raise ClaimPending(db_item)
+        if db_item is not None:
+            return db_item, False
+        # Released after a failure: claim it again
+
+
+async def claim_workitem_async(db, item):
+    """claim_workitem for an AsyncSession."""
+    while True:
+        claimed = await db.run_sync(claim_rows, [item])
+        await db.commit()
+        if claimed:
+            return await db.get(models.FNOLWorkItem, claimed[item.message_id]), True
+        deadline = time.monotonic() + FNOL_CLAIM_WAIT_SECONDS
+        db_item, finished = await db.run_sync(_poll_claim, item.message_id)
+        while not finished and time.monotonic() < deadline:
+            await release_connection_async(db)
+            await asyncio.sleep(FNOL_CLAIM_POLL_INTERVAL)
+            db_item, finished = await db.run_sync(_poll_claim, item.message_id)
+        if not finished:
+            raise ClaimPending(db_item)
+        if db_item is not None:
+            return db_item, False
+
+
+def release_connection(db):
+    """
+    Ends the session's transaction so its pooled connection is returned while
+    the slow OCR/LLM/upload calls run; the next query checks one out again.
+    Callers have nothing pending at that point, so nothing is written.
+    """
+    db.commit()
+
+
+async def release_connection_async(db):
+    await db.commit()
+
+
+def _release_for_original(db, workitem_id, original_id):
+    """
+    Releases the work item of an email answered with its near-duplicate
+    original ('reuse'); a queued email's intake job is moved to the original,
+    so the job still finishes.
+    """
+    db.query(models.IntakeJob).filter(models.IntakeJob.workitem_id == workitem_id).update(
+        {'workitem_id': original_id}, synchronize_session='fetch')
+    db.commit()
+    release_claims(db, [workitem_id])
+
+
+def process_fnol(db, item: schemas.FNOLWorkItemCreate, db_item=None, attempt=1):
+    """
+    Runs the FNOL pipeline (OCR, LLM field extraction, doc-type classification,
+    blob upload) for an email and persists the results.
+    If db_item is given (a work item queued by the async intake), it is filled in
+    and moved to 'pending'; attempt is then its intake job's attempt number,
+    and from the second one on what a failed attempt stored is kept. Otherwise
+    the email's work item is claimed first when it has a message_id
+    (claim_workitem): a concurrent or repeated delivery of it gets the existing
+    work item without running the pipeline, or ClaimPending while that one is
+    unfinished.
+    """
+    queued = db_item is not None
+    claimed = False
+    if not queued and item.message_id:
+        db_item, claimed = claim_workitem(db, item)
+        if not claimed:
+            log.info("Found existing item with id: %s, returning cached result", db_item.id,
+                     extra={'message_id': item.message_id, 'workitem_id': db_item.id})
+            return build_workitem_response(db, db_item)
+    claimed_id = db_item.id if claimed else None
+    try:
+        return _process_workitem(db, item, db_item, attempt > 1)
+    except Exception:
+        if claimed:
+            release_claims(db, [claimed_id])
+        raise
+    finally:
+        if claimed:
+            _drop_claims([claimed_id])
+
+
+def _process_workitem(db, item, db_item, retried):
+    # Near-duplicates of an earlier email with the same attachments skip the
+    # expensive stages (FNOL_NEAR_DUP_MODE); other near-duplicates are flagged
+    attachment_hashes = near_dup.attachment_fingerprints(item)
+    sig = near_dup.item_signature(item, attachment_hashes)
+    match = _find_near_duplicate(db, sig, db_item)
+    duplicate_of_id = None
+    if match is not None:
+        original = db.get(models.FNOLWorkItem, match[0])
+        duplicate_of_id = original.id
+        if _can_skip_pipeline(attachment_hashes, db.execute(_blob_urls_query(original.id)).scalars()):
+            if near_dup.FNOL_NEAR_DUP_MODE == 'reuse' and not retried:
+                if db_item is not None:
+                    _release_for_original(db, db_item.id, original.id)
+                return build_workitem_response(db, original)
+            db_item = _link_duplicate(item, original, db_item)
+            db.add(db_item)
+            with telemetry.span('commit_duplicate'):
+                db.flush()
+                db.add_all(_signature_rows(db, db_item.id, sig, retried))
+                db.commit()
+            db.refresh(db_item)
+            return build_workitem_response(db, db_item)
+
+    existing_filenames = set()
+    if retried:
+        existing_filenames = {
+            filename for (filename,) in
+            db.query(models.Attachment.filename).filter(models.Attachment.workitem_id == db_item.id)
+        }
+    release_connection(db)
+    new_attachments, extracted_fields = run_stages(item, existing_filenames)
+
+    # Step 3: Create (or complete) the FNOL work item
+    db_item = _fill_workitem(item, extracted_fields, db_item)
+    db_item.duplicate_of_id = duplicate_of_id
+    db.add(db_item)
+    with telemetry.span('commit_workitem'):
+        db.commit()
+    db.refresh(db_item)
+
+    # Step 4: Store attachments and the near-duplicate signature in DB
+    try:
+        with telemetry.span('commit_attachments', attachments=len(new_attachments)):
+            insert_attachments(db, _attachment_values(db_item.id, new_attachments))
+            db.add_all(_signature_rows(db, db_item.id, sig, retried))
+            db.commit()
+    except Exception:
+        log.exception("Committing attachments failed for workitem_id=%s", db_item.id,
+                      extra={'workitem_id': db_item.id, 'attachments': len(new_attachments)})
+        db.rollback()
+        raise
+
+    # Step 5: Add the attachment text to the claim's vector index
+    index_attachment_text(db_item.id, new_attachments)
+
+    return build_workitem_response(db, db_item)
+
+
+# --- Async pipeline (FNOL_API_MODE=async) ---
+
+_stage_semaphores = {}
+
+
+def _stage_semaphore(stage):
+    # Semaphores belong to one event loop; recreate them if the loop changed
+    loop = asyncio.get_running_loop()
+    entry = _stage_semaphores.get(stage)
+    if entry is None or entry[0] is not loop:
+        entry = (loop, asyncio.Semaphore(STAGE_CONCURRENCY[stage]))
+        _stage_semaphores[stage] = entry
+    return entry[1]
+
+
+async def _ocr_attachment_async(att_data):
+    if not _decode_attachment(att_data):
+        return None
+    filename, mime_type = att_data['filename'], att_data['mime_type']
+    if mime_type in OCR_MIME_TYPES:
+        try:
+            async with _stage_semaphore('ocr'):
+                with telemetry.span('ocr', attachment=filename, mime_type=mime_type):
+                    att_data['extracted_text'] = await azure_doc_intel.extract_text_from_bytes_async(
+                        att_data['file_bytes'], mime_type, content_hash=att_data['sha256'])
+        except Exception as e:
+            log.warning("Extracting text from %s failed: %s", filename, e, extra={'attachment': filename, 'error': str(e)})
+    return att_data
+
+
+async def _classify_attachments_async(attachment_data):
+    with telemetry.span('classify', attachments=len(attachment_data)):
+        doc_types, uncertain = doc_classifier.classify_attachments(
+            [a['extracted_text'] for a in attachment_data], [a['filename'] for a in attachment_data]
+        )
+        if not uncertain:
+            return doc_types
+        texts = _classification_texts(attachment_data)
+        try:
+            async with _stage_semaphore('classify'):
+                llm_types = await llm_client.guess_doc_types_async([texts[i] for i in uncertain])
+        except Exception as e:
+            log.warning("LLM classification failed, keeping the local document types: %s", e, extra={'error': str(e)})
+            return doc_types
+        return _apply_llm_labels(attachment_data, doc_types, uncertain, llm_types)
+
+
+async def _upload_attachment_async(att_data):
+    async with _stage_semaphore('upload'):
+        with telemetry.span('upload', attachment=att_data['filename']):
+            return await azure_blob.upload_attachment_async(att_data['filename'], att_data['file_bytes'],
+                                                            mime_type=att_data['mime_type'],
+                                                            content_hash=att_data['sha256'],
+                                                            size=att_data['file_size'])
+
+
+async def _extract_fields_async(item, combined_attachment_text):
+    if item.extracted_fields is not None:
+        return item.extracted_fields
+    async with _stage_semaphore('llm'):
+        with telemetry.span('extract_fields'):
+            return await llm_client.extract_fields_from_email_async(item.subject, item.body, combined_attachment_text)
+
+
+async def run_stages_async(item: schemas.FNOLWorkItemCreate, existing_filenames=()):
+    """Async variant of run_stages; stage limits are enforced with semaphores."""
+    attachment_data = _attachment_inputs(item)
+    attachment_data = await asyncio.gather(*(_ocr_attachment_async(a) for a in attachment_data))
+    attachment_data = [a for a in attachment_data if a is not None]
+    extracted_texts = [a['extracted_text'] for a in attachment_data if a['extracted_text']]
+    combined_attachment_text = '\n\n'.join(extracted_texts) if extracted_texts else ''
+
+    new_attachments = _skip_existing(attachment_data, existing_filenames)
+    extracted_fields, doc_types, *blob_urls = await asyncio.gather(
+        _extract_fields_async(item, combined_attachment_text),
+        _classify_attachments_async(new_attachments),
+        *(_upload_attachment_async(a) for a in new_attachments)
+    )
+    for att_data, doc_type, blob_url in zip(new_attachments, doc_types, blob_urls):
+        att_data['doc_type'] = doc_type
+        att_data['blob_url'] = blob_url
+    return new_attachments, extracted_fields
+
+
+async def build_workitem_response_async(db, db_item):
+    result = await db.execute(select(models.Attachment).where(models.Attachment.workitem_id == db_item.id))
+    attachments_out = [
+        schemas.AttachmentOut(id=a.id, filename=a.filename, blob_url=a.blob_url, doc_type=a.doc_type)
+        for a in result.scalars()
+    ]
+    return schemas.FNOLWorkItem(
+        id=db_item.id,
+        message_id=db_item.message_id,
+        email_subject=db_item.email_subject,
+        email_body=db_item.email_body,
+        extracted_fields=db_item.extracted_fields,
+        status=db_item.status,
+        duplicate_of_id=db_item.duplicate_of_id,
+        extraction_error=db_item.extraction_error,
+        attachments=attachments_out
+    )
+
+
+async def process_fnol_async(db, item: schemas.FNOLWorkItemCreate, db_item=None, attempt=1):
+    """process_fnol for an AsyncSession, with async OCR, Gemini and blob clients."""
+    queued = db_item is not None
+    claimed = False
+    if not queued and item.message_id:
+        db_item, claimed = await claim_workitem_async(db, item)
+        if not claimed:
+            log.info("Found existing item with id: %s, returning cached result", db_item.id,
+                     extra={'message_id': item.message_id, 'workitem_id': db_item.id})
+            return await build_workitem_response_async(db, db_item)
+    claimed_id = db_item.id if claimed else None
+    try:
+        return await _process_workitem_async(db, item, db_item, attempt > 1)
+    except Exception:
+        if claimed:
+            await db.run_sync(release_claims, [claimed_id])
+        raise
+    finally:
+        if claimed:
+            _drop_claims([claimed_id])
+
+
+async def _process_workitem_async(db, item, db_item, retried):
+    attachment_hashes = near_dup.attachment_fingerprints(item)
+    sig = near_dup.item_signature(item, attachment_hashes)
+    match = None
+    if near_dup.FNOL_NEAR_DUP_MODE != 'off':
+        match = await near_dup.find_duplicate_async(db, sig, exclude_id=db_item.id if db_item is not None else None)
+    duplicate_of_id = None
+    if match is not None:
+        log.info("Email is a near-duplicate of workitem_id=%s (similarity %.2f)", match[0], match[1],
+                 extra={'duplicate_of_id': match[0], 'similarity': round(match[1], 3)})
+        original = await db.get(models.FNOLWorkItem, match[0])
+        duplicate_of_id = original.id
+        blob_urls = (await db.execute(_blob_urls_query(original.id))).scalars()
+        if _can_skip_pipeline(attachment_hashes, blob_urls):
+            if near_dup.FNOL_NEAR_DUP_MODE == 'reuse' and not retried:
+                if db_item is not None:
+                    await db.run_sync(_release_for_original, db_item.id, original.id)
+                    # The release rolled back the session, expiring the original
+                    original = await db.get(models.FNOLWorkItem, duplicate_of_id)
+                return await build_workitem_response_async(db, original)
+            db_item = _link_duplicate(item, original, db_item)
+            db.add(db_item)
+            with telemetry.span('commit_duplicate'):
+                await db.flush()
+                if not retried or await db.get(models.MinHashSignature, db_item.id) is None:
+                    db.add_all(near_dup.signature_rows(db_item.id, sig))
+                await db.commit()
+            await db.refresh(db_item)
+            return await build_workitem_response_async(db, db_item)
+
+    existing_filenames = set()
+    if retried:
+        result = await db.execute(
+            select(models.Attachment.filename).where(models.Attachment.workitem_id == db_item.id)
+        )
+        existing_filenames = set(result.scalars())
+    await release_connection_async(db)
+    new_attachments, extracted_fields = await run_stages_async(item, existing_filenames)
+
+    db_item = _fill_workitem(item, extracted_fields, db_item)
+    db_item.duplicate_of_id = duplicate_of_id
+    db.add(db_item)
+    with telemetry.span('commit_workitem'):
+        await db.commit()
+    await db.refresh(db_item)
+
+    try:
+        with telemetry.span('commit_attachments', attachments=len(new_attachments)):
+            await db.run_sync(insert_attachments, _attachment_values(db_item.id, new_attachments))
+            if not retried or await db.get(models.MinHashSignature, db_item.id) is None:
+                db.add_all(near_dup.signature_rows(db_item.id, sig))
+            await db.commit()
+    except Exception:
+        log.exception("Committing attachments failed for workitem_id=%s", db_item.id,
+                      extra={'workitem_id': db_item.id, 'attachments': len(new_attachments)})
+        await db.rollback()
+        raise
+
+    index_attachment_text(db_item.id, new_attachments)
+    return await build_workitem_response_async(db, db_item)
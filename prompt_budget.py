@@ -0,0 +1,210 @@
+import os
+import json
+import hashlib
+import logging
+from collections import Counter
+from dotenv import load_dotenv
+
+import vector_store
+
+load_dotenv()
+
+log = logging.getLogger('fnol.llm')
+
+# Estimated tokens of attachment text allowed in one extraction prompt
+LLM_ATTACHMENT_TOKEN_BUDGET = int(os.getenv('LLM_ATTACHMENT_TOKEN_BUDGET', '24000'))
+# Up to this much (deduplicated) attachment text, the most relevant chunks that
+# fit the budget are kept; beyond it, fields are extracted from budget-sized
+# parts separately and merged (map-reduce), at most LLM_MAP_REDUCE_MAX_PARTS parts
+LLM_MAP_REDUCE_TOKENS = int(os.getenv('LLM_MAP_REDUCE_TOKENS', '72000'))
+LLM_MAP_REDUCE_MAX_PARTS = int(os.getenv('LLM_MAP_REDUCE_MAX_PARTS', '6'))
+# 'keyword' scores chunks by overlap with the email and the FNOL field vocabulary;
+# 'embedding' uses the retrieval service's sentence embeddings
+LLM_CHUNK_RANKING = os.getenv('LLM_CHUNK_RANKING', 'keyword')
+
+# Rough average for English text with Gemini's tokenizer
+CHARS_PER_TOKEN = 4
+# Lines repeated this often (page headers, footers, disclaimers) are kept once
+BOILERPLATE_REPEATS = 3
+
+FIELD_VOCABULARY = (
+    "claim policy number insured name phone email address loss date time location cause damage "
+    "accident injury injured claimant hospital treatment police report vehicle property lawsuit "
+    "complaint plaintiff attorney insurer coverage effective expiration reported contact"
+)
+
+
+def estimate_tokens(text):
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN if text else 0
+
+
+class Plan:
+    """
+    What goes into the extraction prompt(s): one attachment text per prompt in
+    `parts` (a single part unless strategy is 'map_reduce'), and the estimated
+    attachment tokens before and after budgeting.
+    """
+
+    def __init__(self, parts, original_tokens, strategy):
+        self.parts = parts
+        self.original_tokens = original_tokens
+        self.kept_tokens = sum(estimate_tokens(part) for part in parts)
+        self.strategy = strategy
+
+    @property
+    def tokens_saved(self):
+        return max(0, self.original_tokens - self.kept_tokens)
+
+
+def _drop_boilerplate(text):
+    lines = text.splitlines()
+    counts = Counter(line.strip() for line in lines if line.strip())
+    seen = set()
+    kept = []
+    for line in lines:
+        key = line.strip()
+        if key and counts[key] >= BOILERPLATE_REPEATS:
+            if key in seen:
+                continue
+            seen.add(key)
+        kept.append(line)
+    return '\n'.join(kept)
+
+
+def dedupe_chunks(attachment_text):
+    """
+    Chunks the attachment text (a string or a list of per-attachment texts)
+    after dropping repeated boilerplate lines, and removes chunks that occur
+    more than once (re-sent or duplicated attachments). Keeps document order.
+    """
+    texts = attachment_text if isinstance(attachment_text, list) else [attachment_text or '']
+    chunks = []
+    seen = set()
+    for text in texts:
+        for chunk in vector_store.chunk_text(_drop_boilerplate(str(text or ''))):
+            digest = hashlib.blake2b(' '.join(chunk.lower().split()).encode('utf-8'), digest_size=16).digest()
+            if digest not in seen:
+                seen.add(digest)
+                chunks.append(chunk)
+    return chunks
+
+
+def _keyword_scores(chunks, query):
+    query_terms = set(query.lower().split()) | set(FIELD_VOCABULARY.split())
+    scores = []
+    for chunk in chunks:
+        words = chunk.lower().split()
+        scores.append(sum(1 for word in words if word.strip('.,:;()') in query_terms) / (len(words) ** 0.5 or 1))
+    return scores
+
+
+def _embedding_scores(chunks, query):
+    import retrieval
+    service = retrieval.get_service()
+    vectors = service.encode(chunks)
+    return list(vectors @ service.encode([f"{query}\n{FIELD_VOCABULARY}"])[0])
+
+
+def rank_chunks(chunks, query, ranking=LLM_CHUNK_RANKING):
+    """Chunk positions, most relevant to the email and the FNOL fields first."""
+    scores = None
+    if ranking == 'embedding':
+        try:
+            scores = _embedding_scores(chunks, query)
+        except Exception as e:
+            log.warning("Embedding ranking unavailable, ranking chunks by keywords: %s", e, extra={'error': str(e)})
+    if scores is None:
+        scores = _keyword_scores(chunks, query)
+    return sorted(range(len(chunks)), key=lambda i: (-scores[i], i))
+
+
+def _chunk_tokens(chunk):
+    # Chunks are joined with a blank line
+    return estimate_tokens(chunk) + 1
+
+
+def _pack(chunks, order, budget, parts=1):
+    """
+    Fills up to `parts` prompts of `budget` tokens with the top-ranked chunks
+    (first fit), and returns each prompt's chunk positions in document order.
+    """
+    bins = [[] for _ in range(parts)]
+    used = [0] * parts
+    for i in order:
+        tokens = _chunk_tokens(chunks[i])
+        for b in range(parts):
+            if used[b] + tokens <= budget:
+                bins[b].append(i)
+                used[b] += tokens
+                break
+    bins = [sorted(positions) for positions in bins if positions]
+    return sorted(bins)
+
+
+def plan(email_subject, email_body, attachment_text, budget=LLM_ATTACHMENT_TOKEN_BUDGET,
+         map_reduce_tokens=LLM_MAP_REDUCE_TOKENS, max_parts=LLM_MAP_REDUCE_MAX_PARTS):
+    if isinstance(attachment_text, list):
+        original = '\n'.join(str(text or '') for text in attachment_text)
+    else:
+        original = attachment_text or ''
+    original_tokens = estimate_tokens(original)
+    if original_tokens <= budget:
+        return Plan([original] if original else [], original_tokens, 'full')
+
+    chunks = dedupe_chunks(attachment_text)
+    deduped_tokens = sum(_chunk_tokens(chunk) for chunk in chunks)
+    if deduped_tokens <= budget:
+        return Plan(['\n\n'.join(chunks)], original_tokens, 'deduped')
+
+    order = rank_chunks(chunks, f"{email_subject}\n{email_body}")
+    if deduped_tokens <= map_reduce_tokens:
+        parts = _pack(chunks, order, budget)
+        strategy = 'ranked'
+    else:
+        parts = _pack(chunks, order, budget, max_parts)
+        strategy = 'map_reduce'
+    return Plan(['\n\n'.join(chunks[i] for i in positions) for positions in parts], original_tokens, strategy)
+
+
+def _is_empty(value):
+    return value is None or value == '' or value == [] or value == {}
+
+
+def merge_fields(results):
+    """
+    Reduces per-part extraction results into one: the first non-empty value
+    wins for scalars, dicts are merged field by field, lists are concatenated
+    without duplicates and a flag is true if any part set it. A field that is
+    empty in every part keeps its empty value ([] for lists). Parts that
+    failed are ignored, unless they all did.
+    """
+    good = [result for result in results if isinstance(result, dict) and 'error' not in result]
+    if not good:
+        return results[0] if results else {}
+
+    def merge(values):
+        present = [value for value in values if value is not None]
+        values = [value for value in present if not _is_empty(value)]
+        if not values:
+            return present[0] if present else None
+        if all(isinstance(value, dict) for value in values):
+            keys = []
+            for value in values:
+                keys.extend(key for key in value if key not in keys)
+            return {key: merge([value.get(key) for value in values]) for key in keys}
+        if all(isinstance(value, bool) for value in values):
+            # Flags like lawsuit_or_complaint_received hold if any part found them
+            return any(values)
+        if all(isinstance(value, list) for value in values):
+            merged = []
+            seen = set()
+            for value in values:
+                for entry in value:
+                    marker = json.dumps(entry, sort_keys=True, default=str)
+                    if marker not in seen:
+                        seen.add(marker)
+                        merged.append(entry)
+            return merged
+        return values[0]
+
+    return merge(good)
@@ -0,0 +1,131 @@
+import os
+import time
+import inspect
+import logging
+import threading
+
+log = logging.getLogger('fnol.providers')
+
+_providers = {}
+
+
+class ClientProvider:
+    """
+    Builds a service client (SDK client, engine, ...) on first use and hands
+    the same one to every caller in the process, so importing a module costs
+    no SDK import, no client construction and no settings check. A forked
+    child never reuses the parent's client: it builds its own, or keeps the
+    inherited one after on_fork(client) when given (e.g. to drop pooled
+    connections). set() swaps in a replacement such as a local fake.
+    warm(client), if given, is run by warm_up() after building, e.g. to open
+    a first connection. close(client), if given, is run (and awaited when it
+    returns an awaitable) by close_all() at shutdown.
+    """
+
+    def __init__(self, name, factory, on_fork=None, warm=None, close=None):
+        self.name = name
+        self.factory = factory
+        self.on_fork = on_fork
+        self.warm = warm
+        self.close = close
+        self.build_seconds = None
+        self._lock = threading.Lock()
+        self._client = None
+        self._pid = None
+        _providers[name] = self
+
+    def get(self):
+        client = self._client
+        if client is not None and self._pid == os.getpid():
+            return client
+        with self._lock:
+            if self._client is None or self._pid != os.getpid():
+                start = time.perf_counter()
+                self._client = self.factory()
+                self._pid = os.getpid()
+                self.build_seconds = time.perf_counter() - start
+                log.info("Built %s client in %.3fs", self.name, self.build_seconds,
+                         extra={'client': self.name, 'seconds': round(self.build_seconds, 4)})
+            return self._client
+
+    def set(self, client):
+        with self._lock:
+            self._client = client
+            self._pid = os.getpid()
+
+    def reset(self):
+        """Forgets the client (the next get() builds a new one) and returns it, or None."""
+        with self._lock:
+            client, self._client, self._pid = self._client, None, None
+            return client
+
+    @property
+    def built(self):
+        return self._client is not None and self._pid == os.getpid()
+
+    def _after_fork_in_child(self):
+        # The parent's lock may have been held by a thread that does not exist here
+        self._lock = threading.Lock()
+        if self._client is not None and self.on_fork is not None:
+            self.on_fork(self._client)
+            self._pid = os.getpid()
+        else:
+            self._client, self._pid = None, None
+
+
+def _after_fork_in_child():
+    for provider in _providers.values():
+        provider._after_fork_in_child()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+def warm_up(names=None):
+    """
+    Builds the named providers (default: all registered) so the first
+    request does not pay for it. Returns {name: seconds or error message};
+    failures and unknown names are logged, not raised.
+    """
+    results = {}
+    for name in set(names or ()) - set(_providers):
+        log.warning("No %s client to warm up", name, extra={'client': name})
+        results[name] = "unknown client"
+    for name, provider in list(_providers.items()):
+        if names is not None and name not in names:
+            continue
+        try:
+            start = time.perf_counter()
+            client = provider.get()
+            if provider.warm is not None:
+                provider.warm(client)
+            results[name] = round(time.perf_counter() - start, 4)
+        except Exception as e:
+            log.warning("Could not warm up the %s client: %s", name, e, extra={'client': name})
+            results[name] = f"{type(e).__name__}: {e}"
+    return results
+
+
+async def close_all(names=None):
+    """
+    Closes the built providers (default: all registered) that have a close
+    hook; the next get() builds a new client. Failures are logged, not raised.
+    """
+    for name, provider in list(_providers.items()):
+        if provider.close is None or (names is not None and name not in names) or not provider.built:
+            continue
+        client = provider.reset()
+        try:
+            result = provider.close(client)
+            if inspect.isawaitable(result):
+                await result
+        except Exception as e:
+            log.warning("Could not close the %s client: %s", name, e, extra={'client': name})
+
+
+def stats():
+    return {
+        name: {'built': provider.built, 'build_seconds': provider.build_seconds}
+        for name, provider in _providers.items()
+    }
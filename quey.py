@@ -1,42 +1,14 @@
-import faiss
-import pickle
-import numpy as np
-from sentence_transformers import SentenceTransformer
-import google.generativeai as genai
-import os
-from dotenv import load_dotenv
-
-load_dotenv()
-
-# ----------------------------
-# Load FAISS index from disk
-# ----------------------------
-def load_faiss_index_and_chunks():
-    index = faiss.read_index("faiss.index")
-    chunks = pickle.load(open("chunks.pkl", "rb"))
-    return index, chunks
+import retrieval
+import llm_client
 
 # ----------------------------
-# Load stored chunks
+# Search the document index
 # ----------------------------
+# The model and index are loaded once per process by retrieval.RetrievalService
 def retrive_relavant_chunks(query: str):
-    index, chunks = load_faiss_index_and_chunks()
-
-    model = SentenceTransformer("all-mpnet-base-v2")
-
-    query_vector = model.encode([query])
-
-    # IMPORTANT: normalize if you used cosine similarity (IndexFlatIP)
-    faiss.normalize_L2(query_vector)
-
-    # Search
-    D, I = index.search(np.array(query_vector), k=3)
-    print("D = ",D)
-    print("I = ", I)
-    retrieved_chunks = []
-    for i in range(len(I[0])):
-        if D[0][i] > 0.35:
-            retrieved_chunks.append(chunks[I[0][i]])
+    results = retrieval.get_service().search(query, k=3)
+    print("Scores = ", [score for score, chunk in results])
+    retrieved_chunks = [chunk for score, chunk in results]
     if len(retrieved_chunks) == 0 :
         return "No relevant information found in the document."
     print("Retrieved Chunks:")
@@ -51,21 +23,7 @@ def retrive_relavant_chunks(query: str):
 
 # Gemini prompt
 def gemini_generation(context: str, query: str):
-    genai.configure(api_key=os.environ.get("GEMINI_API_KEY"))
-    prompt = f"""
-    Answer the question using only the context below.
-    If the answer is not in the context, say "Not found in document."
-
-    Context:
-    {context}
-
-    Question:
-    {query}
-    """
-
-    gemini = genai.GenerativeModel("gemini-2.5-flash")
-    response = gemini.generate_content(prompt)
-
+    response = llm_client.answer_from_context(context, query)
     print(response)
     return response
 
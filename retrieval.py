@@ -0,0 +1,223 @@
+import os
+import time
+import queue
+import threading
+from concurrent.futures import Future
+from dotenv import load_dotenv
+
+load_dotenv()
+
+RETRIEVAL_MODEL = os.getenv('RETRIEVAL_MODEL', 'all-mpnet-base-v2')
+RETRIEVAL_INDEX_PATH = os.getenv('RETRIEVAL_INDEX_PATH', 'faiss.index')
+# Cosine similarity below which a chunk is not considered relevant
+RETRIEVAL_MIN_SCORE = float(os.getenv('RETRIEVAL_MIN_SCORE', '0.35'))
+# Concurrent queries arriving within the wait window are encoded together
+RETRIEVAL_BATCH_SIZE = int(os.getenv('RETRIEVAL_BATCH_SIZE', '32'))
+RETRIEVAL_BATCH_WAIT_MS = float(os.getenv('RETRIEVAL_BATCH_WAIT_MS', '5'))
+
+
+class IndexNotFound(Exception):
+    pass
+
+
+class _ShardChunks:
+    """Chunk lookup for an index built by ann_index.rebuild: vector i -> (workitem_id, position) in the vector store."""
+
+    def __init__(self, ids_path):
+        import numpy as np
+        import vector_store
+        self._ids = np.load(ids_path, mmap_mode='r')
+        self._store = vector_store.get_store()
+
+    def __getitem__(self, i):
+        workitem_id, position = self._ids[i]
+        # None once the claim has been deleted and the index not yet rebuilt
+        return self._store.chunk_text(int(workitem_id), int(position))
+
+
+class RetrievalService:
+    """
+    Long-lived query side of the document index built by ann_index.rebuild. The
+    embedding model and the FAISS index are loaded once (the index memory-mapped
+    where the index type allows it) and reloaded only when the index file
+    changes. Queries are embedded by a single batching thread, so concurrent
+    callers share one encode() call.
+    """
+
+    def __init__(self, model_name=RETRIEVAL_MODEL, index_path=RETRIEVAL_INDEX_PATH,
+                 batch_size=RETRIEVAL_BATCH_SIZE, batch_wait_ms=RETRIEVAL_BATCH_WAIT_MS):
+        self.model_name = model_name
+        self.index_path = index_path
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait_ms / 1000
+        self._model = None
+        self._index = None
+        self._chunks = None
+        self._index_mtime = None
+        self._load_lock = threading.Lock()
+        self._requests = queue.Queue()
+        self._thread = None
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            'queries': 0,
+            'batches': 0,
+            'model_load_seconds': 0.0,
+            'index_loads': 0,
+            'index_load_seconds': 0.0,
+        }
+
+    def _record(self, **deltas):
+        with self._stats_lock:
+            for name, delta in deltas.items():
+                self._stats[name] += delta
+
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['avg_batch_size'] = stats['queries'] / stats['batches'] if stats['batches'] else 0
+        stats['index_size'] = self._index.ntotal if self._index is not None else 0
+        return stats
+
+    def _get_model(self):
+        if self._model is None:
+            with self._load_lock:
+                if self._model is None:
+                    from sentence_transformers import SentenceTransformer
+                    start = time.perf_counter()
+                    self._model = SentenceTransformer(self.model_name)
+                    self._record(model_load_seconds=time.perf_counter() - start)
+        return self._model
+
+    def _get_index(self):
+        """Returns (index, chunks), reloading both if the index file was rewritten."""
+        try:
+            mtime = os.stat(self.index_path).st_mtime
+        except FileNotFoundError:
+            raise IndexNotFound(f"No document index at {self.index_path}, build it with `python ann_index.py rebuild`")
+        if self._index is None or mtime != self._index_mtime:
+            with self._load_lock:
+                if self._index is None or mtime != self._index_mtime:
+                    import faiss
+                    import ann_index
+                    start = time.perf_counter()
+                    try:
+                        index = faiss.read_index(self.index_path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+                    except RuntimeError:
+                        # Index types without mmap support are read into memory
+                        index = faiss.read_index(self.index_path)
+                    ann_index.set_search_params(index)
+                    ids_path = f"{self.index_path}.ids.npy"
+                    if not os.path.exists(ids_path):
+                        # e.g. an index from the old vector.py, whose chunk text was pickled
+                        raise IndexNotFound(f"No chunk ids at {ids_path}, rebuild the index with `python ann_index.py rebuild`")
+                    chunks = _ShardChunks(ids_path)
+                    self._index, self._chunks, self._index_mtime = index, chunks, mtime
+                    self._record(index_loads=1, index_load_seconds=time.perf_counter() - start)
+        return self._index, self._chunks
+
+    def encode(self, texts):
+        """Embeds texts as L2-normalized float32 vectors (cosine similarity with IndexFlatIP)."""
+        import faiss
+        import numpy as np
+        vectors = np.ascontiguousarray(self._get_model().encode(list(texts)), dtype='float32')
+        faiss.normalize_L2(vectors)
+        return vectors
+
+    def warm_up(self):
+        """Loads the model (and the document index, if built) so the first query is not cold."""
+        try:
+            self._get_index()
+        except IndexNotFound:
+            pass
+        self.encode(['warm up'])
+        self._ensure_thread()
+
+    def _ensure_thread(self):
+        if self._thread is None:
+            with self._load_lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._batch_loop, name="retrieval-batcher", daemon=True)
+                    self._thread.start()
+
+    def _next_batch(self):
+        batch = [self._requests.get()]
+        deadline = time.monotonic() + self.batch_wait
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                request = self._requests.get(timeout=remaining) if remaining > 0 else self._requests.get_nowait()
+            except queue.Empty:
+                break
+            batch.append(request)
+        return batch
+
+    def _batch_loop(self):
+        while True:
+            batch = self._next_batch()
+            if any(request is None for request in batch):
+                for request in batch:
+                    if request is not None:
+                        request[1].set_exception(RuntimeError("Retrieval service stopped"))
+                return
+            try:
+                vectors = self.encode([query for query, future in batch])
+            except Exception as e:
+                for query, future in batch:
+                    future.set_exception(e)
+                continue
+            self._record(queries=len(batch), batches=1)
+            for vector, (query, future) in zip(vectors, batch):
+                future.set_result(vector)
+
+    def embed_query(self, query):
+        """Embeds one query, batched with whatever other queries arrive at the same time."""
+        self._ensure_thread()
+        future = Future()
+        self._requests.put((query, future))
+        return future.result()
+
+    def search(self, query, k=3, min_score=RETRIEVAL_MIN_SCORE, workitem_id=None):
+        """
+        Returns up to k (score, chunk_text) pairs scoring above min_score, best
+        first, from the document index or, with workitem_id, from that work
+        item's attachments in the per-claim vector store.
+        """
+        if workitem_id is not None:
+            import vector_store
+            results = vector_store.get_store().search(workitem_id, self.embed_query(query), k)
+            return [(score, text) for score, text, source in results if score > min_score]
+        index, chunks = self._get_index()
+        scores, ids = index.search(self.embed_query(query).reshape(1, -1), min(k, index.ntotal))
+        results = [
+            (float(score), chunks[chunk_id])
+            for score, chunk_id in zip(scores[0], ids[0])
+            if chunk_id != -1 and score > min_score
+        ]
+        return [(score, text) for score, text in results if text is not None]
+
+    def close(self):
+        if self._thread is not None:
+            self._requests.put(None)
+            self._thread.join(timeout=10)
+            self._thread = None
+
+
+_service = None
+_service_lock = threading.Lock()
+
+
+def get_service():
+    global _service
+    if _service is None:
+        with _service_lock:
+            if _service is None:
+                _service = RetrievalService()
+    return _service
+
+
+def close_service():
+    global _service
+    with _service_lock:
+        if _service is not None:
+            _service.close()
+            _service = None
@@ -0,0 +1,348 @@
+import os
+import atexit
+import logging
+import datetime
+import threading
+from collections import defaultdict
+from dotenv import load_dotenv
+from sqlalchemy import event, inspect, select, insert, func, case, cast, and_, or_, Date
+from sqlalchemy.orm import Session
+
+import models
+
+load_dotenv()
+
+log = logging.getLogger('fnol.rollups')
+
+COMPLETED_STATUSES = ('approved', 'closed', 'completed')
+# In-flight states (claimed or waiting for a worker); rows count once they leave them
+TRANSIENT_STATUSES = ('queued', 'processing')
+# Committed rollup deltas are written to the tables at most this often, one
+# upsert per key, outside the request transactions
+FNOL_ROLLUP_FLUSH_SECONDS = float(os.getenv('FNOL_ROLLUP_FLUSH_SECONDS', '5'))
+# Full recompute interval for the rollup tables, catching rows changed outside
+# the ORM (0 disables the background refresh; run `python rollups.py` instead)
+FNOL_ROLLUP_REFRESH_SECONDS = int(os.getenv('FNOL_ROLLUP_REFRESH_SECONDS', '0'))
+
+_stop_event = threading.Event()
+_refresh_thread = None
+
+# Deltas of committed transactions not yet written to the rollup tables
+_pending_lock = threading.RLock()
+_pending_daily = defaultdict(lambda: [0, 0, 0.0])
+_pending_doc_types = defaultdict(int)
+# Held while deltas are written, so a refresh never interleaves with a flush
+_flush_lock = threading.Lock()
+_flush_thread = None
+_flush_stop = threading.Event()
+
+
+def _previous(obj, attr):
+    history = inspect(obj).attrs[attr].history
+    if history.deleted:
+        return history.deleted[0]
+    return getattr(obj, attr)
+
+
+def _workitem_contribution(created_at, status, tag, completed_at):
+    key = (created_at.date(), status or '', tag or '')
+    if status in TRANSIENT_STATUSES:
+        return key, (0, 0, 0.0)
+    processing_count = 0
+    processing_seconds = 0.0
+    if status in COMPLETED_STATUSES and completed_at is not None:
+        processing_count = 1
+        processing_seconds = (completed_at - created_at).total_seconds()
+    return key, (1, processing_count, processing_seconds)
+
+
+def _stamp_completed_at(obj):
+    if obj.status in COMPLETED_STATUSES:
+        if obj.completed_at is None:
+            obj.completed_at = datetime.datetime.utcnow()
+    elif obj.completed_at is not None:
+        obj.completed_at = None
+
+
+def dialect_insert(connection):
+    """The insert() of the connection's dialect, which has on_conflict_do_nothing/do_update."""
+    if connection.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert
+
+
+def _upsert(connection, model, keys, deltas):
+    table = model.__table__
+    stmt = dialect_insert(connection)(table).values(**keys, **deltas)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=list(keys),
+        set_={column: table.c[column] + stmt.excluded[column] for column in deltas}
+    )
+    connection.execute(stmt)
+
+
+@event.listens_for(Session, 'before_flush')
+def _apply_rollup_deltas(session, flush_context, instances):
+    """
+    Stamps completed_at on status changes and records the rollup deltas of
+    the work item and attachment changes about to be flushed on the current
+    transaction; they reach the rollup tables only if it commits. Previous
+    values come from attribute history (the tracked columns use
+    active_history, so they are loaded before being overwritten).
+    """
+    daily, doc_types = _transaction_deltas(session)
+
+    def add(key, contribution, sign):
+        totals = daily[key]
+        for i, value in enumerate(contribution):
+            totals[i] += sign * value
+
+    def previous_contribution(obj):
+        return _workitem_contribution(
+            obj.created_at, _previous(obj, 'status'), _previous(obj, 'tag'), _previous(obj, 'completed_at')
+        )
+
+    for obj in session.new:
+        if isinstance(obj, models.FNOLWorkItem):
+            # Apply the column defaults now so the rollup key is known
+            if obj.created_at is None:
+                obj.created_at = datetime.datetime.utcnow()
+            if obj.status is None:
+                obj.status = 'pending'
+            _stamp_completed_at(obj)
+            add(*_workitem_contribution(obj.created_at, obj.status, obj.tag, obj.completed_at), 1)
+        elif isinstance(obj, models.Attachment):
+            doc_types[obj.doc_type or ''] += 1
+    for obj in session.dirty:
+        if isinstance(obj, models.FNOLWorkItem):
+            state = inspect(obj)
+            if state.attrs.status.history.has_changes():
+                _stamp_completed_at(obj)
+            if not any(state.attrs[attr].history.has_changes() for attr in ('status', 'tag', 'completed_at')):
+                continue
+            add(*previous_contribution(obj), -1)
+            add(*_workitem_contribution(obj.created_at, obj.status, obj.tag, obj.completed_at), 1)
+        elif isinstance(obj, models.Attachment) and inspect(obj).attrs.doc_type.history.has_changes():
+            doc_types[_previous(obj, 'doc_type') or ''] -= 1
+            doc_types[obj.doc_type or ''] += 1
+    for obj in session.deleted:
+        if isinstance(obj, models.FNOLWorkItem):
+            add(*previous_contribution(obj), -1)
+        elif isinstance(obj, models.Attachment):
+            doc_types[_previous(obj, 'doc_type') or ''] -= 1
+
+
+def _transaction_deltas(session):
+    """The (daily, doc_types) deltas of the session's innermost transaction."""
+    transaction = session.get_nested_transaction() or session.get_transaction()
+    deltas = session.info.setdefault('rollup_deltas', {})
+    if transaction not in deltas:
+        deltas[transaction] = (defaultdict(lambda: [0, 0, 0.0]), defaultdict(int))
+    return deltas[transaction]
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard_rolled_back(session, previous_transaction):
+    # Drops the rolled back transaction's deltas and those of savepoints inside it
+    deltas = session.info.get('rollup_deltas')
+    if not deltas:
+        return
+    for transaction in list(deltas):
+        parent = transaction
+        while parent is not None and parent is not previous_transaction:
+            parent = parent.parent
+        if parent is not None:
+            del deltas[transaction]
+
+
+@event.listens_for(Session, 'after_commit')
+def _queue_committed(session):
+    deltas = session.info.pop('rollup_deltas', None)
+    if not deltas:
+        return
+    with _pending_lock:
+        for daily, doc_types in deltas.values():
+            for key, contribution in daily.items():
+                totals = _pending_daily[key]
+                for i, value in enumerate(contribution):
+                    totals[i] += value
+            for doc_type, count in doc_types.items():
+                _pending_doc_types[doc_type] += count
+    start_flush_thread()
+
+
+def flush_pending(db):
+    """Writes the queued deltas of committed transactions, one upsert per rollup row."""
+    with _flush_lock:
+        _flush_pending(db)
+
+
+def _flush_pending(db):
+    global _pending_daily, _pending_doc_types
+    with _pending_lock:
+        daily, doc_types = _pending_daily, _pending_doc_types
+        _pending_daily, _pending_doc_types = defaultdict(lambda: [0, 0, 0.0]), defaultdict(int)
+    if not daily and not doc_types:
+        return
+    try:
+        connection = db.connection()
+        for (day, status, tag), (count, processing_count, processing_seconds) in sorted(daily.items()):
+            if count or processing_count or processing_seconds:
+                _upsert(connection, models.ClaimsDailyRollup, {'day': day, 'status': status, 'tag': tag}, {
+                    'count': count,
+                    'processing_count': processing_count,
+                    'processing_seconds': processing_seconds,
+                })
+        for doc_type, count in sorted(doc_types.items()):
+            if count:
+                _upsert(connection, models.DocTypeRollup, {'doc_type': doc_type}, {'count': count})
+        db.commit()
+    except BaseException:
+        db.rollback()
+        # Put them back for the next flush
+        with _pending_lock:
+            for key, contribution in daily.items():
+                totals = _pending_daily[key]
+                for i, value in enumerate(contribution):
+                    totals[i] += value
+            for doc_type, count in doc_types.items():
+                _pending_doc_types[doc_type] += count
+        raise
+
+
+def count_inserted(session, workitems=(), doc_types=()):
+    """
+    Records rows inserted with Core statements (INSERT ... ON CONFLICT), which
+    the flush listener does not see, on the current transaction like the
+    listener does. workitems are (created_at, status, tag) of the new work
+    items, doc_types those of the new attachments. Later ORM changes to the
+    rows are tracked as usual.
+    """
+    daily, counts = _transaction_deltas(session)
+    for created_at, status, tag in workitems:
+        key, contribution = _workitem_contribution(created_at, status, tag, None)
+        for i, value in enumerate(contribution):
+            daily[key][i] += value
+    for doc_type in doc_types:
+        counts[doc_type or ''] += 1
+
+
+def refresh_rollups(db):
+    """
+    Recomputes both rollup tables from fnol_work_items and attachments. The
+    queued deltas are dropped, the recompute already includes them; no delta
+    is queued or flushed until it is committed, so none is counted twice.
+    """
+    items = models.FNOLWorkItem
+    completed = and_(items.status.in_(COMPLETED_STATUSES), items.completed_at.isnot(None))
+    day = cast(items.created_at, Date)
+    status = func.coalesce(items.status, '')
+    tag = func.coalesce(items.tag, '')
+    daily = select(
+        day,
+        status,
+        tag,
+        func.count(items.id),
+        func.sum(case((completed, 1), else_=0)),
+        func.coalesce(func.sum(case((completed, func.extract('epoch', items.completed_at - items.created_at)), else_=0)), 0)
+    ).group_by(day, status, tag)
+    daily = daily.where(or_(items.status.is_(None), items.status.notin_(TRANSIENT_STATUSES)))
+    doc_type = func.coalesce(models.Attachment.doc_type, '')
+    doc_types = select(doc_type, func.count(models.Attachment.id)).group_by(doc_type)
+
+    with _flush_lock, _pending_lock:
+        db.query(models.ClaimsDailyRollup).delete()
+        db.execute(insert(models.ClaimsDailyRollup).from_select(
+            ['day', 'status', 'tag', 'count', 'processing_count', 'processing_seconds'], daily
+        ))
+        db.query(models.DocTypeRollup).delete()
+        db.execute(insert(models.DocTypeRollup).from_select(['doc_type', 'count'], doc_types))
+        db.commit()
+        _pending_daily.clear()
+        _pending_doc_types.clear()
+
+
+def _refresh_loop():
+    import database
+    while not _stop_event.wait(FNOL_ROLLUP_REFRESH_SECONDS):
+        db = database.SessionLocal()
+        try:
+            refresh_rollups(db)
+        except Exception:
+            log.exception("Refreshing analytics rollups failed")
+            db.rollback()
+        finally:
+            db.close()
+
+
+def _flush_loop():
+    import database
+    while not _flush_stop.wait(FNOL_ROLLUP_FLUSH_SECONDS):
+        db = database.SessionLocal()
+        try:
+            flush_pending(db)
+        except Exception:
+            log.exception("Writing analytics rollups failed")
+        finally:
+            db.close()
+
+
+def start_flush_thread():
+    """Starts the rollup writer in this process (again after a fork); a no-op when running."""
+    global _flush_thread
+    if _flush_thread is not None and _flush_thread.is_alive():
+        return
+    with _pending_lock:
+        if _flush_thread is not None and _flush_thread.is_alive():
+            return
+        if _flush_thread is None:
+            # Short-lived processes (scripts, batch runs) write their last deltas on exit
+            atexit.register(stop_flush_thread)
+        _flush_stop.clear()
+        _flush_thread = threading.Thread(target=_flush_loop, name="fnol-rollup-flush", daemon=True)
+        _flush_thread.start()
+
+
+def stop_flush_thread():
+    """Stops the rollup writer and writes what is still queued."""
+    global _flush_thread
+    import database
+    _flush_stop.set()
+    if _flush_thread is not None:
+        _flush_thread.join(timeout=10)
+        _flush_thread = None
+    db = database.SessionLocal()
+    try:
+        flush_pending(db)
+    finally:
+        db.close()
+
+
+def start_refresh_thread():
+    global _refresh_thread
+    if FNOL_ROLLUP_REFRESH_SECONDS <= 0 or _refresh_thread is not None:
+        return
+    _stop_event.clear()
+    _refresh_thread = threading.Thread(target=_refresh_loop, name="fnol-rollup-refresh", daemon=True)
+    _refresh_thread.start()
+
+
+def stop_refresh_thread():
+    global _refresh_thread
+    _stop_event.set()
+    if _refresh_thread is not None:
+        _refresh_thread.join(timeout=10)
+        _refresh_thread = None
+
+
+if __name__ == "__main__":
+    import database
+    print("Refreshing analytics rollups...")
+    db = database.SessionLocal()
+    try:
+        refresh_rollups(db)
+    finally:
+        db.close()
+    print("Rollups refreshed.")
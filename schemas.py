@@ -1,4 +1,4 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict, field_validator
 import datetime
 from typing import Optional, Dict, Any
 
@@ -35,12 +35,19 @@ class FNOLWorkItem(BaseModel):
     extracted_fields: Optional[Dict[str, Any]] = None
     status: Optional[str] = None
     created_at: Optional[datetime.datetime] = None
+    duplicate_of_id: Optional[int] = None
+    extraction_error: Optional[str] = None
     attachments: Optional[list[AttachmentOut]] = []
 
     class Config:
         from_attributes = True
         validate_by_name = True
 
+class FNOLWorkItemListEntry(FNOLWorkItem):
+    # email_body is left out of list views requested without content
+    body: Optional[str] = Field(None, alias="email_body")
+
+
 class FNOLWorkItemUpdate(BaseModel):
     extracted_fields: Optional[Dict[str, Any]] = None
     status: Optional[str] = None
@@ -50,3 +57,145 @@ class AttachmentCreate(BaseModel):
     filename: str
     blob_url: str
     doc_type: Optional[str] = None
+
+class FNOLJobStatus(BaseModel):
+    workitem_id: int
+    status: Optional[str] = None
+    job_id: Optional[int] = None
+    job_status: Optional[str] = None
+    attempts: int = 0
+    error: Optional[str] = None
+    created_at: Optional[datetime.datetime] = None
+    started_at: Optional[datetime.datetime] = None
+    finished_at: Optional[datetime.datetime] = None
+
+class DocumentQuestion(BaseModel):
+    question: str
+    k: int = 3
+
+class RetrievedChunk(BaseModel):
+    score: float
+    text: str
+
+class DocumentAnswer(BaseModel):
+    answer: str
+    chunks: List[RetrievedChunk] = []
+
+
+# FNOL field set extracted by llm_client. Every field is optional: the model
+# leaves out what the email does not say. Sections and lists the model answers
+# null (or "") for come back empty, so extracted_fields always has this shape.
+
+class _ExtractedSection(BaseModel):
+    model_config = ConfigDict(coerce_numbers_to_str=True)
+
+    @field_validator('*', mode='before')
+    @classmethod
+    def _empty_to_default(cls, value, info):
+        if value is None or value == '':
+            factory = cls.model_fields[info.field_name].default_factory
+            if factory is not None:
+                return factory()
+        return value
+
+class Intent(_ExtractedSection):
+    intent_type: Optional[str] = None
+    confidence_score: Optional[float] = None
+
+class ClaimType(_ExtractedSection):
+    category: Optional[str] = None
+    sub_category: Optional[str] = None
+
+class ReportingContact(_ExtractedSection):
+    name: Optional[str] = None
+    relationship_to_insured: Optional[str] = None
+    phone: Optional[str] = None
+    email: Optional[str] = None
+    preferred_contact_method: Optional[str] = None
+
+class BestContact(_ExtractedSection):
+    contact_type: Optional[str] = None
+    name: Optional[str] = None
+    phone: Optional[str] = None
+    email: Optional[str] = None
+
+class Insured(_ExtractedSection):
+    full_name: Optional[str] = None
+    insured_type: Optional[str] = None
+    phone: Optional[str] = None
+    email: Optional[str] = None
+    address_line1: Optional[str] = None
+    city: Optional[str] = None
+    state: Optional[str] = None
+    postal_code: Optional[str] = None
+
+class Claimant(_ExtractedSection):
+    name: Optional[str] = None
+    claimant_type: Optional[str] = None
+    injury_type: Optional[str] = None
+    phone: Optional[str] = None
+    email: Optional[str] = None
+
+class InjuredPersonContact(_ExtractedSection):
+    name: Optional[str] = None
+    injury_severity: Optional[str] = None
+    medical_treatment_received: Optional[bool] = None
+    hospital_name: Optional[str] = None
+
+class Policy(_ExtractedSection):
+    policy_number: Optional[str] = None
+    policy_type: Optional[str] = None
+    line_of_business: Optional[str] = None
+    effective_date: Optional[str] = None
+    expiration_date: Optional[str] = None
+    insurer_name: Optional[str] = None
+    policy_status: Optional[str] = None
+
+class Loss(_ExtractedSection):
+    loss_date: Optional[str] = None
+    loss_time: Optional[str] = None
+    loss_type: Optional[str] = None
+    cause_of_loss: Optional[str] = None
+    description: Optional[str] = None
+    reported_date: Optional[str] = None
+    location_address_line1: Optional[str] = None
+    location_city: Optional[str] = None
+    location_state: Optional[str] = None
+    location_postal_code: Optional[str] = None
+
+class Acknowledgment(_ExtractedSection):
+    recipient_name: Optional[str] = None
+    recipient_role: Optional[str] = None
+    delivery_method: Optional[str] = None
+    acknowledgment_sent: Optional[bool] = None
+
+class ExtractedFields(_ExtractedSection):
+    summary: Optional[str] = None
+    intent: Intent = Field(default_factory=Intent)
+    reported_by_and_main_contact_are_same: Optional[bool] = None
+    claim_type: ClaimType = Field(default_factory=ClaimType)
+    reporting_contact: ReportingContact = Field(default_factory=ReportingContact)
+    best_contact: BestContact = Field(default_factory=BestContact)
+    reply_to_emails: List[str] = Field(default_factory=list)
+    insured: Insured = Field(default_factory=Insured)
+    claimants: List[Claimant] = Field(default_factory=list)
+    claimants_count: Optional[int] = None
+    injured_person_contact: InjuredPersonContact = Field(default_factory=InjuredPersonContact)
+    plaintiff: Optional[str] = None
+    policy: Policy = Field(default_factory=Policy)
+    loss: Loss = Field(default_factory=Loss)
+    matter: Optional[str] = None
+    acknowledgment: Acknowledgment = Field(default_factory=Acknowledgment)
+    lawsuit_or_complaint_received: Optional[bool] = None
+
+    @classmethod
+    def field_paths(cls):
+        """Dotted paths of the scalar fields and lists, in declaration order."""
+        paths = []
+        for name, field in cls.model_fields.items():
+            section = field.annotation
+            if isinstance(section, type) and issubclass(section, BaseModel):
+                paths += [f"{name}.{inner}" for inner in section.model_fields]
+            else:
+                paths.append(name)
+        return paths
@@ -0,0 +1,224 @@
+import os
+import json
+import time
+import uuid
+import logging
+import datetime
+import contextlib
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from prometheus_client import CollectorRegistry, Histogram, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+load_dotenv()
+
+# Logs of the 'fnol' logger tree: 'json' (one object per line, with the trace
+# id and span fields) or 'text'
+FNOL_LOG_FORMAT = os.getenv('FNOL_LOG_FORMAT', 'json')
+FNOL_LOG_LEVEL = os.getenv('FNOL_LOG_LEVEL', 'INFO')
+# Incoming trace id header (generated when absent), echoed on the response
+TRACE_HEADER = 'X-Request-ID'
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+BYTES_BUCKETS = tuple(1024 * 4 ** i for i in range(10))  # 1 KiB .. 256 MiB
+
+registry = CollectorRegistry()
+stage_seconds = Histogram(
+    'fnol_stage_seconds', 'Time spent in each FNOL pipeline stage', ['stage'],
+    buckets=SECONDS_BUCKETS, registry=registry,
+)
+request_seconds = Histogram(
+    'fnol_request_seconds', 'HTTP request latency', ['method', 'route', 'status'],
+    buckets=SECONDS_BUCKETS, registry=registry,
+)
+attachment_bytes = Histogram(
+    'fnol_attachment_bytes', 'Size of the email attachments taken in', buckets=BYTES_BUCKETS, registry=registry,
+)
+
+log = logging.getLogger('fnol')
+
+_trace_id = contextvars.ContextVar('fnol_trace_id', default=None)
+
+
+def new_trace_id():
+    return uuid.uuid4().hex
+
+
+def current_trace_id():
+    return _trace_id.get()
+
+
+@contextlib.contextmanager
+def trace(trace_id=None):
+    """Runs the block (and the stage pool tasks it submits) under one trace id."""
+    token = _trace_id.set(trace_id or new_trace_id())
+    try:
+        yield _trace_id.get()
+    finally:
+        _trace_id.reset(token)
+
+
+@contextlib.contextmanager
+def span(stage, **fields):
+    """
+    Times a pipeline stage into fnol_stage_seconds{stage} and logs it with the
+    current trace id. Works around awaits too.
+    """
+    start = time.perf_counter()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        seconds = time.perf_counter() - start
+        stage_seconds.labels(stage).observe(seconds)
+        log.info("%s took %.3fs", stage, seconds,
+                 extra={'stage': stage, 'seconds': round(seconds, 4), 'error': error, **fields})
+
+
+def observe_request(method, route, status, seconds):
+    request_seconds.labels(method, route, str(status)).observe(seconds)
+    log.info("%s %s -> %s in %.3fs", method, route, status, seconds,
+             extra={'method': method, 'route': route, 'status': status, 'seconds': round(seconds, 4)})
+
+
+def bind_trace(fn):
+    """Wraps fn to run under the caller's trace id, e.g. on another thread."""
+    trace_id = _trace_id.get()
+    if trace_id is None:
+        return fn
+
+    def run(*args, **kwargs):
+        token = _trace_id.set(trace_id)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _trace_id.reset(token)
+    return run
+
+
+class TracedThreadPoolExecutor(ThreadPoolExecutor):
+    """ThreadPoolExecutor whose tasks log under the submitting caller's trace id."""
+
+    def submit(self, fn, /, *args, **kwargs):
+        return super().submit(bind_trace(fn), *args, **kwargs)
+
+
+# --- Structured logs ---
+
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime', 'trace_id'}
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record: time, level, logger, message, trace id and any `extra` fields."""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'trace_id': getattr(record, 'trace_id', None),
+        }
+        entry.update((key, value) for key, value in vars(record).items() if key not in _RECORD_ATTRIBUTES)
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class _TraceIdFilter(logging.Filter):
+    def filter(self, record):
+        record.trace_id = _trace_id.get()
+        return True
+
+
+def configure_logging(log_format=FNOL_LOG_FORMAT, level=FNOL_LOG_LEVEL):
+    handler = logging.StreamHandler()
+    handler.addFilter(_TraceIdFilter())
+    if log_format == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s [%(trace_id)s] %(message)s'))
+    log.handlers = [handler]
+    log.setLevel(level)
+    log.propagate = False
+
+
+# --- /metrics ---
+
+class _StatsCollector:
+    """Exports the in-process counters kept by llm_client, cache, azure_blob, doc_classifier and database at scrape time."""
+
+    def describe(self):
+        return []
+
+    def collect(self):
+        import cache
+        import azure_blob
+        import llm_client
+        import doc_classifier
+        import database
+
+        llm = llm_client.stats()
+        calls = CounterMetricFamily('fnol_llm_calls', 'Gemini calls, and requests answered without one', labels=['result'])
+        calls.add_metric(['called'], llm['calls'])
+        calls.add_metric(['cache_hit'], llm['cache_hits'])
+        calls.add_metric(['coalesced'], llm['coalesced'])
+        yield calls
+        tokens = CounterMetricFamily('fnol_llm_tokens', 'Gemini tokens used or saved', labels=['kind'])
+        tokens.add_metric(['used'], llm['tokens_used'])
+        tokens.add_metric(['saved_by_cache'], llm['tokens_saved'])
+        tokens.add_metric(['saved_by_prompt_budget'], llm['prompt_tokens_saved'])
+        yield tokens
+        fields = CounterMetricFamily('fnol_llm_invalid_fields', 'Extracted fields that failed schema validation')
+        fields.add_metric([], llm['invalid_fields'])
+        yield fields
+
+        lookups = CounterMetricFamily('fnol_cache_lookups', 'Cache lookups by result', labels=['cache', 'result'])
+        hit_rate = GaugeMetricFamily('fnol_cache_hit_rate', 'Share of cache lookups that hit', labels=['cache'])
+        for name, stats in cache.stats().items():
+            for result in ('memory_hits', 'persistent_hits', 'misses'):
+                lookups.add_metric([name, result], stats[result])
+            hit_rate.add_metric([name], stats['hit_rate'])
+        yield lookups
+        yield hit_rate
+
+        blob = azure_blob.stats()
+        uploads = CounterMetricFamily('fnol_blob_uploads', 'Attachment uploads, and re-uploads skipped for stored content', labels=['result'])
+        uploads.add_metric(['uploaded'], blob['uploads'])
+        uploads.add_metric(['deduplicated'], blob['deduplicated'])
+        yield uploads
+        blob_bytes = CounterMetricFamily('fnol_blob_bytes', 'Attachment bytes uploaded or not re-sent', labels=['result'])
+        blob_bytes.add_metric(['uploaded'], blob['uploaded_bytes'])
+        blob_bytes.add_metric(['deduplicated'], blob['deduplicated_bytes'])
+        yield blob_bytes
+
+        classifier = doc_classifier.stats()
+        classified = CounterMetricFamily('fnol_doc_classifications', 'Attachments labelled locally / escalated to the LLM', labels=['result'])
+        classified.add_metric(['local'], classifier['classified'] - classifier['escalated'])
+        classified.add_metric(['escalated'], classifier['escalated'])
+        yield classified
+
+        connections = GaugeMetricFamily('fnol_db_pool_connections', 'DB pool connections by state', labels=['engine', 'state'])
+        waits = CounterMetricFamily('fnol_db_pool_wait_seconds', 'Time spent waiting for a pooled connection', labels=['engine'])
+        timeouts = CounterMetricFamily('fnol_db_pool_timeouts', 'Checkouts that gave up waiting for a connection', labels=['engine'])
+        for engine, stats in database.pool_stats().items():
+            for state in ('checked_out', 'checked_in', 'overflow'):
+                if state in stats:
+                    connections.add_metric([engine, state], stats[state])
+            waits.add_metric([engine], stats.get('wait_seconds', 0.0))
+            timeouts.add_metric([engine], stats.get('timeouts', 0))
+        yield connections
+        yield waits
+        yield timeouts
+
+
+registry.register(_StatsCollector())
+
+
+def render_metrics():
+    """Returns (body, content type) of the Prometheus text exposition."""
+    return generate_latest(registry), CONTENT_TYPE_LATEST
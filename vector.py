@@ -1,29 +1,29 @@
+import argparse
 from pypdf import PdfReader
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from sentence_transformers import SentenceTransformer
-import faiss
-import numpy as np
 
-# Load PDF
-reader = PdfReader(r"C:\practice\Files\uploaded_files\Demand Latter002.pdf")
-text = "\n".join([page.extract_text() for page in reader.pages])
-
-# Chunk
-splitter = RecursiveCharacterTextSplitter(chunk_size=800, chunk_overlap=150)
-chunks = splitter.split_text(text)
+import ann_index
+import retrieval
+import vector_store
 
-# Embeddings
-model = SentenceTransformer("all-mpnet-base-v2")
-embeddings = model.encode(chunks)
+# Indexes PDFs by hand into a claim's shard of the per-claim vector store (the
+# FNOL pipeline does this for every attachment when FNOL_VECTOR_INDEXING=true).
+# With --rebuild the document index served by POST /documents/ask is then
+# rebuilt from all claim shards, as `python ann_index.py rebuild` does; its
+# chunk text is read from the shards, so no chunk pickle is written.
+parser = argparse.ArgumentParser()
+parser.add_argument('pdfs', nargs='+')
+parser.add_argument('--workitem-id', type=int, required=True)
+parser.add_argument('--rebuild', action='store_true')
+args = parser.parse_args()
 
-# Normalize for cosine similarity
-faiss.normalize_L2(embeddings)
+# Load PDF
+texts = []
+for path in args.pdfs:
+    reader = PdfReader(path)
+    texts.append((path, "\n".join([page.extract_text() or '' for page in reader.pages])))
 
-dimension = embeddings.shape[1]
-index = faiss.IndexFlatIP(dimension)
-index.add(np.array(embeddings))
-print(f"Indexed {index.ntotal} chunks.")
-faiss.write_index(index, "faiss.index")
-import pickle
-pickle.dump(chunks, open("chunks.pkl", "wb"))
+added = vector_store.index_texts(args.workitem_id, texts)
+print(f"Indexed {added} new chunks for workitem_id={args.workitem_id}.")
 
+if args.rebuild:
+    ann_index.rebuild(retrieval.RETRIEVAL_INDEX_PATH)
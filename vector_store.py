@@ -0,0 +1,317 @@
+import os
+import sys
+import json
+import shutil
+import hashlib
+import threading
+from dotenv import load_dotenv
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+import models
+
+load_dotenv()
+
+# Per-claim vector index of attachment text, filled by the FNOL pipeline
+FNOL_VECTOR_INDEXING = os.getenv('FNOL_VECTOR_INDEXING', 'false').lower() == 'true'
+FNOL_VECTOR_DIR = os.getenv('FNOL_VECTOR_DIR', 'vector_index')
+FNOL_CHUNK_SIZE = int(os.getenv('FNOL_CHUNK_SIZE', '800'))
+FNOL_CHUNK_OVERLAP = int(os.getenv('FNOL_CHUNK_OVERLAP', '150'))
+
+# Work items per shard directory, so no directory grows past a few thousand entries
+SHARD_SPAN = 1000
+CHUNK_SEPARATORS = ('\n\n', '\n', '. ', ' ')
+
+_FILES = {
+    # name: (numpy dtype, values per chunk; 0 means dim)
+    'vectors.f32': ('float32', 0),
+    'offsets.u64': ('uint64', 1),
+    'hashes.u64': ('uint64', 1),
+    'sources.u32': ('uint32', 1),
+}
+
+
+def chunk_text(text, size=FNOL_CHUNK_SIZE, overlap=FNOL_CHUNK_OVERLAP):
+    """
+    Splits text into chunks of at most `size` characters, breaking at the last
+    paragraph, line, sentence or word boundary in the window, with `overlap`
+    characters carried over between consecutive chunks.
+    """
+    text = (text or '').strip()
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = min(start + size, len(text))
+        if end < len(text):
+            for separator in CHUNK_SEPARATORS:
+                cut = text.rfind(separator, start + size // 2, end)
+                if cut != -1:
+                    end = cut + len(separator)
+                    break
+        chunk = text[start:end].strip()
+        if chunk:
+            chunks.append(chunk)
+        if end >= len(text):
+            break
+        next_start = max(end - overlap, start + 1)
+        space = text.find(' ', next_start, end)
+        start = space + 1 if space != -1 else next_start
+    return chunks
+
+
+def chunk_hash(text):
+    return int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+class VectorStore:
+    """
+    Chunk embeddings sharded by work item: each work item has a directory of
+    append-only flat files (float32 vectors, uint64 text offsets and chunk
+    hashes, uint32 source ids, UTF-8 chunk text) that are memory-mapped for
+    search, plus a small meta.json written last, whose chunk count is the
+    commit point. Adding to a claim appends to its files only; removing a claim
+    deletes its directory. Nothing is ever rebuilt.
+    """
+
+    def __init__(self, root=FNOL_VECTOR_DIR):
+        self.root = root
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+
+    def shard_path(self, workitem_id):
+        return os.path.join(self.root, str(int(workitem_id) // SHARD_SPAN), str(int(workitem_id)))
+
+    def _lock(self, workitem_id):
+        with self._locks_lock:
+            return self._locks.setdefault(workitem_id, threading.Lock())
+
+    def _read_meta(self, path):
+        try:
+            with open(os.path.join(path, 'meta.json')) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _array(self, path, name, meta):
+        import numpy as np
+        dtype, width = _FILES[name]
+        shape = (meta['count'], width or meta['dim']) if width == 0 else (meta['count'],)
+        if meta['count'] == 0:
+            return np.zeros(shape, dtype=dtype)
+        return np.memmap(os.path.join(path, name), dtype=dtype, mode='r', shape=shape)
+
+    def workitem_ids(self):
+        ids = []
+        if not os.path.isdir(self.root):
+            return ids
+        for shard in os.listdir(self.root):
+            shard_dir = os.path.join(self.root, shard)
+            if os.path.isdir(shard_dir):
+                ids.extend(int(name) for name in os.listdir(shard_dir) if name.isdigit())
+        return sorted(ids)
+
+    def count(self, workitem_id):
+        meta = self._read_meta(self.shard_path(workitem_id))
+        return meta['count'] if meta else 0
+
+    def vectors(self, workitem_id):
+        """The work item's (count, dim) embedding matrix, memory-mapped."""
+        path = self.shard_path(workitem_id)
+        meta = self._read_meta(path)
+        if not meta:
+            import numpy as np
+            return np.zeros((0, 0), dtype='float32')
+        return self._array(path, 'vectors.f32', meta)
+
+    def known_hashes(self, workitem_id):
+        path = self.shard_path(workitem_id)
+        meta = self._read_meta(path)
+        if not meta:
+            return set()
+        return set(self._array(path, 'hashes.u64', meta).tolist())
+
+    def add(self, workitem_id, chunks, vectors, model=None):
+        """
+        Appends chunks to a work item's shard. chunks is a list of
+        (source_filename, text); vectors the matching (n, dim) embeddings.
+        """
+        import numpy as np
+        if not chunks:
+            return 0
+        vectors = np.ascontiguousarray(vectors, dtype='float32')
+        path = self.shard_path(workitem_id)
+        with self._lock(workitem_id):
+            os.makedirs(path, exist_ok=True)
+            meta = self._read_meta(path) or {'dim': vectors.shape[1], 'model': model, 'count': 0, 'sources': []}
+            if vectors.shape[1] != meta['dim']:
+                raise ValueError(f"Embedding dimension {vectors.shape[1]} does not match the index ({meta['dim']})")
+            count = meta['count']
+            sources = meta['sources']
+            source_ids = []
+            for source, _ in chunks:
+                if source not in sources:
+                    sources.append(source)
+                source_ids.append(sources.index(source))
+
+            text_path = os.path.join(path, 'chunks.txt')
+            text_end = int(self._array(path, 'offsets.u64', meta)[-1]) if count else 0
+            encoded = [text.encode('utf-8') for _, text in chunks]
+            offsets = text_end + np.cumsum([len(data) for data in encoded], dtype='uint64')
+            columns = {
+                'vectors.f32': vectors,
+                'offsets.u64': offsets,
+                'hashes.u64': np.array([chunk_hash(text) for _, text in chunks], dtype='uint64'),
+                'sources.u32': np.array(source_ids, dtype='uint32'),
+            }
+            # Drop whatever a crashed append left past the committed count
+            for name, values in columns.items():
+                dtype, width = _FILES[name]
+                committed_size = count * (width or meta['dim']) * np.dtype(dtype).itemsize
+                self._append(os.path.join(path, name), committed_size, values.tobytes())
+            self._append(text_path, text_end, b''.join(encoded))
+
+            meta['count'] = count + len(chunks)
+            tmp_path = os.path.join(path, 'meta.json.tmp')
+            with open(tmp_path, 'w') as f:
+                json.dump(meta, f)
+            os.replace(tmp_path, os.path.join(path, 'meta.json'))
+        return len(chunks)
+
+    @staticmethod
+    def _append(file_path, committed_size, data):
+        with open(file_path, 'ab') as f:
+            f.truncate(committed_size)
+            f.write(data)
+
+    def delete(self, workitem_id):
+        with self._lock(workitem_id):
+            shutil.rmtree(self.shard_path(workitem_id), ignore_errors=True)
+        with self._locks_lock:
+            self._locks.pop(workitem_id, None)
+
+    def search(self, workitem_id, query_vector, k=3):
+        """Exact inner-product search of one work item's chunks; returns [(score, text, source)]."""
+        import numpy as np
+        path = self.shard_path(workitem_id)
+        meta = self._read_meta(path)
+        if not meta or meta['count'] == 0:
+            return []
+        scores = self._array(path, 'vectors.f32', meta) @ np.asarray(query_vector, dtype='float32').reshape(-1)
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        sources = self._array(path, 'sources.u32', meta)
+        return [
+            (float(scores[i]), self.chunk_text(workitem_id, int(i), meta), meta['sources'][int(sources[i])])
+            for i in top
+        ]
+
+    def chunk_text(self, workitem_id, position, meta=None):
+        path = self.shard_path(workitem_id)
+        meta = meta or self._read_meta(path)
+        if not meta or position >= meta['count']:
+            return None
+        offsets = self._array(path, 'offsets.u64', meta)
+        start = int(offsets[position - 1]) if position else 0
+        with open(os.path.join(path, 'chunks.txt'), 'rb') as f:
+            f.seek(start)
+            return f.read(int(offsets[position]) - start).decode('utf-8')
+
+    def source_texts(self, workitem_id):
+        """The work item's indexed chunks joined per source filename: {source: text}."""
+        path = self.shard_path(workitem_id)
+        meta = self._read_meta(path)
+        if not meta or meta['count'] == 0:
+            return {}
+        sources = self._array(path, 'sources.u32', meta)
+        texts = {}
+        for position in range(meta['count']):
+            source = meta['sources'][int(sources[position])]
+            texts.setdefault(source, []).append(self.chunk_text(workitem_id, position, meta))
+        return {source: '\n'.join(chunks) for source, chunks in texts.items()}
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = VectorStore()
+    return _store
+
+
+def use_store(store):
+    """Points get_store() at another VectorStore, e.g. a benchmark's temp directory."""
+    global _store
+    _store = store
+
+
+def index_texts(workitem_id, texts):
+    """
+    Chunks and embeds (source_filename, text) pairs for a work item and appends
+    them to its shard. Chunks already stored for the work item are skipped, and
+    all remaining chunks are embedded in a single batched encode call.
+    Returns the number of chunks added.
+    """
+    import retrieval
+    store = get_store()
+    known = store.known_hashes(workitem_id)
+    chunks = []
+    for source, text in texts:
+        for chunk in chunk_text(text):
+            digest = chunk_hash(chunk)
+            if digest not in known:
+                known.add(digest)
+                chunks.append((source, chunk))
+    if not chunks:
+        return 0
+    service = retrieval.get_service()
+    vectors = service.encode([chunk for _, chunk in chunks])
+    return store.add(workitem_id, chunks, vectors, model=service.model_name)
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_deleted_workitems(session, flush_context):
+    deleted = [obj.id for obj in session.deleted if isinstance(obj, models.FNOLWorkItem)]
+    if deleted:
+        session.info.setdefault('deleted_workitem_ids', []).extend(deleted)
+
+
+@event.listens_for(Session, 'after_commit')
+def _delete_vector_shards(session):
+    for workitem_id in session.info.pop('deleted_workitem_ids', []):
+        get_store().delete(workitem_id)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_deleted_workitems(session):
+    session.info.pop('deleted_workitem_ids', None)
+
+
+def prune(existing_ids):
+    """Deletes the shards of work items that are no longer in the database."""
+    existing_ids = set(existing_ids)
+    store = get_store()
+    removed = [workitem_id for workitem_id in store.workitem_ids() if workitem_id not in existing_ids]
+    for workitem_id in removed:
+        store.delete(workitem_id)
+    return removed
+
+
+if __name__ == "__main__":
+    # python vector_store.py prune  -- drop shards of work items deleted outside the ORM
+    if sys.argv[1:] != ['prune']:
+        print("Usage: python vector_store.py prune")
+        sys.exit(1)
+    import database
+    db = database.SessionLocal()
+    try:
+        ids = [workitem_id for (workitem_id,) in db.query(models.FNOLWorkItem.id)]
+    finally:
+        db.close()
+    removed = prune(ids)
+    print(f"Removed {len(removed)} vector index shards.")